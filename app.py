@@ -1,16 +1,79 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from blockchain import Blockchain
-from crypto_utils import generate_keys, sign_transaction
+from blockstore import PrunedBlockError
+from codec import BLOCK, CONTENT_TYPE, TRANSACTION, TRANSACTIONS, CodecError, UnsupportedFormat, decode, \
+    encode_blocks, encode_headers
+from crypto_pool import TransactionSigner
+from crypto_utils import RSA_SCHEME, SCHEMES, key_address, sign_transaction, transaction_payload
+from keypool import KeyPool
+from mempool import transaction_id
+from metrics import REGISTRY, TRACER
+from snapshot import SnapshotError
+from state import valid_fee, valid_nonce
+from streaming import chain_response
+import argparse
+import atexit
 import json
-import sys
+import os
 
 # Flask app setup and routes
 app = Flask(__name__)
 blockchain = None
+key_pool = KeyPool()  # generates inline until started
+signer = TransactionSigner()
+
+MAX_BULK_TRANSACTIONS = 10000
+
+def request_payload(message_type):
+    # Peers with the binary codec send it under its own content type; anything else is JSON.
+    if request.mimetype == CONTENT_TYPE:
+        return decode(request.get_data(), message_type)
+    return request.get_json()
+
+def negotiated_response(response, encode, items_key):
+    # Answers in the binary codec only if the client prefers it to JSON.
+    if request.accept_mimetypes.best_match(['application/json', CONTENT_TYPE]) == CONTENT_TYPE:
+        try:
+            return Response(encode(response[items_key], response['length']), mimetype=CONTENT_TYPE,
+                            headers={'Vary': 'Accept'}), 200
+        except CodecError:
+            pass
+    return jsonify(response), 200, {'Vary': 'Accept'}
+
+@app.errorhandler(CodecError)
+def codec_error_handler(e):
+    if isinstance(e, UnsupportedFormat):
+        return jsonify({'message': str(e)}), 415
+    return jsonify({'message': f'Malformed binary payload: {str(e)}'}), 400
+
+@app.errorhandler(PrunedBlockError)
+def pruned_block_handler(e):
+    return jsonify({'message': str(e), 'pruned_height': blockchain.store.pruned_height}), 410
+
+def mining_workers(value):
+    # Worker counts come from the query string or JSON; more processes than CPUs only adds overhead.
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError
+        workers = int(value)
+    except ValueError:
+        raise ValueError('workers must be a whole number')
+    return max(1, min(workers, os.cpu_count() or 1))
 
 @app.route('/mine_block', methods=['GET'])
 def mine_block_route():
-    block = blockchain.mine_block()
+    try:
+        engine = blockchain.get_mining_engine(request.args.get('engine'), mining_workers(request.args.get('workers')))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    if request.args.get('background', 'false').lower() in ('1', 'true'):
+        status = blockchain.background_miner.start(engine, blocks=1)
+        return jsonify({'message': 'Mining started in the background', 'mining': status}), 202
+
+    block = blockchain.mine_block(engine)
 
     if block:
         response = {
@@ -32,18 +95,128 @@ def mine_block_route():
 
     return jsonify(response), 200
 
+@app.route('/mining/start', methods=['POST'])
+def mining_start_route():
+    params = request.get_json(silent=True) or {}
+    try:
+        engine = blockchain.get_mining_engine(params.get('engine'), mining_workers(params.get('workers')))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Without a block count the miner keeps going until /mining/stop.
+    status = blockchain.background_miner.start(engine, blocks=params.get('blocks'))
+    return jsonify({'mining': status}), 202
+
+@app.route('/mining/stop', methods=['POST'])
+def mining_stop_route():
+    return jsonify({'mining': blockchain.background_miner.stop()}), 200
+
+@app.route('/mining/status', methods=['GET'])
+def mining_status_route():
+    return jsonify({'mining': blockchain.background_miner.status, 'length': blockchain.snapshot.length}), 200
+
+@app.route('/getwork', methods=['GET'])
+def getwork_route():
+    # The reward goes to ?address if given, otherwise to this node.
+    return jsonify(blockchain.get_work(request.args.get('address'))), 200
+
+@app.route('/submitwork', methods=['POST'])
+def submitwork_route():
+    params = request.get_json(silent=True) or {}
+    nonce = params.get('nonce')
+    if 'job_id' not in params or not isinstance(nonce, int) or isinstance(nonce, bool) or nonce < 0:
+        return jsonify({'message': 'Expected job_id and a non-negative integer nonce'}), 400
+
+    block, error = blockchain.submit_work(params['job_id'], nonce)
+    if block is None:
+        status = {'unknown job': 404, 'stale job': 409}.get(error, 400)
+        return jsonify({'message': error}), status
+    return jsonify({'message': 'Block accepted', 'index': block['index'], 'hash': blockchain.hash(block)}), 201
+
 @app.route('/get_chain', methods=['GET'])
 def get_chain_route():
+    return chain_response(blockchain)
+
+@app.route('/health', methods=['GET'])
+def health_route():
+    # Cheap liveness probe for orchestrators: nothing here touches the block store.
+    length, tip_hash = blockchain.snapshot
     response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain)
+        'status': 'ok',
+        'node': blockchain.node_address,
+        'length': length,
+        'tip_hash': tip_hash,
+        'pending_transactions': len(blockchain.mempool),
+        'peers': len(blockchain.nodes),
+        'mining': blockchain.background_miner.status['state'],
+        'pruned_height': blockchain.store.pruned_height
     }
+    return jsonify(response), 200
 
+@app.route('/snapshot', methods=['GET'])
+def snapshot_route():
+    # Balances, nonces and headers after `height` blocks, the tip by default.
+    # ?commitment=true answers with the commitment only, for comparing nodes.
+    height = request.args.get('height', type=int)
+    snapshot = blockchain.export_snapshot(height)
+    if snapshot is None:
+        return jsonify({'message': 'No snapshot available at that height'}), 404
+    if request.args.get('commitment', 'false').lower() in ('1', 'true'):
+        return jsonify({key: snapshot[key] for key in ('height', 'tip_hash', 'commitment')}), 200
+    return jsonify(snapshot), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/traces', methods=['GET'])
+def traces_route():
+    # Most recent spans first; empty unless the node runs with --trace.
+    limit = request.args.get('limit', 100, type=int)
+    spans = list(TRACER.spans)[::-1][:max(limit, 0)]
+    return jsonify({'enabled': TRACER.enabled, 'spans': spans}), 200
+
+@app.route('/headers', methods=['GET'])
+def headers_route():
+    start = request.args.get('from', 0, type=int)
+    count = min(request.args.get('count', 500, type=int), 2000)
+    response = {
+        'headers': blockchain.get_headers(max(start, 0), max(count, 0)),
+        'length': blockchain.snapshot.length
+    }
+    return negotiated_response(response, encode_headers, 'headers')
+
+@app.route('/blocks', methods=['GET'])
+def blocks_route():
+    start = request.args.get('from', 0, type=int)
+    count = min(request.args.get('count', 100, type=int), 500)
+    response = {
+        'blocks': blockchain.get_blocks(max(start, 0), max(count, 0)),
+        'length': blockchain.snapshot.length
+    }
+    return negotiated_response(response, encode_blocks, 'blocks')
+
+@app.route('/locate', methods=['POST'])
+def locate_route():
+    payload = request.get_json(silent=True) or {}
+    locator = payload.get('locator') if isinstance(payload, dict) else None
+    if not isinstance(locator, list) or not all(isinstance(entry, list) and len(entry) == 2
+                                                and isinstance(entry[1], str) for entry in locator):
+        return jsonify({'message': 'Expected a locator of [height, hash] pairs'}), 400
+
+    response = {
+        'fork_height': blockchain.locate_fork(locator),
+        'length': len(blockchain.chain)
+    }
     return jsonify(response), 200
 
 @app.route('/is_valid', methods=['GET'])
 def is_valid_route():
-    is_valid = blockchain.is_chain_valid(blockchain.chain)
+    full = request.args.get('full', 'false').lower() in ('1', 'true')
+    if full and request.args.get('background', 'false').lower() in ('1', 'true'):
+        return jsonify({'message': 'Full audit started', 'audit': blockchain.start_audit()}), 202
+
+    is_valid = blockchain.is_chain_valid(blockchain.chain, full=full)
     if is_valid:
         response = {
             'message': 'Blockchain is valid'
@@ -55,6 +228,66 @@ def is_valid_route():
 
     return jsonify(response), 200
 
+@app.route('/audit_status', methods=['GET'])
+def audit_status_route():
+    response = {
+        'audit': blockchain.audit_status,
+        'validated_height': blockchain.validated_height
+    }
+    return jsonify(response), 200
+
+@app.route('/get_proof/<txid>', methods=['GET'])
+def get_proof_route(txid):
+    try:
+        proof = blockchain.get_transaction_proof(txid)
+    except ValueError:
+        return jsonify({'message': 'Invalid transaction id'}), 400
+
+    if proof is None:
+        return jsonify({'message': 'Transaction not found'}), 404
+    return jsonify(proof), 200
+
+@app.route('/balance/<address>', methods=['GET'])
+def balance_route(address):
+    response = {
+        'address': address,
+        'balance': blockchain.state.balance(address),
+        'available_balance': blockchain.available_balance(address)
+    }
+    return jsonify(response), 200
+
+@app.route('/account/<address>', methods=['GET'])
+def account_route(address):
+    return jsonify(blockchain.get_account(address)), 200
+
+@app.route('/tx/<txid>', methods=['GET'])
+def transaction_route(txid):
+    transaction = blockchain.get_transaction(txid)
+    if transaction is None:
+        return jsonify({'message': 'Transaction not found'}), 404
+    return jsonify(transaction), 200
+
+@app.route('/address/<address>/txs', methods=['GET'])
+def address_transactions_route(address):
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    before = request.args.get('before')
+    if before is not None:
+        try:
+            before = tuple(int(part) for part in before.split(':'))
+        except ValueError:
+            before = ()
+        if len(before) != 2:
+            return jsonify({'message': 'before must look like <height>:<position>'}), 400
+
+    transactions = blockchain.tx_index.address_transactions(address, limit, before)
+    last = transactions[-1] if len(transactions) == limit else None
+    response = {
+        'address': address,
+        'transactions': transactions,
+        'next': f"{last['height']}:{last['position']}" if last else None
+    }
+    return jsonify(response), 200
+
 @app.route('/add_transaction', methods=['POST'])
 def add_transaction_route():
     add_transaction_json = request.get_json()
@@ -69,7 +302,9 @@ def add_transaction_route():
         add_transaction_json['amount'],
         add_transaction_json['signature'],
         add_transaction_json['public_key'],
-        add_transaction_json['nonce']
+        add_transaction_json['nonce'],
+        add_transaction_json.get('scheme'),
+        add_transaction_json.get('fee')
     )
 
     if index is False:
@@ -80,6 +315,75 @@ def add_transaction_route():
 
     return jsonify(response), 201
 
+def is_well_formed(transaction):
+    # Checked before anything is verified, so one bad item cannot fail the whole batch.
+    # Other keys are refused: they are not signed, but would be stored and hashed with the transaction.
+    transaction_keys = ['sender', 'receiver', 'amount', 'signature', 'public_key', 'nonce']
+    optional_keys = ['scheme', 'fee']
+    fee = transaction.get('fee', 0) if isinstance(transaction, dict) else None
+    return (isinstance(transaction, dict) and all(key in transaction for key in transaction_keys)
+            and all(key in transaction_keys or key in optional_keys for key in transaction)
+            and isinstance(transaction['signature'], str) and isinstance(transaction['public_key'], str)
+            and transaction.get('scheme', RSA_SCHEME) in SCHEMES
+            and valid_nonce(transaction['nonce']) and valid_fee(fee))
+
+@app.route('/add_transactions', methods=['POST'])
+def add_transactions_route():
+    # Takes a JSON array (or {"transactions": [...]}), NDJSON with one
+    # transaction per line, or a binary transaction list, and answers with one
+    # result per item, in order.
+    if request.mimetype == CONTENT_TYPE:
+        transactions = request_payload(TRANSACTIONS)['transactions']
+    elif request.mimetype == 'application/x-ndjson' or request.args.get('format') == 'ndjson':
+        transactions = []
+        for line in request.get_data().splitlines():
+            if line.strip():
+                try:
+                    transactions.append(json.loads(line))
+                except ValueError:
+                    transactions.append(None)
+    else:
+        transactions = request.get_json(silent=True)
+        if isinstance(transactions, dict):
+            transactions = transactions.get('transactions')
+
+    if not isinstance(transactions, list):
+        return jsonify({'message': 'Expected a JSON array, NDJSON or a binary transaction list'}), 400
+    if len(transactions) > MAX_BULK_TRANSACTIONS:
+        return jsonify({'message': f'At most {MAX_BULK_TRANSACTIONS} transactions per request'}), 413
+
+    results = [None] * len(transactions)
+    batch, positions, seen = [], [], set()
+    for position, transaction in enumerate(transactions):
+        if not is_well_formed(transaction):
+            results[position] = {'index': position, 'status': 'rejected', 'reason': 'malformed transaction'}
+            continue
+        txid = transaction_id(transaction)
+        if txid in seen or txid in blockchain.mempool:
+            results[position] = {'index': position, 'txid': txid, 'status': 'rejected', 'reason': 'duplicate'}
+            continue
+        seen.add(txid)
+        batch.append(transaction)
+        positions.append((position, txid))
+
+    # Signatures are verified in parallel, and accepted transactions are gossiped as one batch.
+    for (position, txid), (block_index, reason) in zip(positions, blockchain.add_transactions(batch, reasons=True)):
+        if block_index is False:
+            results[position] = {'index': position, 'txid': txid, 'status': 'rejected', 'reason': reason}
+        else:
+            results[position] = {'index': position, 'txid': txid, 'status': 'accepted', 'block_index': block_index}
+
+    accepted = sum(1 for result in results if result['status'] == 'accepted')
+    if request.args.get('results') == 'rejected':
+        results = [result for result in results if result['status'] == 'rejected']
+    response = {
+        'received': len(transactions),
+        'accepted': accepted,
+        'rejected': len(transactions) - accepted,
+        'results': results
+    }
+    return jsonify(response), 200
+
 @app.route('/sign_transaction', methods=['POST'])
 def sign_transaction_route():
     transaction_data_json = request.get_json() 
@@ -88,22 +392,73 @@ def sign_transaction_route():
     if not all(key in transaction_data_json for key in transaction_keys):
         return 'Some elements of the transaction are missing', 400
 
+    # Without a scheme the transaction is signed with RSA, as before, and the
+    # payload is left untagged.
+    scheme = transaction_data_json.get('scheme', RSA_SCHEME)
+    if scheme not in SCHEMES:
+        return jsonify({'message': f'Unknown signature scheme, expected one of {list(SCHEMES)}'}), 400
+
     private_key = transaction_data_json['private_key']
-    transaction_data = json.dumps({
-        'sender': transaction_data_json['sender'],
-        'receiver': transaction_data_json['receiver'],
-        'amount': transaction_data_json['amount'],
-        'nonce': transaction_data_json['nonce']
-    }, sort_keys=True).encode()
+    transaction_data = transaction_payload(transaction_data_json)
 
-    signature = sign_transaction(private_key, transaction_data)
+    signature = sign_transaction(private_key, transaction_data, scheme)
 
     response = {
         'signature': signature.hex()
     }
+    if 'scheme' in transaction_data_json:
+        response['scheme'] = scheme
 
     return jsonify(response), 200
 
+@app.route('/sign_transactions', methods=['POST'])
+def sign_transactions_route():
+    # Takes a JSON array, or {"transactions": [...]} where a top-level
+    # private_key and scheme apply to every item that has none of its own.
+    # Answers with one result per item, in order.
+    body = request.get_json(silent=True)
+    defaults = {}
+    if isinstance(body, dict):
+        defaults = {key: body[key] for key in ('private_key', 'scheme') if key in body}
+        body = body.get('transactions')
+    if not isinstance(body, list):
+        return jsonify({'message': 'Expected a JSON array or {"transactions": [...]}'}), 400
+    if len(body) > MAX_BULK_TRANSACTIONS:
+        return jsonify({'message': f'At most {MAX_BULK_TRANSACTIONS} transactions per request'}), 413
+
+    transaction_keys = ['sender', 'receiver', 'amount', 'nonce', 'private_key']
+    results = [None] * len(body)
+    items, positions = [], []
+    for position, transaction in enumerate(body):
+        if isinstance(transaction, dict):
+            transaction = dict(defaults, **transaction)
+        if not isinstance(transaction, dict) or not all(key in transaction for key in transaction_keys):
+            results[position] = {'index': position, 'message': 'Some elements of the transaction are missing'}
+            continue
+        scheme = transaction.get('scheme', RSA_SCHEME)
+        if scheme not in SCHEMES or not isinstance(transaction['private_key'], str):
+            results[position] = {'index': position, 'message': 'Unknown signature scheme or unreadable key'}
+            continue
+        items.append((transaction['private_key'], transaction_payload(transaction), scheme))
+        positions.append((position, transaction))
+
+    for (position, transaction), signature in zip(positions, signer.sign_batch(items)):
+        if signature is None:
+            results[position] = {'index': position, 'message': 'Unreadable private key'}
+        else:
+            results[position] = {'index': position, 'signature': signature}
+            if 'scheme' in transaction:
+                results[position]['scheme'] = transaction['scheme']
+
+    signed = sum(1 for result in results if 'signature' in result)
+    response = {
+        'received': len(body),
+        'signed': signed,
+        'failed': len(body) - signed,
+        'results': results
+    }
+    return jsonify(response), 200
+
 @app.route('/connect_node', methods=['POST'])
 def connect_node_route():
     json = request.get_json()
@@ -134,61 +489,156 @@ def get_nodes_route():
 def replace_chain_route():
     is_chain_replaced = blockchain.replace_chain()
 
+    return chain_response(blockchain, 'chain', {'is_chain_replaced': f'Chain is replaced: {is_chain_replaced}'})
+
+@app.route('/receive_transaction', methods=['POST'])
+def receive_transaction_route():
+    transaction = request_payload(TRANSACTION)
+    if not is_well_formed(transaction):
+        return 'Malformed transaction', 400
+
+    if transaction_id(transaction) in blockchain.mempool:
+        return jsonify({'message': 'Transaction already in pool'}), 200
+    if blockchain.add_transactions([transaction], broadcast=False)[0] is False:
+        return jsonify({'message': 'Invalid transaction'}), 400
+    return jsonify({'message': 'Transaction received and added to pool'}), 200
+
+@app.route('/receive_transactions', methods=['POST'])
+def receive_transactions_route():
+    transactions = request_payload(TRANSACTIONS)
+    if request.mimetype == CONTENT_TYPE:
+        transactions = transactions['transactions']
+    if not isinstance(transactions, list) or not all(is_well_formed(tx) for tx in transactions):
+        return 'Expected a list of well-formed transactions', 400
+
+    new_transactions = [tx for tx in transactions if transaction_id(tx) not in blockchain.mempool]
+    results = blockchain.add_transactions(new_transactions, broadcast=False)
     response = {
-        'is_chain_replaced': f'Chain is replaced: {is_chain_replaced}',
-        'chain': blockchain.chain
+        'received': len(transactions),
+        'added': sum(1 for result in results if result is not False)
     }
-
     return jsonify(response), 200
 
-@app.route('/receive_transaction', methods=['POST'])
-def receive_transaction_route():
-    transaction = request.get_json()
-    transaction_str = json.dumps(transaction, sort_keys=True)
-    if transaction_str not in blockchain.transaction_pool:
-        blockchain.pending_transactions.append(transaction)
-        blockchain.transaction_pool.add(transaction_str)
-        return jsonify({'message': 'Transaction received and added to pool'}), 200
-    return jsonify({'message': 'Transaction already in pool'}), 200
+@app.route('/gossip_stats', methods=['GET'])
+def gossip_stats_route():
+    return jsonify(blockchain.gossip.stats()), 200
 
 @app.route('/receive_block', methods=['POST'])
 def receive_block_route():
-    block = request.get_json()
-    if blockchain.is_chain_valid([blockchain.get_previous_block(), block]):
-        blockchain.chain.append(block)
-        blockchain.sync_transaction_pool()
-        return jsonify({'message': 'Block received and added to chain'}), 200
-    return jsonify({'message': 'Invalid block'}), 400
+    block = request_payload(BLOCK)
+    status = blockchain.receive_block(block)
+    if status is None:
+        return jsonify({'message': 'Invalid block'}), 400
+    if status == 'orphan':
+        return jsonify({'message': 'Block parent unknown, holding it as an orphan', 'status': status}), 202
+    messages = {
+        'added': 'Block received and added to chain',
+        'reorg': 'Block received, switched to its branch',
+        'side': 'Block stored on a side branch',
+        'known': 'Block already known'
+    }
+    return jsonify({'message': messages[status], 'status': status}), 200
+
+@app.route('/block/<block_hash>', methods=['GET'])
+def block_by_hash_route(block_hash):
+    height = blockchain.store.height_of(block_hash)
+    if height is None:
+        return jsonify({'message': 'Block not found'}), 404
+    return jsonify({'block': blockchain.chain[height], 'hash': block_hash, 'height': height}), 200
+
+@app.route('/block/height/<int:height>', methods=['GET'])
+def block_by_height_route(height):
+    if height >= len(blockchain.chain):
+        return jsonify({'message': 'Block not found'}), 404
+    response = {
+        'block': blockchain.chain[height],
+        'hash': blockchain.store.block_hash(height),
+        'height': height
+    }
+    return jsonify(response), 200
 
 @app.route('/apply_consensus', methods=['GET'])
 def apply_consensus_route():
     consensus_applied = blockchain.apply_consensus()
-    
+
     if consensus_applied:
-        response = {
-            'message': 'The chain was replaced by the longest one in the network.',
-            'new_chain': blockchain.chain
-        }
+        key, message = 'new_chain', 'The chain was replaced by the one with the most work in the network.'
     else:
+        key, message = 'chain', 'This chain is authoritative. No consensus changes needed.'
+
+    if request.args.get('chain', 'true').lower() in ('0', 'false'):
+        # Callers that only want the outcome can skip downloading the chain.
         response = {
-            'message': 'This chain is authoritative. No consensus changes needed.',
-            'chain': blockchain.chain
+            'message': message,
+            'replaced': consensus_applied,
+            'length': blockchain.snapshot.length
         }
-    
-    return jsonify(response), 200
+        return jsonify(response), 200
+    return chain_response(blockchain, key, {'message': message})
 
 @app.route('/generate_keys', methods=['GET'])
 def generate_keys_route():
-    private_key, public_key = generate_keys()
+    scheme = request.args.get('scheme', RSA_SCHEME)
+    if scheme not in SCHEMES:
+        return jsonify({'message': f'Unknown signature scheme, expected one of {list(SCHEMES)}'}), 400
+    private_key, public_key = key_pool.get(scheme)
     response = {
         'private_key': private_key,
-        'public_key': public_key
+        'public_key': public_key,
+        'address': key_address(public_key),  # the sender of transactions signed with this key
+        'scheme': scheme
     }
     return jsonify(response), 200
 
 if __name__ == '__main__':
-    port = 5000  # Default port
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
-    blockchain = Blockchain(port)
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Run a blockchain node.')
+    parser.add_argument('port', nargs='?', type=int, default=5000)
+    parser.add_argument('--server', choices=['waitress', 'dev'], default='waitress',
+                        help='waitress (threaded WSGI server) or the Flask development server')
+    parser.add_argument('--threads', type=int, default=8, help='request handler threads')
+    parser.add_argument('--debug', action='store_true', help='Flask debug mode, implies --server dev')
+    parser.add_argument('--storage-format', choices=['json', 'binary'], default='json',
+                        help='format of newly stored blocks; existing records are read either way')
+    parser.add_argument('--wire-format', choices=['binary', 'json'], default='binary',
+                        help='format offered to peers for gossip and sync; JSON is always accepted')
+    parser.add_argument('--trace', action='store_true',
+                        help='record spans around mining, consensus and received blocks, served at /traces')
+    parser.add_argument('--prune', type=int, metavar='BLOCKS',
+                        help='keep only headers and the bodies of the most recent BLOCKS blocks')
+    parser.add_argument('--snapshot', metavar='FILE', help='bootstrap an empty node from a state snapshot file')
+    parser.add_argument('--snapshot-commitment', metavar='HASH',
+                        help='refuse the snapshot unless it has this commitment, as served by a trusted node')
+    parser.add_argument('--reward-address', metavar='ADDRESS',
+                        help='account credited with mining rewards, the address /generate_keys returns with a key')
+    parser.add_argument('--key-pool-size', type=int, default=16,
+                        help='RSA keypairs generated ahead of time for /generate_keys, 0 to disable')
+    args = parser.parse_args()
+
+    if args.trace:
+        TRACER.enable()
+
+    if args.prune is not None and args.prune < 1:
+        parser.error('--prune must keep at least one block')
+    try:
+        blockchain = Blockchain(args.port, storage_format=args.storage_format, wire_format=args.wire_format,
+                                prune=args.prune, bootstrap_snapshot=args.snapshot,
+                                snapshot_commitment=args.snapshot_commitment, reward_address=args.reward_address)
+    except SnapshotError as e:
+        parser.exit(1, f"Cannot bootstrap from {args.snapshot}: {str(e)}\n")
+    atexit.register(blockchain.close)
+    key_pool = KeyPool(size=args.key_pool_size).start()
+    atexit.register(key_pool.close)
+    atexit.register(signer.close)
+
+    # The node state lives in this process, so requests are served by threads
+    # rather than worker processes; Blockchain.lock serializes chain updates.
+    serve = None
+    if args.server == 'waitress' and not args.debug:
+        try:
+            from waitress import serve
+        except ImportError:
+            print("waitress is not installed, falling back to the Flask development server")
+    if serve is not None:
+        serve(app, host='0.0.0.0', port=args.port, threads=args.threads)
+    else:
+        app.run(host='0.0.0.0', port=args.port, debug=args.debug, threaded=True, use_reloader=False)
\ No newline at end of file
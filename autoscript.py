@@ -1,118 +1,271 @@
-import requests
-import time
+import argparse
+import asyncio
 import json
-import threading
-from concurrent.futures import ThreadPoolExecutor
 import logging
+import random
+import statistics
+import time
+from collections import deque
+
+import aiohttp
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class NodeStats:
+    def __init__(self, interval):
+        self.started = time.monotonic()
+        self.blocks = 0
+        self.failures = 0
+        self.chain_replacements = 0
+        self.interval = interval  # pause before the next mining round, adjusted after every round
+        self.latencies = deque(maxlen=200)  # seconds per /mine_block round trip
+        self.overheads = deque(maxlen=200)  # seconds of each round not spent mining
+        self.length = None
+
+    def record_round(self, latency, overhead):
+        self.blocks += 1
+        self.latencies.append(latency)
+        self.overheads.append(overhead)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2) if latencies else None
+
+        return {
+            'blocks': self.blocks,
+            'blocks_per_minute': round(self.blocks * 60 / elapsed, 2),
+            'failures': self.failures,
+            'chain_replacements': self.chain_replacements,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'overhead_avg_ms': round(statistics.fmean(self.overheads) * 1000, 2) if self.overheads else None,
+            'interval_seconds': round(self.interval, 3),
+            'length': self.length
+        }
+
 class MultiChainAutomation:
-    def __init__(self, chains):
+    """Drives mining and consensus on many nodes from one asyncio loop.
+
+    All requests share one aiohttp session, so each node keeps a few
+    keep-alive connections instead of opening one per request, and at most
+    `max_in_flight` mining requests run at once. Each node is paced on its
+    own: the part of a round not spent mining (queueing, HTTP, consensus)
+    is compared with `target_overhead`, and the pause before the node's
+    next round doubles when it is over and halves when it is under.
+    """
+
+    def __init__(self, chains, max_in_flight=64, min_interval=0.0, max_interval=30.0, target_overhead=0.5,
+                 consensus_every=1):
         self.chains = chains
-        self.mining_threads = {}
+        self.mining_tasks = {}
         self.stop_mining = {}
+        self.node_stats = {}
         self.node_check_interval = 300
+        self.report_interval = 30
         self.max_retries = 3
         self.retry_delay = 5
+        self.max_in_flight = max_in_flight
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_overhead = target_overhead
+        self.consensus_every = consensus_every
+        self.session = None
+        self.semaphore = None
+
+    async def get_json(self, url, timeout):
+        start = time.monotonic()
+        async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            return await response.json(), time.monotonic() - start
 
-    def mine_continuously(self, chain_url):
+    async def mine_continuously(self, chain_url):
+        stats = self.node_stats[chain_url]
         retries = 0
+        # Spread the first requests out so hundreds of nodes do not all start mining at once.
+        await asyncio.sleep(random.uniform(0, min(5.0, 0.01 * len(self.chains))))
         while not self.stop_mining.get(chain_url, False):
             try:
-                response = requests.get(f"{chain_url}/mine_block", timeout=25)
-                response.raise_for_status()
-                block_data = response.json()
+                async with self.semaphore:
+                    block_data, latency = await self.get_json(f"{chain_url}/mine_block", timeout=25)
                 block_time = block_data.get('block_time', 0)
-                logging.info(f"Mined a block on {chain_url} in {block_time:.2f} seconds")
-                
+                overhead = max(0.0, latency - block_time)
+                stats.record_round(latency, overhead)
+                logging.debug(f"Mined a block on {chain_url} in {block_time:.2f} seconds")
+
                 # Apply consensus after mining a block
-                self.apply_consensus(chain_url)
-                
+                if stats.blocks % self.consensus_every == 0:
+                    overhead += await self.apply_consensus(chain_url)
+
+                self.pace(stats, overhead)
                 retries = 0
-            except requests.RequestException as e:
-                logging.error(f"Failed to mine a block on {chain_url}: {str(e)}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Failed to mine a block on {chain_url}: {str(e) or type(e).__name__}")
+                stats.failures += 1
                 retries += 1
                 if retries > self.max_retries:
                     logging.error(f"Max retries exceeded for {chain_url}. Stopping mining on this chain.")
-                    self.stop_mining_on_chain(chain_url)
+                    self.stop_mining[chain_url] = True
+                    self.mining_tasks.pop(chain_url, None)
                     break
-                time.sleep(self.retry_delay)
+                stats.interval = min(self.max_interval, max(stats.interval, self.retry_delay * 2 ** (retries - 1)))
+            if stats.interval > 0:
+                await asyncio.sleep(stats.interval)
+
+    def pace(self, stats, overhead):
+        if overhead > self.target_overhead:
+            stats.interval = min(self.max_interval, max(stats.interval * 2, 0.1))
+        else:
+            stats.interval = max(self.min_interval, stats.interval / 2 if stats.interval > 0.05 else 0.0)
 
-    def apply_consensus(self, chain_url):
+    async def apply_consensus(self, chain_url):
+        """Returns the seconds the request took, or 0 if it failed."""
         try:
-            response = requests.get(f"{chain_url}/apply_consensus", timeout=10)
-            response.raise_for_status()
-            result = response.json()
-            if 'message' in result:
-                if "chain was replaced" in result['message']:
-                    logging.info(f"Consensus applied on {chain_url}: {result['message']}")
-                else:
-                    logging.info(f"No consensus changes needed on {chain_url}: {result['message']}")
-            else:
-                logging.warning(f"Unexpected response from {chain_url}: {result}")
-        except requests.RequestException as e:
-            logging.error(f"Failed to apply consensus on {chain_url}: {str(e)}")
+            result, latency = await self.get_json(f"{chain_url}/apply_consensus?chain=false", timeout=10)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Failed to apply consensus on {chain_url}: {str(e) or type(e).__name__}")
+            return 0.0
+
+        stats = self.node_stats[chain_url]
+        stats.length = result.get('length', stats.length)
+        if 'message' not in result:
+            logging.warning(f"Unexpected response from {chain_url}: {result}")
+        elif result.get('replaced'):
+            stats.chain_replacements += 1
+            logging.info(f"Consensus applied on {chain_url}: {result['message']}")
+        else:
+            logging.debug(f"No consensus changes needed on {chain_url}: {result['message']}")
+        return latency
 
     def start_mining(self, chain_url):
-        if chain_url not in self.mining_threads:
+        if chain_url not in self.mining_tasks:
             self.stop_mining[chain_url] = False
-            thread = threading.Thread(target=self.mine_continuously, args=(chain_url,))
-            thread.start()
-            self.mining_threads[chain_url] = thread
+            self.node_stats.setdefault(chain_url, NodeStats(self.min_interval))
+            self.mining_tasks[chain_url] = asyncio.create_task(self.mine_continuously(chain_url))
             logging.info(f"Started mining on {chain_url}")
 
-    def stop_mining_on_chain(self, chain_url):
-        if chain_url in self.mining_threads:
+    async def stop_mining_on_chain(self, chain_url):
+        task = self.mining_tasks.pop(chain_url, None)
+        if task is not None:
             self.stop_mining[chain_url] = True
-            self.mining_threads[chain_url].join()
-            del self.mining_threads[chain_url]
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
             logging.info(f"Stopped mining on {chain_url}")
 
-    def check_chain_health(self, chain_url):
+    async def check_chain_health(self, chain_url):
         try:
-            response = requests.get(f"{chain_url}/get_chain", timeout=5)
-            response.raise_for_status()
-            return True
-        except requests.RequestException:
+            result, _ = await self.get_json(f"{chain_url}/health", timeout=5)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
             return False
+        if chain_url in self.node_stats:
+            self.node_stats[chain_url].length = result.get('length')
+        return result.get('status') == 'ok'
 
-    def manage_chains(self):
+    async def manage_chains(self):
         while True:
-            for chain in list(self.chains):
-                if not self.check_chain_health(chain):
+            chains = list(self.chains)
+            healthy = await asyncio.gather(*(self.check_chain_health(chain) for chain in chains))
+            for chain, is_healthy in zip(chains, healthy):
+                if not is_healthy:
                     logging.warning(f"Chain {chain} is unhealthy. Stopping mining and removing from chain list.")
-                    self.stop_mining_on_chain(chain)
+                    await self.stop_mining_on_chain(chain)
                     self.chains.remove(chain)
-            time.sleep(self.node_check_interval)
+            await asyncio.sleep(self.node_check_interval)
 
-    def run(self):
-        logging.info("Starting automatic mining on all chains...")
-        for chain in self.chains:
-            self.start_mining(chain)
+    def stats(self):
+        nodes = {chain: stats.stats() for chain, stats in self.node_stats.items()}
+        latencies = [node['latency_p50_ms'] for node in nodes.values() if node['latency_p50_ms'] is not None]
+        return {
+            'mining_nodes': len(self.mining_tasks),
+            'blocks': sum(node['blocks'] for node in nodes.values()),
+            'blocks_per_minute': round(sum(node['blocks_per_minute'] for node in nodes.values()), 2),
+            'failures': sum(node['failures'] for node in nodes.values()),
+            'median_latency_ms': round(statistics.median(latencies), 2) if latencies else None,
+            'nodes': nodes
+        }
 
-        chain_management_thread = threading.Thread(target=self.manage_chains)
-        chain_management_thread.daemon = True
-        chain_management_thread.start()
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            summary = self.stats()
+            logging.info(f"{summary['mining_nodes']} nodes mining, {summary['blocks']} blocks "
+                         f"({summary['blocks_per_minute']}/min), {summary['failures']} failures, "
+                         f"median latency {summary['median_latency_ms']} ms")
 
+    async def run_async(self, duration=None):
+        connector = aiohttp.TCPConnector(limit=max(100, 2 * len(self.chains)), limit_per_host=4, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        background = []
         try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
+            logging.info(f"Starting automatic mining on {len(self.chains)} chains...")
+            for chain in self.chains:
+                self.start_mining(chain)
+            background = [asyncio.create_task(self.manage_chains()), asyncio.create_task(self.report())]
+
+            if duration is None:
+                await asyncio.Event().wait()
+            else:
+                await asyncio.sleep(duration)
+        finally:
             logging.info("Stopping all mining operations...")
-            for chain_url in list(self.mining_threads.keys()):
-                self.stop_mining_on_chain(chain_url)
+            for task in background:
+                task.cancel()
+            for chain_url in list(self.mining_tasks.keys()):
+                await self.stop_mining_on_chain(chain_url)
+            await self.session.close()
+        return self.stats()
+
+    def run(self, duration=None):
+        try:
+            return asyncio.run(self.run_async(duration))
+        except KeyboardInterrupt:
+            return self.stats()
+
+def main():
+    parser = argparse.ArgumentParser(description='Mine continuously on every node in a nodes file.')
+    parser.add_argument('nodes_file', nargs='?', default='nodes.json')
+    parser.add_argument('--max-in-flight', type=int, default=64, help='mining requests running at once')
+    parser.add_argument('--min-interval', type=float, default=0.0, help='shortest pause between rounds on a node')
+    parser.add_argument('--max-interval', type=float, default=30.0, help='longest pause between rounds on a node')
+    parser.add_argument('--target-overhead', type=float, default=0.5,
+                        help='seconds per round outside mining before a node is slowed down')
+    parser.add_argument('--consensus-every', type=int, default=1, help='apply consensus every N blocks')
+    parser.add_argument('--check-interval', type=float, default=300, help='seconds between health checks')
+    parser.add_argument('--report-interval', type=float, default=30, help='seconds between progress reports')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    parser.add_argument('--stats', help='write per-node statistics as JSON to this file on exit')
+    args = parser.parse_args()
 
-if __name__ == "__main__":
     try:
-        with open('nodes.json', 'r') as f:
+        with open(args.nodes_file, 'r') as f:
             nodes_data = json.load(f)
         nodes = nodes_data['nodes']
-        automation = MultiChainAutomation(nodes)
-        automation.run()
     except FileNotFoundError:
-        logging.error("nodes.json file not found. Please create a JSON file with a list of chain URLs.")
+        logging.error(f"{args.nodes_file} file not found. Please create a JSON file with a list of chain URLs.")
+        return
     except json.JSONDecodeError:
-        logging.error("Error parsing chains.json. Please ensure it's a valid JSON file.")
+        logging.error(f"Error parsing {args.nodes_file}. Please ensure it's a valid JSON file.")
+        return
+
+    automation = MultiChainAutomation(nodes, max_in_flight=args.max_in_flight, min_interval=args.min_interval,
+                                      max_interval=args.max_interval, target_overhead=args.target_overhead,
+                                      consensus_every=args.consensus_every)
+    automation.node_check_interval = args.check_interval
+    automation.report_interval = args.report_interval
+    try:
+        summary = automation.run(args.duration)
     except Exception as e:
-        logging.error(f"An unexpected error occurred: {str(e)}")
\ No newline at end of file
+        logging.error(f"An unexpected error occurred: {str(e)}")
+        return
+
+    logging.info(f"Mined {summary['blocks']} blocks ({summary['blocks_per_minute']}/min) "
+                 f"with {summary['failures']} failures")
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from crypto_pool import SignatureVerifier
+import codec
+from crypto_utils import RSA_SCHEME, SCHEMES, generate_keys, sign_transaction, transaction_payload, verification_item, verify_signature
+from merkletree import MerkleTree
+from mining import CHECK_INTERVAL, block_work, create_engine, search_nonce
+
+SUITES = ['mining', 'validation', 'merkle', 'crypto', 'api']
+
+# (full, --quick) sizes for each suite
+SIZES = {
+    'hashes': (2 ** 21, 2 ** 18),
+    'solve_difficulty': (18, 14),
+    'solves': (20, 10),
+    'chain_lengths': ([10, 50, 100], [10, 20]),
+    'block_transactions': ([0, 10, 50], [0, 5]),
+    'merkle_leaves': ([16, 256, 4096, 65536], [16, 256, 4096]),
+    'signatures': (500, 50),
+    'api_requests': (1000, 100),
+}
+
+class CountdownEvent:
+    """Stop signal for search_nonce that reads as set after `checks` polls."""
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    def is_set(self):
+        self.checks -= 1
+        return self.checks < 0
+
+class TransactionPool:
+    """Signed transactions from one sender with increasing nonces, signed once and reused by every suite."""
+
+    def __init__(self, sender='bench', start_nonce=1, scheme=None):
+        self.sender = sender
+        self.start_nonce = start_nonce
+        self.scheme = scheme  # None signs untagged RSA transactions
+        self.private_key, self.public_key = generate_keys(scheme or RSA_SCHEME)
+        self.transactions = []
+
+    def take(self, count):
+        while len(self.transactions) < count:
+            transaction = {'sender': self.sender, 'receiver': 'bench-receiver', 'amount': 0.001,
+                           'nonce': self.start_nonce + len(self.transactions)}
+            if self.scheme is not None:
+                transaction['scheme'] = self.scheme
+            transaction['signature'] = sign_transaction(self.private_key, transaction_payload(transaction),
+                                                        self.scheme or RSA_SCHEME).hex()
+            transaction['public_key'] = self.public_key
+            self.transactions.append(transaction)
+        return self.transactions[:count]
+
+def timed(fn, repeat=3):
+    # Best of `repeat` runs; the minimum is the least disturbed by the rest of the machine.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def result(suite, name, params, **metrics):
+    return {'suite': suite, 'name': name, 'params': params,
+            'metrics': {key: round(value, 6) if isinstance(value, float) else value for key, value in metrics.items()}}
+
+def bench_mining(args, size):
+    results = []
+    hashes = size('hashes')
+    checks = hashes // CHECK_INTERVAL
+    seconds = timed(lambda: search_nonce(1, 256, stop_event=CountdownEvent(checks)), args.repeat)
+    results.append(result('mining', 'search_nonce', {'hashes': checks * CHECK_INTERVAL},
+                          seconds=seconds, hashes_per_second=checks * CHECK_INTERVAL / seconds))
+
+    # Whole solves through each engine. Solve times are random, so the rate is
+    # estimated from the expected work per solve.
+    difficulty, solves = size('solve_difficulty'), size('solves')
+    for name in ('single', 'parallel'):
+        engine = create_engine(name)
+        try:
+            rng = random.Random(args.seed)
+            start = time.perf_counter()
+            for _ in range(solves):
+                engine.search(rng.getrandbits(64), difficulty)
+            seconds = time.perf_counter() - start
+        finally:
+            engine.close()
+        results.append(result('mining', f'{name}_engine', {'difficulty': difficulty, 'solves': solves,
+                                                          'workers': engine.workers},
+                              seconds=seconds, solves_per_second=solves / seconds,
+                              estimated_hashes_per_second=solves * block_work(difficulty) / seconds))
+    return results
+
+def build_chain(blockchain, length, block_transactions, pool, difficulty=8):
+    # Blocks are spaced exactly target_time apart, so the retarget rule keeps
+    # the low genesis difficulty and building the chain costs almost no hashing.
+    start = datetime.datetime(2024, 1, 1)
+    retarget = blockchain.retarget
+    genesis = {'index': 1, 'timestamp': str(start), 'previous_hash': '0', 'transactions': [], 'merkleroot': '',
+               'difficulty': difficulty, 'uncles': [], 'miner': 'bench', 'nonce': 0, 'block_time': 0}
+    chain = [genesis]
+    transactions = pool.take((length - 1) * block_transactions)
+    for height in range(1, length):
+        block_txs = transactions[(height - 1) * block_transactions:height * block_transactions]
+        block = {
+            'index': height + 1,
+            'timestamp': str(start + datetime.timedelta(seconds=height * retarget.target_time)),
+            'previous_hash': blockchain.hash(chain[-1]),
+            'transactions': block_txs,
+            'merkleroot': MerkleTree(block_txs).get_root(),
+            'difficulty': retarget.next_difficulty(chain[retarget.window_start(height):]),
+            'uncles': [],
+            'miner': 'bench',
+            'block_time': retarget.target_time
+        }
+        block['nonce'] = search_nonce(chain[-1]['nonce'], block['difficulty'])
+        chain.append(block)
+    return chain
+
+def bench_validation(args, size, pool):
+    from blockchain import Blockchain
+
+    results = []
+    data_dir = tempfile.mkdtemp(prefix='bench-chain-')
+    blockchain = Blockchain(0, data_dir=data_dir)
+    try:
+        for block_transactions in size('block_transactions'):
+            for length in size('chain_lengths'):
+                chain = build_chain(blockchain, length, block_transactions, pool)
+
+                def validate():
+                    assert blockchain.is_chain_valid(chain, full=True), 'benchmark chain failed validation'
+
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    seconds = timed(validate, args.repeat)
+                results.append(result('validation', 'is_chain_valid',
+                                      {'length': length, 'block_transactions': block_transactions},
+                                      seconds=seconds, blocks_per_second=(length - 1) / seconds,
+                                      transactions_per_second=(length - 1) * block_transactions / seconds))
+    finally:
+        blockchain.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+def bench_merkle(args, size):
+    results = []
+    rng = random.Random(args.seed)
+    for leaves in size('merkle_leaves'):
+        transactions = [{'sender': f'sender-{i}', 'receiver': 'bench-receiver', 'amount': i, 'nonce': i,
+                         'signature': '00' * 256, 'public_key': 'bench'} for i in range(leaves)]
+        build_seconds = timed(lambda: MerkleTree(transactions), args.repeat)
+
+        tree = MerkleTree(transactions)
+        root = tree.get_root()
+        sample = [tree.hash_transaction(transactions[rng.randrange(leaves)]) for _ in range(200)]
+        proof_seconds = timed(lambda: [tree.get_proof_by_hash(tx_hash) for tx_hash in sample], args.repeat)
+        proofs = [tree.get_proof_by_hash(tx_hash) for tx_hash in sample]
+        verify_seconds = timed(lambda: [MerkleTree.verify_proof(tx_hash, proof, root)
+                                        for tx_hash, proof in zip(sample, proofs)], args.repeat)
+
+        results.append(result('merkle', 'merkle_tree', {'leaves': leaves},
+                              build_seconds=build_seconds, leaves_per_second=leaves / build_seconds,
+                              proof_microseconds=proof_seconds / len(sample) * 1e6,
+                              verify_microseconds=verify_seconds / len(sample) * 1e6))
+    return results
+
+def bench_crypto(args, size, pool):
+    count = size('signatures')
+    results = []
+    verifier = SignatureVerifier(min_parallel_batch=1)
+    try:
+        for scheme in SCHEMES:
+            scheme_pool = pool if scheme == RSA_SCHEME else TransactionPool(scheme=scheme)
+            transactions = scheme_pool.take(count)
+            items = [verification_item(tx) for tx in transactions]
+
+            # RSA signing is slow, so signing is measured on a smaller sample.
+            payloads = [payload for _, payload, _, _ in items[:50]]
+            seconds = timed(lambda: [sign_transaction(scheme_pool.private_key, payload, scheme)
+                                     for payload in payloads], 1)
+            results.append(result('crypto', 'sign_transaction', {'scheme': scheme, 'signatures': len(payloads)},
+                                  seconds=seconds, signatures_per_second=len(payloads) / seconds))
+
+            seconds = timed(lambda: [verify_signature(*item) for item in items], args.repeat)
+            results.append(result('crypto', 'verify_signature', {'scheme': scheme, 'signatures': count},
+                                  seconds=seconds, verifications_per_second=count / seconds))
+
+            verifier.verify_batch(items[:verifier.workers])  # start the pool outside the timing
+            seconds = timed(lambda: verifier.verify_batch(items), args.repeat)
+            results.append(result('crypto', 'verify_batch',
+                                  {'scheme': scheme, 'signatures': count, 'workers': verifier.workers},
+                                  seconds=seconds, verifications_per_second=count / seconds))
+
+            results.append(result('crypto', 'transaction_size', {'scheme': scheme},
+                                  json_bytes=len(json.dumps(transactions[0])),
+                                  binary_bytes=len(codec.encode_transactions(transactions)) / count))
+    finally:
+        verifier.close()
+    return results
+
+@contextlib.contextmanager
+def local_node(port):
+    # A real node process, so the server does not share the GIL with the load generator.
+    work_dir = tempfile.mkdtemp(prefix='bench-node-')
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    with open(os.path.join(work_dir, 'node.log'), 'w') as log:
+        process = subprocess.Popen([sys.executable, app_path, str(port)], cwd=work_dir, stdout=log,
+                                   stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(f'{url}/health', timeout=1).raise_for_status()
+                break
+            except requests.RequestException:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f'node on port {port} did not start, see {work_dir}/node.log')
+                time.sleep(0.2)
+        yield url
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def load_test(requests_count, concurrency, make_request):
+    """Run `requests_count` calls of make_request(session, i) over `concurrency` keep-alive sessions."""
+    local = threading.local()
+    latencies = deque()
+    errors = []
+
+    def call(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            make_request(session, i).raise_for_status()
+        except requests.RequestException as e:
+            errors.append(str(e))
+            return
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(requests_count)))
+    seconds = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000 if ordered else None
+
+    return {'seconds': seconds, 'requests_per_second': requests_count / seconds, 'errors': len(errors),
+            'latency_p50_ms': percentile(0.5), 'latency_p95_ms': percentile(0.95),
+            'latency_p99_ms': percentile(0.99)}
+
+def bench_api(args, size):
+    count = size('api_requests')
+    with contextlib.ExitStack() as stack:
+        url = args.url.rstrip('/') if args.url else stack.enter_context(local_node(args.port))
+        health = requests.get(f'{url}/health', timeout=10).json()
+        if not args.url:
+            requests.get(f'{url}/mine_block', timeout=120)  # the reward funds the transactions below
+
+        # Transactions are sent from the node's own address, which holds its
+        # mining rewards. Nonces start from the clock to stay above earlier runs.
+        transactions = TransactionPool(sender=health['node'], start_nonce=int(time.time())).take(count)
+
+        results = []
+        metrics = load_test(count, args.concurrency,
+                            lambda session, i: session.post(f'{url}/add_transaction', json=transactions[i],
+                                                            timeout=30))
+        results.append(result('api', 'add_transaction', {'requests': count, 'concurrency': args.concurrency},
+                              **metrics))
+
+        requests.get(f'{url}/mine_block', timeout=120)
+        length = requests.get(f'{url}/health', timeout=10).json()['length']
+        metrics = load_test(count, args.concurrency,
+                            lambda session, i: session.get(f'{url}/get_chain', timeout=30))
+        results.append(result('api', 'get_chain', {'requests': count, 'concurrency': args.concurrency,
+                                                   'chain_length': length}, **metrics))
+    return results
+
+def compare(current, baseline, threshold):
+    """Print metrics that moved by more than `threshold` and return the number of benchmarks that got worse."""
+    def key(record):
+        return record['suite'], record['name'], json.dumps(record['params'], sort_keys=True)
+
+    previous = {key(record): record for record in baseline['results']}
+    regressions = 0
+    for record in current['results']:
+        old = previous.get(key(record))
+        if old is None:
+            continue
+        regressed = False
+        for metric, value in record['metrics'].items():
+            old_value = old['metrics'].get(metric)
+            if not isinstance(value, (int, float)) or not old_value or metric == 'errors':
+                continue
+            higher_is_better = metric.endswith('per_second')
+            if not higher_is_better and not metric.endswith(('seconds', '_ms')):
+                continue
+            change = (value - old_value) / old_value
+            if abs(change) < threshold:
+                continue
+            worse = change < 0 if higher_is_better else change > 0
+            regressed = regressed or worse
+            label = 'REGRESSION' if worse else 'improved'
+            print(f"{label:>10}  {record['name']} {record['params']} {metric}: {old_value} -> {value} "
+                  f"({change:+.1%})")
+        regressions += regressed
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mining, validation, Merkle trees, signatures and the '
+                                                 'HTTP API, and report the results as JSON.')
+    parser.add_argument('suites', nargs='*', help=f'suites to run (default: all of {", ".join(SUITES)})')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a fast smoke run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--url', help='benchmark the API of this running node instead of starting one')
+    parser.add_argument('--port', type=int, default=5990, help='port for the node started by the api suite')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads for the api suite')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--compare', help='a previous JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported by --compare, and counted as a regression when worse')
+    args = parser.parse_args()
+
+    def size(name):
+        return SIZES[name][1 if args.quick else 0]
+
+    unknown = [suite for suite in args.suites if suite not in SUITES]
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(unknown)}")
+
+    suites = args.suites or SUITES
+    pool = TransactionPool()
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'quick': args.quick,
+            'repeat': args.repeat,
+            'suites': suites
+        },
+        'results': []
+    }
+    for suite in suites:
+        print(f"Running {suite} benchmarks...", file=sys.stderr)
+        if suite == 'mining':
+            report['results'] += bench_mining(args, size)
+        elif suite == 'validation':
+            report['results'] += bench_validation(args, size, pool)
+        elif suite == 'merkle':
+            report['results'] += bench_merkle(args, size)
+        elif suite == 'crypto':
+            report['results'] += bench_crypto(args, size, pool)
+        elif suite == 'api':
+            report['results'] += bench_api(args, size)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        print(f"{regressions} regressions beyond {args.threshold:.0%}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
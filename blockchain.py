@@ -1,30 +1,271 @@
-import datetime
+from collections import ChainMap, OrderedDict, deque, namedtuple
 import hashlib
 import json
+import os
 import requests
+import secrets
+import threading
 import time
 from urllib.parse import urlparse
 import logging
-from crypto_utils import verify_signature
+from blockstore import BlockStore
+from blocktree import BlockTree
+from chainwork import ChainWork
+from codec import CONTENT_TYPE, decode
+from crypto_pool import SignatureVerifier
+from gossip import Gossip
+from crypto_utils import key_address, verification_item
+from mempool import Mempool
+from retarget import Retarget, utc_now
+from snapshot import SnapshotError, make_snapshot, read_snapshot
+from state import AccountState, balance_changes, transaction_cost, valid_amount, valid_fee, valid_nonce
+from txindex import TransactionIndex
 from merkletree import MerkleTree
+from metrics import TRACER, Counter, Gauge, Histogram, traced
+from mining import AnyEvent, BackgroundMiner, block_work, check_proof, create_engine, difficulty_target
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+POW_HASHES = Counter('blockchain_pow_hashes_total', 'Proof-of-work hashes tried for mined blocks, estimated from '
+                                                    'the winning nonce; rate() of it is the hash rate')
+HASH_RATE = Gauge('blockchain_hash_rate', 'Hashes per second while mining the last block')
+BLOCKS_MINED = Counter('blockchain_blocks_mined_total', 'Blocks mined by this node', labels=('source',))
+BLOCK_TIME = Histogram('blockchain_block_time_seconds', 'Time spent finding the proof of work of a mined block',
+                       buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64))
+BLOCK_VALIDATION = Histogram('blockchain_block_validation_seconds', 'Time to validate one block',
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+VALIDATION_FAILURES = Counter('blockchain_block_validation_failures_total', 'Blocks that failed validation',
+                              labels=('reason',))
+RECEIVED_BLOCKS = Counter('blockchain_received_blocks_total', 'Blocks received from peers', labels=('status',))
+TRANSACTIONS = Counter('blockchain_transactions_total', 'Transactions offered to the mempool, by outcome',
+                       labels=('result',))
+CONSENSUS_ROUNDS = Histogram('blockchain_consensus_round_seconds', 'Duration of consensus rounds', labels=('result',),
+                             buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+CHAIN_LENGTH = Gauge('blockchain_chain_length', 'Blocks in the main chain')
+MEMPOOL_TRANSACTIONS = Gauge('blockchain_mempool_transactions', 'Pending transactions in the mempool')
+MEMPOOL_BYTES = Gauge('blockchain_mempool_bytes', 'Encoded size of the pending transactions')
+
+ChainSnapshot = namedtuple('ChainSnapshot', ['length', 'tip_hash'])
+
+PRUNED_SEGMENT_SIZE = 4 * 1024 * 1024  # small segments, so pruning can delete them sooner
+
+class CandidateChain:
+    """A peer's chain seen as our blocks below `fork_height` plus the blocks it downloaded."""
+
+    def __init__(self, base, fork_height, blocks, hashes):
+        self.base = base
+        self.fork_height = fork_height
+        self.blocks = blocks
+        self.hashes = hashes
+
+    def block_hash(self, height):
+        if height < 0:
+            height += len(self)
+        if height < self.fork_height:
+            return self.base.block_hash(height)
+        return self.hashes[height - self.fork_height]
+
+    def header(self, height):
+        # Downloaded blocks stand in for their own headers.
+        if height < self.fork_height:
+            return self.base.header(height)
+        return self.blocks[height - self.fork_height]
+
+    def __len__(self):
+        return self.fork_height + len(self.blocks)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[height] for height in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('block height out of range')
+        if item < self.fork_height:
+            return self.base[item]
+        return self.blocks[item - self.fork_height]
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
 class Blockchain:
-    def __init__(self, port):
-        self.chain = []
-        self.pending_transactions = []
-        self.difficulty = 20  # Initial difficulty
+    def __init__(self, port, data_dir=None, storage_format='json', wire_format='binary', prune=None,
+                 bootstrap_snapshot=None, snapshot_commitment=None, reward_address=None):
+        self.port = port
+        self.store = BlockStore(data_dir or os.path.join('chaindata', str(port)), record_format=storage_format,
+                                **({'segment_size': PRUNED_SEGMENT_SIZE} if prune else {}))
+        self.prune_keep = prune  # block bodies kept below the tip in pruned mode, None keeps them all
+        self.prune_batch = 100
+        self.wire_format = wire_format  # 'binary' asks peers for the binary codec when syncing and gossiping
+        self.mempool = Mempool()
+        self.max_block_transactions = 5000
         self.target_time = 2  # Target block time in seconds
+        self.retarget = Retarget(target_time=self.target_time)
         self.nodes = set()
-        self.nonces = {}
-        self.uncle_blocks = [] 
+        self.lock = threading.RLock()  # single writer lock for the chain, state and indexes
+        self.mining_lock = threading.Lock()
+        self.snapshot = ChainSnapshot(0, '')
+        self.state = AccountState(os.path.join(self.store.path, 'state.json'))
+        self.tx_index = TransactionIndex(os.path.join(self.store.path, 'txindex.sqlite'))
+        self.chainwork = ChainWork(os.path.join(self.store.path, 'chainwork.dat'))
+        self.block_tree = BlockTree()  # side branches, orphans and uncle candidates
+        self.validated_height = 0  # length of the chain prefix that has been fully validated
+        self.validated_hash = None
+        self.validated_accounts = ({}, {})  # balances and sender nonces at validated_height
+        self.audit_status = {'state': 'idle'}
         self.max_uncles = 2
-        self.transaction_pool = set()
+        self.verifier = SignatureVerifier()
+        self.mining_engine = create_engine('single')
+        self.mining_engines = {self.mining_engine.name: self.mining_engine}  # one engine per name
+        self.engine_lock = threading.Lock()
+        self.new_tip = threading.Event()  # set whenever the tip changes, cancels the search in progress
+        self.work_jobs = OrderedDict()  # /getwork job id -> (template, previous nonce, issued at)
+        self.max_work_jobs = 64
         self.load_nodes_from_file()  # Load nodes when initializing the blockchain
-        self.port = port
         self.node_address = self.get_node_address()
-        self.create_block(previous_hash='0', nonce=0, block_time=0, difficulty=self.difficulty)
+        self.reward_address = reward_address or self.node_address  # no key can spend from the node address
+        self.gossip = Gossip(self.node_address, lambda: self.nodes, binary=wire_format == 'binary')
+        self.http = requests.Session()
+        self.sync_timeout = 10
+        self.header_page_size = 2000
+        self.block_page_size = 100
+        if bootstrap_snapshot is not None:
+            if len(self.store) == 0:
+                self.import_snapshot(read_snapshot(bootstrap_snapshot, snapshot_commitment))
+            else:
+                logging.info(f"Chain already has {len(self.store)} blocks, not bootstrapping from {bootstrap_snapshot}")
+        self.state.load()
+        self.sync_state()
+        self.sync_tx_index()
+        self.sync_chainwork()
+        self.publish_snapshot()
+        self.background_miner = BackgroundMiner(self.mine_block)
+        CHAIN_LENGTH.set_function(lambda: self.snapshot.length)
+        MEMPOOL_TRANSACTIONS.set_function(lambda: len(self.mempool))
+        MEMPOOL_BYTES.set_function(lambda: self.mempool.size_bytes)
+        if len(self.store) == 0:
+            self.create_block(previous_hash='0', nonce=0, block_time=0, difficulty=self.retarget.initial_difficulty)
+        else:
+            logging.info(f"Reopened chain with {len(self.store)} blocks from {self.store.path}")
+
+    def sync_state(self):
+        # Replays the blocks after the state snapshot, or every block if the
+        # snapshot belongs to a different chain.
+        height = self.state.height
+        if height > len(self.store) or (height and self.state.tip_hash != self.store.block_hash(height - 1)):
+            logging.warning("Account state does not match the chain, rebuilding it")
+            self.state.reset()
+            height = 0
+        if height < self.store.pruned_height:
+            raise RuntimeError(f"Account state at height {height} needs pruned blocks, bootstrap from a snapshot again")
+        for height in range(height, len(self.store)):
+            self.state.apply_block(self.store[height], self.store.block_hash(height))
+
+    def sync_tx_index(self):
+        height = self.tx_index.height
+        if height > len(self.store) or (height and self.tx_index.tip_hash != self.store.block_hash(height - 1)):
+            logging.warning("Transaction index does not match the chain, rebuilding it")
+            self.tx_index.reset()
+            height = 0
+        if height < self.store.pruned_height:
+            # Transactions of pruned blocks are not indexed.
+            height = self.store.pruned_height
+            self.tx_index.rollback_to(height, self.store.block_hash(height - 1))
+        for height in range(height, len(self.store)):
+            self.tx_index.add_block(height, self.store[height], self.store.block_hash(height))
+
+    def sync_chainwork(self):
+        # Keeps the entries that still match the store and recomputes the rest.
+        height = min(len(self.chainwork), len(self.store))
+        while height and self.chainwork.block_hash(height - 1) != self.store.block_hash(height - 1):
+            height -= 1
+        self.chainwork.truncate(height)
+        for height in range(height, len(self.store)):
+            self.chainwork.append(self.store.block_hash(height), block_work(self.store.header(height)['difficulty']))
+
+    def total_work(self, length=None):
+        """Cumulative work of the first `length` main-chain blocks, by default the whole chain."""
+        return self.chainwork.total(len(self.chainwork) if length is None else length)
+
+    def append_block(self, block):
+        with self.lock:
+            height = len(self.store)
+            block_hash = self.store.append(block)
+            try:
+                self.state.apply_block(block, block_hash)
+                self.tx_index.add_block(height, block, block_hash)
+                self.chainwork.append(block_hash, block_work(block['difficulty']))
+            except Exception:
+                self.undo_append(height)
+                raise
+            self.block_tree.connected(block_hash, len(self.store) - 1, [self.hash(uncle) for uncle in block['uncles']])
+            self.publish_snapshot()
+            if self.prune_keep is not None:
+                self.prune_blocks()
+            return block_hash
+
+    def undo_append(self, height):
+        # Takes the store and every index back to `height` after appending the
+        # block there failed part way, so none of them is left a block ahead.
+        if self.state.height > height:
+            self.state.revert_block()
+        self.tx_index.rollback_to(height, self.store.block_hash(height - 1) if height else None)
+        self.chainwork.truncate(height)
+        self.store.truncate(height)
+
+    def prune_blocks(self):
+        # Bodies are dropped in batches, and never above the last saved account
+        # state, which a restart replays from.
+        with self.lock:
+            height = min(len(self.store) - self.prune_keep, self.state.saved_height)
+            if height - self.store.pruned_height >= self.prune_batch:
+                pruned = self.store.prune(height)
+                logging.info(f"Pruned {pruned} block bodies, headers kept below height {height}")
+
+    def rollback_to(self, height):
+        with self.lock:
+            try:
+                while self.state.height > height:
+                    self.state.revert_block()
+            except ValueError:
+                logging.warning(f"Reorg to height {height} is deeper than the undo log")
+            # Blocks leaving the main chain stay around as a side branch.
+            first_side = max(height, len(self.store) - self.block_tree.max_depth, self.store.pruned_height)
+            for side_height in range(first_side, len(self.store)):
+                block = self.store[side_height]
+                self.block_tree.disconnected(block, self.store.block_hash(side_height), side_height,
+                                             [self.hash(uncle) for uncle in block['uncles']])
+            self.store.truncate(height)
+            self.chainwork.truncate(height)
+            self.tx_index.rollback_to(height, self.store.block_hash(height - 1) if height else None)
+            self.sync_state()
+            if self.state.saved_height > self.state.height:
+                self.state.save()  # the saved state is past the fork and could not be replayed on restart
+            self.publish_snapshot()
+
+    def publish_snapshot(self):
+        # Readers take this immutable view instead of the lock; blocks below
+        # `length` are only rewritten by a reorg.
+        length = len(self.store)
+        self.snapshot = ChainSnapshot(length, self.store.block_hash(length - 1) if length else '')
+        self.new_tip.set()
+
+    def close(self):
+        for engine in self.mining_engines.values():
+            engine.close()
+        self.store.close()
+        self.state.save()
+        self.tx_index.close()
+        self.chainwork.close()
+
+    @property
+    def chain(self):
+        return self.store
+
+    @property
+    def pending_transactions(self):
+        return self.mempool.select()
 
     def load_nodes_from_file(self):
         try:
@@ -56,98 +297,202 @@ class Blockchain:
         except Exception as e:
             logging.error(f"Failed to add node {address}: {str(e)}")
 
-    def mine_block(self):
-        previous_block = self.get_previous_block()
-        nonce, block_time, difficulty = self.proof_of_work(previous_block['nonce'])
-        previous_hash = self.hash(previous_block)
-        
-        block = self.create_block(previous_hash, nonce, block_time, difficulty)
-        print('Block %d mined' % block['index'])
-        
-        # Update nonces after mining the block
-        for transaction in block['transactions']:
-            sender = transaction['sender']
-            self.nonces[sender] = transaction['nonce']
-        
+    def get_mining_engine(self, name=None, workers=None):
+        # Asking for another worker count resizes the engine in place, so a
+        # background miner that holds it keeps working.
+        if name is None:
+            return self.mining_engine
+        with self.engine_lock:
+            engine = self.mining_engines.get(name)
+            if engine is None:
+                engine = self.mining_engines[name] = create_engine(name, workers)
+            elif workers is not None and workers != engine.workers:
+                engine.resize(workers)
+            return engine
+
+    @traced('mine_block')
+    def mine_block(self, engine=None, stop_event=None):
+        # Proof of work runs without the chain lock. Any new tip, ours or a
+        # peer's, cancels the search and we start over on a fresh template.
+        engine = engine or self.mining_engine
+        with self.mining_lock:
+            while True:
+                with self.lock:
+                    template, previous_nonce = self.create_block_template()
+                    self.new_tip.clear()
+                start_time = time.time()
+                with TRACER.span('search', difficulty=template['difficulty']):
+                    nonce = engine.search(previous_nonce, template['difficulty'], AnyEvent(self.new_tip, stop_event))
+                if nonce is None:
+                    if stop_event is not None and stop_event.is_set():
+                        return None
+                    logging.info("Chain tip moved while mining, restarting on the new tip")
+                    continue
+                block = self.complete_block(template, nonce, time.time() - start_time)
+                if block is not None:
+                    break
+
+        # Every engine has tried about nonce + 1 hashes when it finds one;
+        # searches cancelled by a new tip are not counted.
+        block_time = block['block_time']
+        POW_HASHES.inc(nonce + 1)
+        BLOCKS_MINED.inc(source='local')
+        BLOCK_TIME.observe(block_time)
+        if block_time > 0:
+            HASH_RATE.set((nonce + 1) / block_time)
+        logging.info(f"Block {block['index']} mined in {block_time:.2f}s")
+
         self.broadcast_block(block)  # Broadcast the newly mined block to other nodes
 
         return block
     
     def broadcast_block(self, block):
-        current_node = self.get_node_address()
-        print("Current node ", current_node)
+        self.gossip.publish_block(block)  # queued, delivered in the background
 
-        for node in self.nodes:
-            print(f"Broadcasting block to {node}")
-            if node == current_node:
-                continue
-            try:
-                response = requests.post(f'http://{node}/receive_block', json=block)
-                if response.status_code == 200:
-                    print(f"Block successfully broadcast to {node}")
-                else:
-                    print(f"Failed to broadcast block to {node}: {response.text}")
-            except requests.RequestException as e:
-                print(f"Failed to broadcast block to {node}: {str(e)}")
+    def create_block_template(self, miner=None):
+        """Return a block on the current tip lacking only its proof of work, and the nonce it must extend."""
+        with self.lock:
+            previous_block = self.get_previous_block()
+            difficulty = self.next_difficulty(self.store)
+            return self.block_template(self.store.block_hash(-1), difficulty, miner), previous_block['nonce']
 
-    def create_block(self, previous_hash, nonce, block_time, difficulty):
-        merkletree = MerkleTree(self.pending_transactions)
-        block = {
+    def block_template(self, previous_hash, difficulty, miner=None):
+        merkletree = self.template_tree()
+        return {
             'index': len(self.chain) + 1,
-            'timestamp': str(datetime.datetime.now()),
+            'timestamp': str(utc_now()),
             'previous_hash': previous_hash,
-            'transactions': self.pending_transactions,
+            'transactions': merkletree.transactions,
             'merkleroot': merkletree.get_root(),
             'difficulty': difficulty,
-            'nonce': nonce,
-            'block_time': block_time,
-            'uncles': self.get_valid_uncles()
+            'uncles': self.get_valid_uncles(),
+            'miner': miner or self.reward_address
         }
 
-        self.pending_transactions = [] # clear pending transactions
-        self.chain.append(block) # append block to chain
-        self.uncle_blocks = [uncle for uncle in self.uncle_blocks if uncle not in block['uncles']]
+    def template_tree(self):
+        # Pending transactions were checked when they arrived; blocks since
+        # then may have spent the same funds, so each one is checked again on
+        # top of the current state and the transactions taken before it. The
+        # tree grows one leaf at a time as transactions pass.
+        balances, nonces = ChainMap({}, self.state.balances), ChainMap({}, self.state.nonces)
+        merkletree = MerkleTree([])
+        for transaction in self.mempool.select(self.max_block_transactions):
+            sender = transaction['sender']
+            if nonces.get(sender) is not None and transaction['nonce'] <= nonces[sender]:
+                continue
+            try:
+                balances.update(balance_changes(balances, {'transactions': [transaction]}, 0))
+            except ValueError:
+                continue
+            nonces[sender] = transaction['nonce']
+            merkletree.append(transaction)
+        return merkletree
+
+    def create_block(self, previous_hash, nonce, block_time, difficulty):
+        block = self.block_template(previous_hash, difficulty)
+        block.update(nonce=nonce, block_time=block_time)
+        return self.append_mined_block(block)
+
+    def complete_block(self, template, nonce, block_time):
+        # Returns None if the chain moved on since the template was built.
+        with self.lock:
+            if self.store.block_hash(-1) != template['previous_hash']:
+                return None
+            block = self.append_mined_block(dict(template, nonce=nonce, block_time=block_time))
         return block
-    
-    def get_previous_block(self):
-        return self.chain[-1] if self.chain else None
 
-    def get_valid_uncles(self):
-        valid_uncles = []
-        for uncle in self.uncle_blocks:
-            if len(valid_uncles) >= self.max_uncles:
-                break
-            if self.is_valid_uncle(uncle):
-                valid_uncles.append(uncle)
-        return valid_uncles
+    def append_mined_block(self, block):
+        with self.lock:
+            self.append_block(block) # append block to chain
+            self.sync_transaction_pool([block])
+        return block
 
-    def is_valid_uncle(self, uncle):
-        if len(self.chain) < 7:
-            return False
-        uncle_index = uncle['index']
-        current_index = len(self.chain)
-        return current_index - 7 <= uncle_index < current_index
+    def get_work(self, miner=None):
+        """Hand out a template for an external miner to solve."""
+        template, previous_nonce = self.create_block_template(miner)
+        job_id = secrets.token_hex(8)
+        with self.lock:
+            for stale_id in [key for key, job in self.work_jobs.items() if job[0]['previous_hash'] != template['previous_hash']]:
+                del self.work_jobs[stale_id]
+            self.work_jobs[job_id] = (template, previous_nonce, time.time())
+            while len(self.work_jobs) > self.max_work_jobs:
+                self.work_jobs.popitem(last=False)
+        return {
+            'job_id': job_id,
+            'previous_nonce': previous_nonce,
+            'difficulty': template['difficulty'],
+            'target': difficulty_target(template['difficulty']).hex(),
+            'template': template
+        }
 
-    def proof_of_work(self, previous_nonce):
-        start_time = time.time()
-        nonce = 0
-        check_proof = False
+    def submit_work(self, job_id, nonce):
+        """Return (block, error) for a nonce found for a /getwork job."""
+        job = self.work_jobs.get(job_id)
+        if job is None:
+            return None, 'unknown job'
+        template, previous_nonce, created = job
+        if template['previous_hash'] != self.snapshot.tip_hash:
+            return None, 'stale job'
+        if not check_proof(previous_nonce, nonce, template['difficulty']):
+            return None, 'invalid proof of work'
 
-        while not check_proof:
-            hash_operation = self.calculate_hash(previous_nonce, nonce)
-            if int(hash_operation, 16) < 2**(256 - self.difficulty):
-                check_proof = True
+        block = self.complete_block(template, nonce, time.time() - created)
+        if block is None:
+            return None, 'stale job'
+        self.work_jobs.pop(job_id, None)
+        BLOCKS_MINED.inc(source='getwork')
+        logging.info(f"Block {block['index']} submitted")
+        self.broadcast_block(block)
+        return block, None
+    
+    def get_previous_block(self):
+        # Only header fields are used, and the tip's body may be pruned right after a bootstrap.
+        return self.store.header(-1) if len(self.store) else None
+
+    def find_fork_height(self, chain):
+        # Returns how many leading blocks `chain` shares with ours. Blocks are
+        # linked by hash, so if block i matches, every block before it does too.
+        low, high = 0, min(len(self.store), len(chain))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.store.block_hash(mid - 1) == self.chain_block_hash(chain, mid - 1):
+                low = mid
             else:
-                nonce += 1
+                high = mid - 1
+        return low
+
+    def switch_chain(self, chain, accounts=None):
+        with self.lock:
+            fork_height = self.find_fork_height(chain)
+            self.rollback_to(fork_height)
+            for block in chain[fork_height:]:
+                self.append_block(block)
 
-        end_time = time.time()
-        block_time = end_time - start_time
-        print('Block time: ', block_time)
+            if accounts is not None:
+                self.set_checkpoint(chain, accounts, len(chain))
+            elif fork_height < self.validated_height:
+                self.validated_height = 0
+            return fork_height
 
-        current_difficulty = self.difficulty # save current
-        self.adjust_difficulty(block_time)
+    def start_audit(self):
+        if self.audit_status['state'] == 'running':
+            return self.audit_status
+        self.audit_status = {'state': 'running', 'height': len(self.chain), 'started': time.time()}
+        threading.Thread(target=self.run_audit, args=(self.audit_status['height'],), daemon=True).start()
+        return self.audit_status
 
-        return nonce, block_time, current_difficulty
+    def run_audit(self, height):
+        valid, _ = self.validate_chain(self.chain, full=True, end=height)
+        self.audit_status = dict(self.audit_status, state='passed' if valid else 'failed', finished=time.time())
+        logging.info(f"Background audit of {height} blocks {self.audit_status['state']}")
+
+    def get_valid_uncles(self):
+        # Unused side blocks with an index among the last seven, i.e. heights
+        # current_index - 8 to current_index - 2; only those heights are looked at.
+        current_index = len(self.chain)
+        if current_index < 7:
+            return []
+        return self.block_tree.uncle_candidates(current_index - 8, current_index - 1, self.max_uncles)
 
     def calculate_hash(self, previous_nonce, nonce):
         hash_str = f"{previous_nonce}{nonce}".encode()
@@ -157,164 +502,576 @@ class Blockchain:
         """Perform double SHA-256 hash."""
         return hashlib.sha256(hashlib.sha256(data).digest()).hexdigest()
 
-    def adjust_difficulty(self, block_time):
-        if block_time < self.target_time * 0.8:
-            self.difficulty += 1
-        elif block_time > self.target_time * 1.2 and self.difficulty > 1:
-            self.difficulty -= 1
-        
-        # Ensure difficulty doesn't drop too low
-        self.difficulty = max(self.difficulty, 1)
-        
-        print(f"Adjusted difficulty to {self.difficulty}")
+    def next_difficulty(self, chain, height=None):
+        # Difficulty required of the block at `height`, from the blocks before it.
+        height = len(chain) if height is None else height
+        return self.retarget.next_difficulty([self.chain_header(chain, h)
+                                              for h in range(self.retarget.window_start(height), height)])
 
     def hash(self, block):
         encoded_block = json.dumps(block, sort_keys=True).encode()
         return self.sha256d(encoded_block)
+
+    def chain_block_hash(self, chain, height):
+        # Stored and downloaded blocks carry the hash computed when their
+        # canonical form was first produced; anything else is hashed here.
+        block_hash = getattr(chain, 'block_hash', None)
+        if block_hash is not None:
+            return block_hash(height)
+        return self.hash(chain[height])
+
+    def chain_header(self, chain, height):
+        # Stores and candidate chains can answer with a header even for pruned
+        # heights; a plain list of blocks answers with the block.
+        header = getattr(chain, 'header', None)
+        if header is not None:
+            return header(height)
+        return chain[height]
     
     def get_node_address(self):
         return f"127.0.0.1:{self.port}"
 
-    def add_transaction(self, sender, receiver, amount, signature, public_key, nonce=0):
+    def add_transaction(self, sender, receiver, amount, signature, public_key, nonce=0, scheme=None, fee=None):
         transaction = {
             'sender': sender,
             'receiver': receiver,
             'amount': amount,
-            'nonce': nonce
+            'nonce': nonce,
+            'signature': signature,
+            'public_key': public_key
         }
+        if scheme is not None:
+            transaction['scheme'] = scheme
+        if fee is not None:
+            transaction['fee'] = fee
+        return self.add_transactions([transaction])[0]
 
-        transaction_data = json.dumps(transaction, sort_keys=True).encode()
+    def add_transactions(self, transactions, broadcast=True, reasons=False):
+        # Verifies every signature in one batch, then admits transactions in
+        # order. Returns the target block index, or False, for each transaction;
+        # with `reasons`, (index or False, reason) pairs instead.
+        items = [verification_item(tx) for tx in transactions]
 
-        if verify_signature(public_key, transaction_data, signature):
-            if self.is_valid_nonce(sender, nonce):
-                transaction['signature'] = signature
-                transaction['public_key'] = public_key
+        verified_flags = self.verifier.verify_batch(items)
+        with self.lock:
+            results = self.admit_transactions(transactions, verified_flags)
+        if broadcast:
+            # Accepted transactions go to peers together, as one gossip batch.
+            self.broadcast_transactions([tx for tx, (index, _) in zip(transactions, results) if index is not False])
+        return results if reasons else [index for index, _ in results]
 
-                self.pending_transactions.append(transaction)
-                transaction_str = json.dumps(transaction, sort_keys=True)
-                self.transaction_pool.add(transaction_str)
-                self.nonces[sender] = nonce # update the nonce for the sender
-                previous_block = self.get_previous_block()
+    def admit_transactions(self, transactions, verified_flags):
+        results = []
+        for transaction, verified in zip(transactions, verified_flags):
+            reason = self.transaction_error(transaction, verified)
+            if reason is None:
+                accepted, reason = self.mempool.add(transaction)
+                if accepted:
+                    TRANSACTIONS.inc(result='accepted')
+                    previous_block = self.get_previous_block()
+                    results.append((previous_block['index'] + 1, reason)) # index of the block it will land in
+                    continue
+            TRANSACTIONS.inc(result=reason)
+            logging.debug(f"Transaction rejected: {reason}")
+            results.append((False, reason))
+        return results
 
-                self.broadcast_transaction(transaction)  # Broadcast the transaction to other nodes
+    def transaction_error(self, transaction, verified):
+        if not verified:
+            return 'invalid signature'
+        if transaction['sender'] != key_address(transaction['public_key']):
+            return 'sender does not match key'
+        amount = transaction['amount']
+        if not valid_amount(amount):
+            return 'invalid amount'
+        if not valid_fee(transaction.get('fee', 0)):
+            return 'invalid fee'
+        if not self.is_valid_nonce(transaction['sender'], transaction['nonce']):
+            return 'invalid nonce'
+        if self.available_balance(transaction['sender']) < transaction_cost(transaction):
+            return 'insufficient balance'
+        return None
 
-                return previous_block['index'] + 1 # return index of block
-            else:
-                print('Invalid nonce')
-                return False
-        else:
-            print('Signature verification failed')
-            return False 
+    def get_transaction_proof(self, txid):
+        bytes.fromhex(txid)  # a malformed id raises ValueError
+        if txid in self.mempool:
+            # A pending transaction is proven against the transactions the next
+            # block template would take, which change as the mempool does. One
+            # that would not make it into that block has no proof yet.
+            with self.lock:
+                tree = self.template_tree()
+            proof = tree.get_proof_by_hash(txid)
+            return {'txid': txid, 'status': 'pending', 'block_index': None,
+                    'merkle_root': None if proof is None else tree.get_root(), 'proof': proof}
+
+        location = self.tx_index.lookup(txid)
+        if location is None:
+            return None
+        block = self.chain[location[0]]
+        proof = MerkleTree(block['transactions']).get_proof_by_hash(txid)
+        return {'txid': txid, 'status': 'confirmed', 'block_index': block['index'], 'merkle_root': block['merkleroot'],
+                'proof': proof}
+
+    def get_transaction(self, txid):
+        location = self.tx_index.lookup(txid)
+        if location is None:
+            pending = self.mempool.get(txid)
+            return None if pending is None else {'txid': txid, 'status': 'pending', 'transaction': pending}
+
+        height, position = location
+        return {
+            'txid': txid,
+            'status': 'confirmed',
+            'height': height,
+            'position': position,
+            'block_hash': self.store.block_hash(height),
+            'confirmations': len(self.store) - height,
+            'transaction': self.chain[height]['transactions'][position]
+        }
 
     def is_valid_nonce(self, sender, nonce):
-        if sender not in self.nonces:
-            return True # first transaction
-        return nonce > self.nonces[sender]
+        # Pending transactions may reuse a pending nonce; the mempool then
+        # decides whether the newer one replaces it.
+        if not valid_nonce(nonce):
+            return False
+        confirmed_nonce = self.state.nonce(sender)
+        if confirmed_nonce is None:
+            return True # first confirmed transaction
+        return nonce > confirmed_nonce
 
-    def broadcast_transaction(self, transaction):
-        for node in self.nodes:
-            try:
-                requests.post(f'http://{node}/receive_transaction', json=transaction)
-            except requests.RequestException as e:
-                print(f"Failed to broadcast transaction to {node}: {str(e)}")
+    def available_balance(self, address):
+        return self.state.balance(address) - self.mempool.pending_spend(address)
+
+    def get_account(self, address):
+        return {
+            'address': address,
+            'balance': self.state.balance(address),
+            'available_balance': self.available_balance(address),
+            'nonce': self.state.nonce(address),
+            'pending_nonce': self.mempool.pending_nonce(address),
+            'height': self.state.height
+        }
+
+    def broadcast_transactions(self, transactions):
+        if transactions:
+            self.gossip.publish_transactions(transactions)  # batched with other transactions
 
     def add_node(self, address):
         parsed_url = urlparse(address)
         self.nodes.add(parsed_url.netloc)
 
-    def is_chain_valid(self, chain):
-        previous_block = chain[0]
-        block_index = 1
-        address_nonces = {}
+    def is_chain_valid(self, chain, full=False):
+        end = len(chain)
+        tip_hash = self.chain_block_hash(chain, end - 1)
+        valid, accounts = self.validate_chain(chain, full, end)
+        if valid and chain is self.chain:
+            with self.lock:
+                # Only checkpoint if no reorg replaced the blocks we just validated.
+                if self.snapshot_hash_at(end) == tip_hash:
+                    self.set_checkpoint(chain, accounts, end)
+        return valid
+
+    def snapshot_hash_at(self, length):
+        return self.store.block_hash(length - 1) if length <= len(self.store) else None
+
+    def validate_chain(self, chain, full=False, end=None):
+        # Returns (valid, (balances, sender nonces) at the tip). Unless `full`
+        # is set, blocks covered by the validated checkpoint are trusted and skipped.
+        end = len(chain) if end is None else end
+        if full and self.store.pruned_height and chain is self.chain:
+            start, accounts = self.pruned_base()
+        elif full:
+            start, accounts = 1, self.replay_accounts(chain[:1])
+        else:
+            start, accounts = self.validated_prefix(chain)
+        if accounts is None:
+            logging.warning(f"Chain forks at height {start}, below what this pruned node can revert")
+            return False, None
+        if start < 1:
+            # Nothing is shared, not even the genesis block, whose reward the
+            # accounts must still include.
+            start, accounts = 1, self.replay_accounts(chain[:1])
+        return self.validate_blocks(chain, start, end, accounts), accounts
+
+    def pruned_base(self):
+        # Validation of our own pruned chain starts at the first block with a
+        # body whose accounts the undo log can still rebuild; the blocks below
+        # were validated before, or came with a snapshot.
+        with self.lock:
+            height = max(self.store.pruned_height, self.state.height - len(self.state.undo))
+            return height, (self.state.balances_at(height), self.state.nonces_at(height))
+
+    def replay_accounts(self, blocks):
+        # Balances and sender nonces after `blocks`, which must already be validated.
+        balances, address_nonces = {}, {}
+        for block in blocks:
+            balances.update(balance_changes(balances, block, self.state.mining_reward))
+            for transaction in block['transactions']:
+                address_nonces[transaction['sender']] = transaction['nonce']
+        return balances, address_nonces
+
+    def validated_prefix(self, chain):
+        if chain is not self.chain:
+            # Our main chain was validated as it was built, so a candidate only
+            # needs checking from the fork point, with the sender nonces there
+            # rolled back from the account state.
+            with self.lock:
+                fork_height = self.find_fork_height(chain)
+                if self.state.height == len(self.store):
+                    balances = self.state.balances_at(fork_height)
+                    if balances is not None:
+                        return fork_height, (balances, self.state.nonces_at(fork_height))
+
+        height = self.validated_height
+        if height and len(chain) >= height and self.chain_block_hash(chain, height - 1) == self.validated_hash:
+            balances, address_nonces = self.validated_accounts
+            return height, (dict(balances), dict(address_nonces))
+
+        # The candidate forked below the checkpoint: trust only the part it
+        # shares with our validated chain and rebuild the accounts from it.
+        fork_height = min(self.find_fork_height(chain), height)
+        if self.store.pruned_height:
+            # The bodies to rebuild from are gone: a candidate that got here
+            # forked deeper than the undo log, and our own chain restarts at
+            # its first unpruned block.
+            return (fork_height, None) if chain is not self.chain else self.pruned_base()
+        return fork_height, self.replay_accounts(chain[:fork_height])
+
+    def set_checkpoint(self, chain, accounts, height):
+        self.validated_height = height
+        self.validated_hash = self.chain_block_hash(chain, height - 1)
+        self.validated_accounts = tuple(dict(values) for values in accounts)
+
+    def validate_blocks(self, chain, start, end, accounts):
+        # `accounts` holds the balances and sender nonces before block `start`
+        # and is updated in place, so callers pass a copy of the live state.
+        balances, address_nonces = accounts
+        block_index = start
+        previous_block = self.chain_header(chain, block_index - 1) if block_index < end else None
+        heights = range(self.retarget.window_start(start), start)
+        window = deque((self.chain_header(chain, height) for height in heights), maxlen=self.retarget.window + 1)
 
-        while block_index < len(chain):
+        while block_index < end:
+            started = time.perf_counter()
             block = chain[block_index]
-            calculated_previous_hash = self.hash(previous_block)
-            print(f'Verifying block {block_index}')
+            calculated_previous_hash = self.chain_block_hash(chain, block_index - 1)
 
             if block['previous_hash'] != calculated_previous_hash:
-                print('Previous hash does not match')
-                return False
+                return self.invalid_block(block_index, 'previous hash')
 
-            previous_nonce = previous_block['nonce']
-            nonce = block['nonce']
-            hash_operation = self.calculate_hash(previous_nonce, nonce)
+            if not self.retarget.valid_timestamp(window, block.get('timestamp')):
+                return self.invalid_block(block_index, 'timestamp')
 
-            if int(hash_operation, 16) >= 2**(256 - block['difficulty']):
-                print(f'Proof of work failed for block {block_index}')
-                return False
+            if not check_proof(previous_block['nonce'], block['nonce'], block['difficulty']):
+                return self.invalid_block(block_index, 'proof of work')
+
+            if block['difficulty'] != self.retarget.next_difficulty(window):
+                return self.invalid_block(block_index, 'difficulty')
 
             merkle_tree = MerkleTree(block['transactions'])
             if block['merkleroot'] != merkle_tree.get_root():
-                print(f'Merkle root is invalid for block {block_index}')
-                return False
+                return self.invalid_block(block_index, 'merkle root')
 
-            for transaction in block['transactions']:
-                transaction_data = json.dumps({
-                    'sender': transaction['sender'],
-                    'receiver': transaction['receiver'],
-                    'amount': transaction['amount'],
-                    'nonce': transaction['nonce']
-                }, sort_keys=True).encode()
-
-                if not self.verify_signature(transaction['public_key'], transaction_data, transaction['signature']):
-                    print('Invalid transaction signature')
-                    return False
+            items = [verification_item(tx) for tx in block['transactions']]
+            if not all(self.verifier.verify_batch(items)):
+                return self.invalid_block(block_index, 'signature')
 
+            if any(tx['sender'] != key_address(tx['public_key']) for tx in block['transactions']):
+                return self.invalid_block(block_index, 'sender')
+
+            for transaction in block['transactions']:
+                if not valid_nonce(transaction['nonce']):
+                    return self.invalid_block(block_index, 'nonce')
                 if transaction['sender'] not in address_nonces:
                     address_nonces[transaction['sender']] = transaction['nonce']
                 elif transaction['nonce'] <= address_nonces[transaction['sender']]:
-                    print('Invalid nonce')
-                    return False
+                    return self.invalid_block(block_index, 'nonce')
                 else:
                     address_nonces[transaction['sender']] = transaction['nonce']
 
+            try:
+                balances.update(balance_changes(balances, block, self.state.mining_reward))
+            except ValueError as e:
+                return self.invalid_block(block_index, str(e))
+
+            BLOCK_VALIDATION.observe(time.perf_counter() - started)
             previous_block = block
+            window.append(block)
             block_index += 1
 
         return True
 
+    def invalid_block(self, height, reason):
+        VALIDATION_FAILURES.inc(reason=reason)
+        logging.warning(f"Block {height} is invalid: {reason}")
+        return False
+
+    def get_headers(self, start, count):
+        heights = range(start, min(start + count, self.snapshot.length))
+        return [self.store.header(height) for height in heights]
+
+    def get_blocks(self, start, count):
+        return self.chain[start:min(start + count, self.snapshot.length)]
+
+    def block_locator(self):
+        # Heights of the last ten blocks, then exponentially sparser back to genesis.
+        locator = []
+        height, step = len(self.chain) - 1, 1
+        while height > 0:
+            locator.append([height, self.store.block_hash(height)])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        if len(self.chain):
+            locator.append([0, self.store.block_hash(0)])
+        return locator
+
+    def locate_fork(self, locator):
+        """Return how many leading blocks we share with the chain that sent `locator`."""
+        for _, block_hash in locator:
+            height = self.store.height_of(block_hash)
+            if height is not None:
+                return height + 1
+        return 0
+
+    @property
+    def sync_accept(self):
+        # Peers without the codec ignore it and answer in JSON.
+        if self.wire_format == 'binary':
+            return {'Accept': f'{CONTENT_TYPE}, application/json;q=0.9'}
+        return {'Accept': 'application/json'}
+
+    def fetch_range(self, node, path, key, start, stop, page_size):
+        items = []
+        while start + len(items) < stop:
+            count = min(page_size, stop - start - len(items))
+            response = self.http.get(f'http://{node}/{path}', params={'from': start + len(items), 'count': count},
+                                     headers=self.sync_accept, timeout=self.sync_timeout)
+            response.raise_for_status()
+            if response.headers.get('Content-Type', '').startswith(CONTENT_TYPE):
+                page = decode(response.content)[key]
+            else:
+                page = response.json()[key]
+            if not page:
+                break
+            items.extend(page)
+        return items
+
+    def headers_connect(self, fork_height, headers):
+        previous = self.store.header(fork_height - 1) if fork_height else None
+        previous_hash = self.store.block_hash(fork_height - 1) if previous else None
+        heights = range(self.retarget.window_start(fork_height), fork_height)
+        window = deque((self.store.header(height) for height in heights), maxlen=self.retarget.window + 1)
+        for header in headers:
+            if previous is not None:
+                if header['previous_hash'] != previous_hash:
+                    return False
+                if not check_proof(previous['nonce'], header['nonce'], header['difficulty']):
+                    return False
+                if header['difficulty'] != self.retarget.next_difficulty(window):
+                    return False
+                if not self.retarget.valid_timestamp(window, header.get('timestamp')):
+                    return False
+            window.append(header)
+            previous, previous_hash = header, header['hash']
+        return True
+
+    def sync_headers(self, node):
+        """Ask `node` where our chains fork and fetch only the headers past that point."""
+        response = self.http.post(f'http://{node}/locate', json={'locator': self.block_locator()},
+                                  timeout=self.sync_timeout)
+        response.raise_for_status()
+        located = response.json()
+        fork_height, length = located['fork_height'], located['length']
+
+        headers = []
+        if length > fork_height:
+            headers = self.fetch_range(node, 'headers', 'headers', fork_height, length, self.header_page_size)
+            if len(headers) != length - fork_height or not self.headers_connect(fork_height, headers):
+                logging.warning(f"Headers from {node} do not connect to our chain")
+                return None
+        return fork_height, length, headers
+
+    def headers_work(self, fork_height, headers):
+        # Total work of our chain up to the fork plus the work the headers claim;
+        # headers_connect has already checked their proof of work and difficulty.
+        return self.total_work(fork_height) + sum(block_work(header['difficulty']) for header in headers)
+
+    def download_chain(self, node, fork_height, headers):
+        blocks = self.fetch_range(node, 'blocks', 'blocks', fork_height, fork_height + len(headers),
+                                  self.block_page_size)
+        hashes = [self.hash(block) for block in blocks]
+        if hashes != [header['hash'] for header in headers]:
+            logging.warning(f"Blocks from {node} do not match their headers")
+            return None
+        return CandidateChain(self.store, fork_height, blocks, hashes)
+
+    def collect_uncles(self, node, fork_height, length):
+        # Only blocks from the peer's side branch inside the uncle window are fetched.
+        current_index = len(self.chain)
+        start = max(fork_height, current_index - 8)
+        stop = min(length, current_index)
+        if start >= stop:
+            return
+        blocks = self.fetch_range(node, 'blocks', 'blocks', start, stop, self.block_page_size)
+        with self.lock:
+            for height, block in enumerate(blocks, start):
+                block_hash = self.hash(block)
+                if self.store.height_of(block_hash) is None:
+                    self.block_tree.add(block, block_hash, height)
+
+    @traced('apply_consensus')
     def apply_consensus(self):
+        started = time.perf_counter()
         network = self.nodes
-        longest_chain = None
-        max_length = len(self.chain)
+        candidates = []
         consensus_applied = False
 
         for node in network:
+            if node == self.node_address:
+                continue
+            try:
+                with TRACER.span('sync_headers', node=node):
+                    synced = self.sync_headers(node)
+                if synced is None:
+                    continue
+                fork_height, length, headers = synced
+                work = self.headers_work(fork_height, headers)
+                if work > self.total_work():
+                    candidates.append((work, node, fork_height, headers))
+                elif fork_height < len(self.chain):
+                    self.collect_uncles(node, fork_height, length)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logging.warning(f"Failed to sync headers from {node}: {str(e)}")
+
+        # Candidates are ranked by the work their headers claim. Only the best
+        # one is downloaded and validated past the fork point; the next is
+        # tried only if it turns out to be invalid.
+        for work, node, fork_height, headers in sorted(candidates, key=lambda c: c[0], reverse=True):
             try:
-                response = requests.get(f'http://{node}/get_chain')
-                if response.status_code == 200:
-                    length = response.json()['length']
-                    chain = response.json()['chain']
-
-                    if length > max_length and self.is_chain_valid(chain):
-                        max_length = length
-                        longest_chain = chain
-            except requests.RequestException as e:
-                print(f"Failed to get chain from {node}: {str(e)}")
-
-        if longest_chain:
-            self.chain = longest_chain
-            self.sync_transaction_pool()  # Sync transaction pool after updating chain
+                with TRACER.span('download_chain', node=node, blocks=len(headers)):
+                    candidate = self.download_chain(node, fork_height, headers)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logging.warning(f"Failed to download blocks from {node}: {str(e)}")
+                continue
+            if candidate is None:
+                continue
+
+            valid, accounts = self.validate_chain(candidate)
+            if not valid:
+                continue
+
+            with self.lock:
+                # The candidate was validated without the lock; make sure our
+                # chain still contains its fork point and still has less work.
+                fork_hash = candidate.block_hash(fork_height - 1) if fork_height else None
+                if work <= self.total_work() or (fork_height and self.snapshot_hash_at(fork_height) != fork_hash):
+                    continue
+                fork_height = self.switch_chain(candidate, accounts)
+                self.sync_transaction_pool(candidate[fork_height:], reorg=True)
             consensus_applied = True
-        else:
-            for node in network:
-                try:
-                    response = requests.get(f'http://{node}/get_chain')
-                    if response.status_code == 200:
-                        other_chain = response.json()['chain']
-                        for block in other_chain:
-                            if block not in self.chain and self.is_valid_uncle(block):
-                                self.uncle_blocks.append(block)
-                except requests.RequestException as e:
-                    print(f"Failed to get chain from {node}: {str(e)}")
+            break
 
+        CONSENSUS_ROUNDS.observe(time.perf_counter() - started, result='replaced' if consensus_applied else 'unchanged')
         return consensus_applied
 
-    def sync_transaction_pool(self):
-        confirmed_transactions = set()
-        for block in self.chain:
-            for tx in block['transactions']:
-                confirmed_transactions.add(json.dumps(tx, sort_keys=True))
-        
-        self.transaction_pool -= confirmed_transactions
\ No newline at end of file
+    @traced('receive_block')
+    def receive_block(self, block):
+        """Returns 'added', 'reorg', 'side', 'orphan' or 'known', or None if the block is invalid."""
+        status = self.connect_block(block)
+        RECEIVED_BLOCKS.inc(status=status or 'invalid')
+        return status
+
+    def connect_block(self, block):
+        block_hash = self.hash(block)
+        with self.lock:
+            if block_hash in self.block_tree or self.store.height_of(block_hash) is not None:
+                return 'known'
+
+            parent_hash = block['previous_hash']
+            if parent_hash == self.snapshot.tip_hash:
+                tip_height = len(self.store)
+                candidate = CandidateChain(self.store, tip_height, [block], [block_hash])
+                accounts = (dict(self.state.balances), dict(self.state.nonces))
+                if not self.validate_blocks(candidate, tip_height, tip_height + 1, accounts):
+                    return None
+                self.append_block(block)
+                self.sync_transaction_pool([block])
+                status = 'added'
+            else:
+                parent_height = self.store.height_of(parent_hash)
+                parent = None if parent_height is None else self.store.header(parent_height)
+                if parent is None:
+                    parent, parent_height = self.block_tree.get(parent_hash), self.block_tree.height_of(parent_hash)
+                if parent is None:
+                    self.block_tree.add_orphan(block, block_hash)
+                    return 'orphan'
+                # Side blocks only get a proof-of-work check; the rest is
+                # validated if their branch ever overtakes the main chain.
+                if not check_proof(parent['nonce'], block['nonce'], block['difficulty']):
+                    return None
+                self.block_tree.add(block, block_hash, parent_height + 1)
+                status = 'reorg' if self.reorg_to(block_hash) else 'side'
+
+            for _, orphan in self.block_tree.take_orphans(block_hash):
+                self.connect_block(orphan)
+            return status
+
+    def reorg_to(self, tip_hash):
+        # Switch to the side branch ending at `tip_hash` if it has more work
+        # than the main chain. Only the branch is validated, no download is needed.
+        blocks, hashes = self.block_tree.branch(tip_hash)
+        fork_height = self.store.height_of(blocks[0]['previous_hash'])
+        if fork_height is None:
+            return False
+        candidate = CandidateChain(self.store, fork_height + 1, blocks, hashes)
+        if self.headers_work(fork_height + 1, blocks) <= self.total_work():
+            return False
+
+        valid, accounts = self.validate_chain(candidate)
+        if not valid:
+            self.block_tree.remove(tip_hash)
+            return False
+        fork_height = self.switch_chain(candidate, accounts)
+        self.sync_transaction_pool(candidate[fork_height:], reorg=True)
+        logging.info(f"Reorganized to a side branch of {len(blocks)} blocks at height {fork_height}")
+        return True
+
+    def export_snapshot(self, height=None):
+        """State snapshot after the first `height` blocks, by default the tip; None if the undo log cannot reach it."""
+        with self.lock:
+            height = self.state.height if height is None else height
+            balances, nonces = self.state.balances_at(height), self.state.nonces_at(height)
+            if height < 1 or balances is None:
+                return None
+            tip_hash = self.store.block_hash(height - 1)
+        # Headers are read without the lock; a reorg below `height` meanwhile
+        # would change the hash of the snapshot's tip.
+        headers = [self.store.header(h) for h in range(height)]
+        if headers[-1]['hash'] != tip_hash or self.snapshot_hash_at(height) != tip_hash:
+            return None
+        return make_snapshot(height, tip_hash, balances, nonces, headers)
+
+    def import_snapshot(self, snapshot):
+        # The commitment was checked by read_snapshot; the headers are checked
+        # for linkage, proof of work and difficulty like headers from a peer.
+        headers = snapshot['headers']
+        if not self.headers_connect(0, headers):
+            raise SnapshotError('snapshot headers do not form a valid chain')
+        with self.lock:
+            self.store.import_headers(headers)
+            self.state.restore(snapshot['height'], snapshot['tip_hash'], snapshot['balances'], snapshot['nonces'])
+            self.state.save()
+            self.set_checkpoint(self.store, (snapshot['balances'], snapshot['nonces']), snapshot['height'])
+        logging.info(f"Bootstrapped from the snapshot at height {snapshot['height']}: {snapshot['commitment']}")
+
+    def replace_chain(self):
+        return self.apply_consensus()
+
+    def sync_transaction_pool(self, blocks=None, reorg=False):
+        blocks = self.chain if blocks is None else blocks
+        self.mempool.remove_confirmed(tx for block in blocks for tx in block['transactions'])
+        # New blocks only take funds from their senders; a reorg can take them
+        # from anyone who was paid in the blocks it dropped.
+        senders = None if reorg else {tx['sender'] for block in blocks for tx in block['transactions']}
+        self.mempool.remove_unfunded(self.state.balance, senders)
@@ -0,0 +1,457 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from codec import CodecError, decode_block, encode_block, is_binary
+
+INDEX_MAGIC = b'BIDX'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('<4sI')
+INDEX_FIELDS = 7  # segment, offset, length, then the 32-byte block hash as four words
+RECORD_HEADER = struct.Struct('<II')  # payload length, crc32
+PRUNED = 2 ** 64 - 1  # segment number of an index entry whose record is a header in headers.dat
+
+class PrunedBlockError(IndexError):
+    """The block body at this height was pruned; only its header is kept."""
+
+def block_digest(payload):
+    """Double SHA-256 of a block's canonical JSON, the same value as Blockchain.hash."""
+    return hashlib.sha256(hashlib.sha256(payload).digest()).digest()
+
+def decode_record(payload):
+    # Records say which format they are in with their first byte.
+    return decode_block(payload) if is_binary(payload) else json.loads(payload)
+
+def block_header(block, block_hash):
+    return {
+        'index': block['index'],
+        'timestamp': block['timestamp'],
+        'previous_hash': block['previous_hash'],
+        'merkleroot': block['merkleroot'],
+        'difficulty': block['difficulty'],
+        'nonce': block['nonce'],
+        'block_time': block['block_time'],
+        'hash': block_hash,
+        'transaction_count': len(block['transactions']),
+        'uncle_count': len(block['uncles'])
+    }
+
+def record_json(payload):
+    """The block's canonical JSON, whichever format the record is in."""
+    if is_binary(payload):
+        return json.dumps(decode_block(payload), sort_keys=True).encode()
+    return payload
+
+class BlockStore:
+    """Append-only block log split into segment files, with a height -> offset index.
+
+    Every record is written straight to its segment file, but fsync only runs every
+    `sync_every` appends or `sync_interval` seconds. On open, index entries that point
+    past the end of a segment are dropped and records that were written but never
+    indexed are re-indexed, so a crash loses at most the unsynced tail.
+
+    New records are written as canonical JSON or, with record_format='binary', in
+    the codec's format; a store can hold both.
+
+    prune(height) keeps only the headers of the blocks below `height`: they are
+    appended to headers.dat, their index entries are rewritten in place to point
+    there, and segment files holding nothing but pruned blocks are deleted. A
+    store can also start from imported headers, with no block bodies at all.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, sync_every=100, sync_interval=1.0, cache_size=256,
+                 record_format='json'):
+        if record_format not in ('json', 'binary'):
+            raise ValueError(f"Unknown record format: {record_format}")
+        self.path = path
+        self.record_format = record_format
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # height -> block, most recent blocks only
+        self.index = array('Q')
+        self._hash_index = None  # block hash -> height, built on first lookup
+        self._readers = {}
+        self._lock = threading.RLock()  # guards the index and files against concurrent readers
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+        os.makedirs(path, exist_ok=True)
+        index_valid = self._load_index()
+        if not len(self.index) and os.path.exists(self._headers_path()) and os.path.getsize(self._headers_path()):
+            # Pruned heights only exist in the index, so it cannot be rebuilt from the segments.
+            raise RuntimeError(f"Block index of the pruned store {path} is unreadable, bootstrap from a snapshot again")
+        self.pruned_height = self._count_pruned()
+        self._recover(rewrite_index=not index_valid)
+        self._open_writers()
+        self._headers_file = open(self._headers_path(), 'ab', buffering=0) if self.pruned_height else None
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, 'blk%05d.dat' % segment)
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.dat')
+
+    def _headers_path(self):
+        return os.path.join(self.path, 'headers.dat')
+
+    def _count_pruned(self):
+        # Pruned entries always form a prefix of the index.
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self.index[mid * INDEX_FIELDS] == PRUNED:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _records_end(self):
+        """Segment and offset just past the last block record."""
+        if len(self) > self.pruned_height:
+            segment, offset, length = self._entry(len(self) - 1)
+            return segment, offset + RECORD_HEADER.size + length
+        segments = self._segments_on_disk() if self.pruned_height else []
+        if not segments:
+            return 0, 0
+        # Only headers are indexed: new records go after whatever the last segment holds.
+        return max(segments), self._segment_size_on_disk(max(segments))
+
+    def _segments_on_disk(self):
+        return [int(name[3:8]) for name in os.listdir(self.path) if name.startswith('blk') and name.endswith('.dat')]
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        if len(data) < INDEX_HEADER.size or INDEX_HEADER.unpack_from(data) != (INDEX_MAGIC, INDEX_VERSION):
+            logging.warning(f"Block index in {self.path} is missing or outdated, rebuilding from segments")
+            return False
+
+        entry_size = INDEX_FIELDS * self.index.itemsize
+        usable = (len(data) - INDEX_HEADER.size) // entry_size * entry_size
+        self.index.frombytes(data[INDEX_HEADER.size:INDEX_HEADER.size + usable])
+        return usable == len(data) - INDEX_HEADER.size
+
+    def _segment_size_on_disk(self, segment):
+        try:
+            return os.path.getsize(self.segment_path(segment))
+        except FileNotFoundError:
+            return -1
+
+    def _recover(self, rewrite_index=False):
+        recovered = 0
+        dropped = 0
+
+        # Drop index entries whose record never fully reached the segment file.
+        while len(self) > self.pruned_height:
+            segment, offset, length = self._entry(len(self) - 1)
+            if offset + RECORD_HEADER.size + length <= self._segment_size_on_disk(segment):
+                break
+            del self.index[-INDEX_FIELDS:]
+            dropped += 1
+
+        # Re-index any complete records written after the last index entry.
+        segment, offset = self._records_end()
+
+        while self._segment_size_on_disk(segment) >= 0:
+            with open(self.segment_path(segment), 'r+b') as f:
+                data = f.read()
+                while offset + RECORD_HEADER.size <= len(data):
+                    length, crc = RECORD_HEADER.unpack_from(data, offset)
+                    start = offset + RECORD_HEADER.size
+                    payload = data[start:start + length]
+                    if len(payload) != length or zlib.crc32(payload) != crc:
+                        break
+                    self.index.extend((segment, offset, length))
+                    self.index.frombytes(block_digest(record_json(payload)))
+                    offset = start + length
+                    recovered += 1
+                if offset < len(data):
+                    logging.warning(f"Truncating torn record at {self.segment_path(segment)}:{offset}")
+                    f.truncate(offset)
+                    self._remove_segments_after(segment)
+                    break
+            if self._segment_size_on_disk(segment + 1) < 0:
+                break
+            segment, offset = segment + 1, 0
+
+        if rewrite_index or recovered or dropped:
+            self._write_index()
+        if recovered or dropped:
+            logging.info(f"Block store recovery: re-indexed {recovered} blocks, dropped {dropped} index entries")
+
+    def _remove_segments_after(self, segment):
+        segment += 1
+        while self._segment_size_on_disk(segment) >= 0:
+            self._close_reader(segment)
+            os.remove(self.segment_path(segment))
+            segment += 1
+
+    def _write_index(self):
+        with open(self._index_path(), 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION))
+            f.write(self.index.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _open_writers(self):
+        self._segment, self._offset = self._records_end()
+        self._segment_file = open(self.segment_path(self._segment), 'ab', buffering=0)
+        self._index_file = open(self._index_path(), 'ab', buffering=0)
+
+    def _entry(self, height):
+        i = height * INDEX_FIELDS
+        return self.index[i], self.index[i + 1], self.index[i + 2]
+
+    def block_hash(self, height):
+        """Hex hash of the block at `height`, as computed when it was stored."""
+        if height < 0:
+            height += len(self)
+        i = height * INDEX_FIELDS
+        return self.index[i + 3:i + INDEX_FIELDS].tobytes().hex()
+
+    def height_of(self, block_hash):
+        if self._hash_index is None:
+            raw = self.index.tobytes()
+            entry_size = INDEX_FIELDS * self.index.itemsize
+            self._hash_index = {
+                raw[start + 24:start + entry_size]: height
+                for height, start in enumerate(range(0, len(raw), entry_size))
+            }
+        try:
+            return self._hash_index.get(bytes.fromhex(block_hash))
+        except ValueError:
+            return None
+
+    def _reader(self, segment):
+        fd = self._readers.get(segment)
+        if fd is None:
+            fd = os.open(self._headers_path() if segment == PRUNED else self.segment_path(segment), os.O_RDONLY)
+            self._readers[segment] = fd
+        return fd
+
+    def _close_reader(self, segment):
+        fd = self._readers.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+
+    def __len__(self):
+        return len(self.index) // INDEX_FIELDS
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.get(height) for height in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('block height out of range')
+        return self.get(item)
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self.get(height)
+
+    def get(self, height):
+        with self._lock:
+            block = self.cache.get(height)
+            if block is None:
+                block = decode_record(self.read_raw(height))
+            return block
+
+    def header(self, height):
+        """The header of the block at `height`, pruned or not."""
+        if height < 0:
+            height += len(self)
+        with self._lock:
+            if not 0 <= height < len(self):
+                raise IndexError('block height out of range')
+            if height >= self.pruned_height:
+                return block_header(self.get(height), self.block_hash(height))
+            _, offset, length = self._entry(height)
+            return json.loads(os.pread(self._reader(PRUNED), length, offset + RECORD_HEADER.size))
+
+    def read_raw(self, height):
+        with self._lock:
+            if not 0 <= height < len(self):
+                raise IndexError('block height out of range')
+            if height < self.pruned_height:
+                raise PrunedBlockError(f'block {height} was pruned, only its header is kept')
+            segment, offset, length = self._entry(height)
+            return os.pread(self._reader(segment), length, offset + RECORD_HEADER.size)
+
+    def read_json(self, height):
+        """The block at `height` as canonical JSON bytes."""
+        return record_json(self.read_raw(height))
+
+    def append(self, block):
+        # The canonical serialization is computed once here; it is the input to
+        # the block hash kept in the index and, by default, the stored record.
+        payload = json.dumps(block, sort_keys=True).encode()
+        digest = block_digest(payload)
+        if self.record_format == 'binary':
+            try:
+                payload = encode_block(block)
+            except CodecError as e:
+                logging.debug(f"Storing block as JSON, it has no binary form: {str(e)}")
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            return self._append_record(block, record, len(payload), digest)
+
+    def _append_record(self, block, record, length, digest):
+
+        if self._offset > 0 and self._offset + len(record) > self.segment_size:
+            self._roll_segment()
+
+        self._segment_file.write(record)
+        entry = array('Q', (self._segment, self._offset, length))
+        entry.frombytes(digest)
+        self._index_file.write(entry.tobytes())
+        self.index.extend(entry)
+        self._offset += len(record)
+
+        height = len(self) - 1
+        if self._hash_index is not None:
+            self._hash_index[digest] = height
+        self._cache_put(height, block)
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+        return digest.hex()
+
+    def _roll_segment(self):
+        self.sync()
+        self._segment_file.close()
+        self._segment += 1
+        self._offset = 0
+        self._segment_file = open(self.segment_path(self._segment), 'ab', buffering=0)
+
+    def _cache_put(self, height, block):
+        self.cache[height] = block
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def truncate(self, height):
+        """Drop every block at `height` and above."""
+        with self._lock:
+            self._truncate(height)
+
+    def _truncate(self, height):
+        if height >= len(self):
+            return
+
+        self.sync()
+        self._segment_file.close()
+        self._index_file.close()
+
+        # Cut the segments where the first dropped block record starts.
+        first_record = max(height, self.pruned_height)
+        if first_record < len(self):
+            segment, end, _ = self._entry(first_record)
+            with open(self.segment_path(segment), 'r+b') as f:
+                f.truncate(end)
+            self._remove_segments_after(segment)
+        if height < self.pruned_height:
+            _, header_offset, _ = self._entry(height)
+            os.truncate(self._headers_path(), header_offset)
+            self.pruned_height = height
+
+        if self._hash_index is not None:
+            for dropped in range(height, len(self)):
+                self._hash_index.pop(bytes.fromhex(self.block_hash(dropped)), None)
+        del self.index[height * INDEX_FIELDS:]
+        for cached_height in [h for h in self.cache if h >= height]:
+            del self.cache[cached_height]
+
+        os.truncate(self._index_path(), INDEX_HEADER.size + height * INDEX_FIELDS * self.index.itemsize)
+        self._open_writers()
+
+    def _append_headers(self, headers):
+        # Appends header records and returns their (offset, length) in headers.dat.
+        if self._headers_file is None:
+            self._headers_file = open(self._headers_path(), 'ab', buffering=0)
+        offset = os.fstat(self._headers_file.fileno()).st_size
+        records, positions = bytearray(), []
+        for header in headers:
+            payload = json.dumps(header, sort_keys=True).encode()
+            positions.append((offset + len(records), len(payload)))
+            records += RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        self._headers_file.write(records)
+        os.fsync(self._headers_file.fileno())
+        return positions
+
+    def prune(self, height):
+        """Keep only the headers of the blocks below `height`; returns the number of blocks pruned."""
+        with self._lock:
+            height = min(height, len(self))
+            start = self.pruned_height
+            if height <= start:
+                return 0
+            self.sync()
+            headers = [block_header(self.get(h), self.block_hash(h)) for h in range(start, height)]
+            positions = self._append_headers(headers)
+
+            # Headers are durable before any index entry points at them, and
+            # segments are deleted only once the index no longer needs them.
+            entries = bytearray()
+            for h, (offset, length) in enumerate(positions, start):
+                i = h * INDEX_FIELDS
+                self.index[i:i + 3] = array('Q', (PRUNED, offset, length))
+                entries += self.index[i:i + INDEX_FIELDS].tobytes()
+            fd = os.open(self._index_path(), os.O_WRONLY)
+            try:
+                os.pwrite(fd, bytes(entries), INDEX_HEADER.size + start * INDEX_FIELDS * self.index.itemsize)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.pruned_height = height
+            for cached_height in [h for h in self.cache if h < height]:
+                del self.cache[cached_height]
+
+            first_kept = self._entry(height)[0] if height < len(self) else self._segment
+            for segment in self._segments_on_disk():
+                if segment < first_kept:
+                    self._close_reader(segment)
+                    os.remove(self.segment_path(segment))
+            return height - start
+
+    def import_headers(self, headers):
+        """Start an empty store from the headers of an existing chain, without their blocks."""
+        with self._lock:
+            if len(self):
+                raise ValueError('headers can only be imported into an empty store')
+            entries = array('Q')
+            for header, (offset, length) in zip(headers, self._append_headers(headers)):
+                entries.extend((PRUNED, offset, length))
+                entries.frombytes(bytes.fromhex(header['hash']))
+            self._index_file.write(entries.tobytes())
+            os.fsync(self._index_file.fileno())
+            self.index.extend(entries)
+            self._hash_index = None
+            self.pruned_height = len(self)
+
+    def sync(self):
+        if self._unsynced:
+            os.fsync(self._segment_file.fileno())
+            os.fsync(self._index_file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self._segment_file.close()
+        self._index_file.close()
+        if self._headers_file is not None:
+            self._headers_file.close()
+        for segment in list(self._readers):
+            self._close_reader(segment)
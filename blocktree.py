@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+class BlockTree:
+    """Known blocks that are not on the main chain, indexed by hash.
+
+    Side blocks have a known parent, either on the main chain or in the tree,
+    and are also indexed by height so uncle selection only looks at the few
+    heights in the uncle window. Orphans are blocks whose parent has not been
+    seen yet; they wait, keyed by parent hash, until it arrives. Both sets are
+    bounded, and blocks more than `max_depth` below the tip are pruned.
+    """
+
+    def __init__(self, max_blocks=1000, max_orphans=100, max_depth=100):
+        self.max_blocks = max_blocks
+        self.max_orphans = max_orphans
+        self.max_depth = max_depth
+        self.blocks = OrderedDict()  # hash -> (height, block), oldest first
+        self.by_height = {}  # height -> set of hashes
+        self.orphans = OrderedDict()  # hash -> block
+        self.orphans_by_parent = {}  # parent hash -> set of orphan hashes
+        self.used_uncles = {}  # hash -> height of the main-chain block that included it as an uncle
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks or block_hash in self.orphans
+
+    def get(self, block_hash):
+        entry = self.blocks.get(block_hash)
+        return None if entry is None else entry[1]
+
+    def height_of(self, block_hash):
+        entry = self.blocks.get(block_hash)
+        return None if entry is None else entry[0]
+
+    def add(self, block, block_hash, height):
+        if block_hash in self.blocks:
+            return
+        self.blocks[block_hash] = (height, block)
+        self.by_height.setdefault(height, set()).add(block_hash)
+        while len(self.blocks) > self.max_blocks:
+            self.remove(next(iter(self.blocks)))
+
+    def remove(self, block_hash):
+        entry = self.blocks.pop(block_hash, None)
+        if entry is None:
+            return None
+        height, block = entry
+        hashes = self.by_height[height]
+        hashes.discard(block_hash)
+        if not hashes:
+            del self.by_height[height]
+        return block
+
+    def add_orphan(self, block, block_hash):
+        if block_hash in self.orphans:
+            return
+        self.orphans[block_hash] = block
+        self.orphans_by_parent.setdefault(block['previous_hash'], set()).add(block_hash)
+        while len(self.orphans) > self.max_orphans:
+            self._remove_orphan(next(iter(self.orphans)))
+
+    def _remove_orphan(self, block_hash):
+        block = self.orphans.pop(block_hash)
+        siblings = self.orphans_by_parent[block['previous_hash']]
+        siblings.discard(block_hash)
+        if not siblings:
+            del self.orphans_by_parent[block['previous_hash']]
+        return block
+
+    def take_orphans(self, parent_hash):
+        """Remove and return the (hash, block) pairs of orphans waiting on `parent_hash`."""
+        return [(block_hash, self._remove_orphan(block_hash))
+                for block_hash in list(self.orphans_by_parent.get(parent_hash, ()))]
+
+    def branch(self, tip_hash):
+        """Blocks and hashes from the first tree block on the way back from `tip_hash` up to it, oldest first."""
+        blocks, hashes = [], []
+        while tip_hash in self.blocks:
+            blocks.append(self.blocks[tip_hash][1])
+            hashes.append(tip_hash)
+            tip_hash = blocks[-1]['previous_hash']
+        blocks.reverse()
+        hashes.reverse()
+        return blocks, hashes
+
+    def connected(self, block_hash, height, uncle_hashes):
+        # The block joined the main chain at `height`.
+        self.remove(block_hash)
+        for uncle_hash in uncle_hashes:
+            self.used_uncles[uncle_hash] = height
+        self.prune(height + 1 - self.max_depth)
+
+    def disconnected(self, block, block_hash, height, uncle_hashes):
+        # The block left the main chain in a reorg and is now on a side branch.
+        for uncle_hash in uncle_hashes:
+            self.used_uncles.pop(uncle_hash, None)
+        self.add(block, block_hash, height)
+
+    def uncle_candidates(self, low, high, limit):
+        """Up to `limit` unused side blocks with height in [low, high), newest first."""
+        selected = []
+        for height in range(high - 1, low - 1, -1):
+            for block_hash in self.by_height.get(height, ()):
+                if block_hash not in self.used_uncles:
+                    selected.append(self.blocks[block_hash][1])
+                    if len(selected) >= limit:
+                        return selected
+        return selected
+
+    def prune(self, min_height):
+        for height in [height for height in self.by_height if height < min_height]:
+            for block_hash in list(self.by_height.get(height, ())):
+                self.remove(block_hash)
+        for block_hash in [block_hash for block_hash, block in self.orphans.items() if block['index'] - 1 < min_height]:
+            self._remove_orphan(block_hash)
+        for uncle_hash in [uncle_hash for uncle_hash, height in self.used_uncles.items() if height < min_height]:
+            del self.used_uncles[uncle_hash]
@@ -0,0 +1,64 @@
+import logging
+import os
+import struct
+import threading
+
+WORK_MAGIC = b'BWRK'
+WORK_VERSION = 1
+WORK_HEADER = struct.Struct('<4sI')
+ENTRY_SIZE = 64  # 32-byte block hash, then the cumulative work as a 256-bit big-endian integer
+
+class ChainWork:
+    """Cumulative proof-of-work of every main-chain block, kept next to the block store.
+
+    Entry i holds the hash of block i and the total work of blocks 0..i, so
+    comparing our chain with a candidate never has to re-read blocks. The file
+    can always be rebuilt from the store, so writes are not fsynced; a torn
+    last entry is dropped on open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = bytearray()
+        self._lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        data = os.pread(self.fd, os.fstat(self.fd).st_size, 0)
+        if len(data) >= WORK_HEADER.size and WORK_HEADER.unpack_from(data) == (WORK_MAGIC, WORK_VERSION):
+            body = data[WORK_HEADER.size:]
+            self.entries = bytearray(body[:len(body) - len(body) % ENTRY_SIZE])
+        else:
+            if data:
+                logging.warning(f"Chain work file {path} is not readable, rebuilding it")
+            os.ftruncate(self.fd, 0)
+            os.pwrite(self.fd, WORK_HEADER.pack(WORK_MAGIC, WORK_VERSION), 0)
+
+    def __len__(self):
+        return len(self.entries) // ENTRY_SIZE
+
+    def block_hash(self, height):
+        start = height * ENTRY_SIZE
+        return self.entries[start:start + 32].hex()
+
+    def total(self, length):
+        """Total work of the first `length` blocks."""
+        if length <= 0:
+            return 0
+        start = (length - 1) * ENTRY_SIZE + 32
+        return int.from_bytes(self.entries[start:start + 32], 'big')
+
+    def append(self, block_hash, work):
+        with self._lock:
+            entry = bytes.fromhex(block_hash) + (self.total(len(self)) + work).to_bytes(32, 'big')
+            os.pwrite(self.fd, entry, WORK_HEADER.size + len(self.entries))
+            self.entries += entry
+
+    def truncate(self, length):
+        with self._lock:
+            if length >= len(self):
+                return
+            del self.entries[length * ENTRY_SIZE:]
+            os.ftruncate(self.fd, WORK_HEADER.size + len(self.entries))
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,590 @@
+import struct
+import threading
+from collections import OrderedDict
+from Crypto.PublicKey import RSA
+from crypto_utils import key_fingerprint
+
+# Binary encoding of blocks, headers and transactions for the wire and the block
+# store. A message is
+#
+#   magic (0xB1), codec version, message type
+#   key table: count, then per key: kind, 32-byte fingerprint, length, key bytes
+#   body
+#
+# Transactions refer to their public key by its position in the key table, so a
+# key used by many transactions is sent once, as DER rather than PEM. Integers
+# and floats are tagged 9-byte fields, hashes are 32 raw bytes and signatures
+# raw bytes. Decoding gives back exactly the dict that was encoded, so block
+# hashes and transaction ids, which are taken over canonical JSON, do not change.
+# Anything the layout cannot represent exactly raises CodecError, and the caller
+# falls back to JSON. JSON never starts with 0xB1, so stored records and request
+# bodies identify their own format from the first byte.
+#
+# Version 2 adds raw Ed25519 keys and the transaction scheme tag. A message that
+# uses neither is still written as version 1, so older nodes can read it.
+
+MAGIC = 0xB1
+CODEC_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+CONTENT_TYPE = 'application/x-blockchain-binary'
+
+BLOCK, HEADER, TRANSACTION, BLOCKS, HEADERS, TRANSACTIONS = range(1, 7)
+
+PREAMBLE = struct.Struct('<BBB')  # magic, version, message type
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+F64 = struct.Struct('<d')
+LIST_HEADER = struct.Struct('<II')  # chain length, item count
+KEY_ENTRY = struct.Struct('<B32sH')  # kind, fingerprint, key length
+# index, nonce, difficulty, block_time, flags, transaction count, uncle count
+BLOCK_FIXED = struct.Struct('<qqB8sB8sBIH')
+# index, nonce, difficulty, block_time, transaction count, uncle count
+HEADER_FIXED = struct.Struct('<qqB8sB8sII')
+# flags, amount, nonce, fee, key table position, signature length
+TRANSACTION_FIXED = struct.Struct('<BB8sB8sB8sHH')
+
+KEY_DER, KEY_TEXT, KEY_ED25519 = 0, 1, 2
+NUMBER_INT, NUMBER_FLOAT = 0, 1
+HASH_RAW, HASH_TEXT = 0, 1
+HAS_FEE, HAS_SCHEME = 1, 2  # transaction flags
+HAS_MINER = 1  # block flag
+
+TRANSACTION_FIELDS = frozenset(['sender', 'receiver', 'amount', 'nonce', 'signature', 'public_key'])
+BLOCK_FIELDS = frozenset(['index', 'timestamp', 'previous_hash', 'transactions', 'merkleroot', 'difficulty',
+                          'nonce', 'block_time', 'uncles'])
+HEADER_FIELDS = frozenset(['index', 'timestamp', 'previous_hash', 'merkleroot', 'difficulty', 'nonce',
+                           'block_time', 'hash', 'transaction_count', 'uncle_count'])
+
+KEY_CACHE_SIZE = 1024
+_encoded_keys = OrderedDict()  # PEM -> (kind, fingerprint, key bytes)
+_decoded_keys = OrderedDict()  # (kind, fingerprint) -> PEM
+_key_lock = threading.Lock()
+
+class CodecError(ValueError):
+    pass
+
+class UnsupportedFormat(CodecError):
+    """The data is not a message this version of the codec can read."""
+
+def _cache_put(cache, key, value):
+    with _key_lock:
+        cache[key] = value
+        if len(cache) > KEY_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def _encode_key(public_key):
+    cached = _encoded_keys.get(public_key)
+    if cached is not None:
+        return cached
+    if not isinstance(public_key, str):
+        raise CodecError('public key is not a string')
+
+    fingerprint = bytes.fromhex(key_fingerprint(public_key))
+    kind, raw = KEY_TEXT, public_key.encode()
+    if len(public_key) == 64:
+        try:
+            raw_key = bytes.fromhex(public_key)
+        except ValueError:
+            raw_key = None
+        if raw_key is not None and raw_key.hex() == public_key:
+            encoded = (KEY_ED25519, fingerprint, raw_key)
+            _cache_put(_encoded_keys, public_key, encoded)
+            return encoded
+    try:
+        der = RSA.import_key(public_key).export_key('DER')
+        # DER is only used when it converts back to the very same PEM text.
+        if RSA.import_key(der).export_key('PEM').decode() == public_key:
+            kind, raw = KEY_DER, der
+    except (ValueError, IndexError, TypeError):
+        pass
+    encoded = (kind, fingerprint, raw)
+    _cache_put(_encoded_keys, public_key, encoded)
+    return encoded
+
+def _decode_key(kind, fingerprint, raw):
+    public_key = _decoded_keys.get((kind, fingerprint))
+    if public_key is not None:
+        return public_key
+    try:
+        if kind == KEY_DER:
+            public_key = RSA.import_key(bytes(raw)).export_key('PEM').decode()
+        elif kind == KEY_TEXT:
+            public_key = bytes(raw).decode()
+        elif kind == KEY_ED25519 and len(raw) == 32:
+            public_key = bytes(raw).hex()
+        else:
+            raise CodecError(f'unknown key kind {kind}')
+    except (ValueError, IndexError, TypeError, UnicodeDecodeError) as e:
+        raise CodecError(f'unreadable public key: {e}')
+    if bytes.fromhex(key_fingerprint(public_key)) != fingerprint:
+        raise CodecError('public key does not match its fingerprint')
+    _cache_put(_decoded_keys, (kind, fingerprint), public_key)
+    return public_key
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise CodecError(f'expected a number, got {type(value).__name__}')
+    if isinstance(value, float):
+        return NUMBER_FLOAT, F64.pack(value)
+    if not -2 ** 63 <= value < 2 ** 63:
+        raise CodecError('integer out of range')
+    return NUMBER_INT, I64.pack(value)
+
+def _read_number(tag, raw):
+    if tag == NUMBER_INT:
+        return I64.unpack(raw)[0]
+    if tag == NUMBER_FLOAT:
+        return F64.unpack(raw)[0]
+    raise CodecError(f'unknown number tag {tag}')
+
+def _integer(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not -2 ** 63 <= value < 2 ** 63:
+        raise CodecError('expected a 64-bit integer')
+    return value
+
+def _check_fields(item, required, optional=()):
+    if not isinstance(item, dict):
+        raise CodecError('expected an object')
+    keys = item.keys()
+    unsupported = (keys - required - set(optional)) | (required - keys)
+    if unsupported:
+        raise CodecError(f'unsupported or missing fields: {sorted(unsupported)}')
+
+class _Encoder:
+    def __init__(self):
+        self.body = bytearray()
+        self.keys = {}  # PEM -> key table position
+        self.key_entries = []
+        self.version = 1  # raised to 2 once a version 2 feature is written
+
+    def text(self, value):
+        if not isinstance(value, str):
+            raise CodecError('expected a string')
+        raw = value.encode()
+        if len(raw) > 0xFFFF:
+            raise CodecError('string too long')
+        self.body += U16.pack(len(raw))
+        self.body += raw
+
+    def hash(self, value):
+        if isinstance(value, str) and len(value) == 64:
+            try:
+                raw = bytes.fromhex(value)
+            except ValueError:
+                raw = None
+            if raw is not None and raw.hex() == value:
+                self.body += U8.pack(HASH_RAW)
+                self.body += raw
+                return
+        # e.g. the genesis block's '0' previous hash or an empty Merkle root
+        self.body += U8.pack(HASH_TEXT)
+        self.text(value)
+
+    def key(self, public_key):
+        position = self.keys.get(public_key)
+        if position is None:
+            if len(self.key_entries) >= 0xFFFF:
+                raise CodecError('too many keys')
+            position = self.keys[public_key] = len(self.key_entries)
+            self.key_entries.append(_encode_key(public_key))
+            if self.key_entries[-1][0] == KEY_ED25519:
+                self.version = 2
+        return position
+
+    def transaction(self, transaction):
+        _check_fields(transaction, TRANSACTION_FIELDS, ('fee', 'scheme'))
+        signature = transaction['signature']
+        try:
+            raw_signature = bytes.fromhex(signature)
+        except (ValueError, TypeError):
+            raise CodecError('signature is not hex')
+        if raw_signature.hex() != signature or len(raw_signature) > 0xFFFF:
+            raise CodecError('signature is not lowercase hex')
+
+        has_fee = 'fee' in transaction
+        flags = (HAS_FEE if has_fee else 0) | (HAS_SCHEME if 'scheme' in transaction else 0)
+        amount_tag, amount = _number(transaction['amount'])
+        nonce_tag, nonce = _number(transaction['nonce'])
+        fee_tag, fee = _number(transaction['fee']) if has_fee else (NUMBER_INT, bytes(8))
+        self.body += TRANSACTION_FIXED.pack(flags, amount_tag, amount, nonce_tag, nonce,
+                                            fee_tag, fee, self.key(transaction['public_key']), len(raw_signature))
+        self.body += raw_signature
+        self.text(transaction['sender'])
+        self.text(transaction['receiver'])
+        if flags & HAS_SCHEME:
+            self.text(transaction['scheme'])
+            self.version = 2
+
+    def block(self, block):
+        _check_fields(block, BLOCK_FIELDS, ('miner',))
+        transactions, uncles = block['transactions'], block['uncles']
+        if not isinstance(transactions, list) or not isinstance(uncles, list) or len(uncles) > 0xFFFF:
+            raise CodecError('bad transaction or uncle list')
+        difficulty_tag, difficulty = _number(block['difficulty'])
+        block_time_tag, block_time = _number(block['block_time'])
+        has_miner = 'miner' in block
+        self.body += BLOCK_FIXED.pack(_integer(block['index']), _integer(block['nonce']), difficulty_tag, difficulty,
+                                      block_time_tag, block_time, HAS_MINER if has_miner else 0,
+                                      len(transactions), len(uncles))
+        self.hash(block['previous_hash'])
+        self.hash(block['merkleroot'])
+        self.text(block['timestamp'])
+        if has_miner:
+            self.text(block['miner'])
+        for transaction in transactions:
+            self.transaction(transaction)
+        for uncle in uncles:
+            self.block(uncle)
+
+    def header(self, header):
+        _check_fields(header, HEADER_FIELDS)
+        difficulty_tag, difficulty = _number(header['difficulty'])
+        block_time_tag, block_time = _number(header['block_time'])
+        try:
+            self.body += HEADER_FIXED.pack(_integer(header['index']), _integer(header['nonce']), difficulty_tag,
+                                           difficulty, block_time_tag, block_time, header['transaction_count'],
+                                           header['uncle_count'])
+        except struct.error as e:
+            raise CodecError(str(e))
+        self.hash(header['previous_hash'])
+        self.hash(header['merkleroot'])
+        self.hash(header['hash'])
+        self.text(header['timestamp'])
+
+    def message(self, message_type):
+        out = bytearray(PREAMBLE.pack(MAGIC, self.version, message_type))
+        out += U16.pack(len(self.key_entries))
+        for kind, fingerprint, raw in self.key_entries:
+            out += KEY_ENTRY.pack(kind, fingerprint, len(raw))
+            out += raw
+        out += self.body
+        return bytes(out)
+
+def encode_block(block):
+    encoder = _Encoder()
+    encoder.block(block)
+    return encoder.message(BLOCK)
+
+def encode_header(header):
+    encoder = _Encoder()
+    encoder.header(header)
+    return encoder.message(HEADER)
+
+def encode_transaction(transaction):
+    encoder = _Encoder()
+    encoder.transaction(transaction)
+    return encoder.message(TRANSACTION)
+
+def _encode_list(message_type, write, items, length):
+    encoder = _Encoder()
+    if not isinstance(items, list):
+        raise CodecError('expected a list')
+    encoder.body += LIST_HEADER.pack(length, len(items))
+    for item in items:
+        write(encoder, item)
+    return encoder.message(message_type)
+
+def encode_blocks(blocks, length=0):
+    return _encode_list(BLOCKS, _Encoder.block, blocks, length)
+
+def encode_headers(headers, length=0):
+    return _encode_list(HEADERS, _Encoder.header, headers, length)
+
+def encode_transactions(transactions):
+    return _encode_list(TRANSACTIONS, _Encoder.transaction, transactions, 0)
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+class _Message:
+    """The key table of a message; the views below read everything else from the buffer in place."""
+
+    def __init__(self, data, expected_type=None):
+        self.buffer = memoryview(data)
+        try:
+            magic, version, self.type = PREAMBLE.unpack_from(self.buffer, 0)
+        except struct.error:
+            raise CodecError('message too short')
+        if magic != MAGIC:
+            raise UnsupportedFormat('not a binary message')
+        if version not in SUPPORTED_VERSIONS:
+            raise UnsupportedFormat(f'unsupported codec version {version}')
+        if expected_type is not None and self.type != expected_type:
+            raise CodecError(f'expected message type {expected_type}, got {self.type}')
+
+        try:
+            offset = PREAMBLE.size
+            count, = U16.unpack_from(self.buffer, offset)
+            offset += U16.size
+            self._key_entries = []
+            self._keys = [None] * count
+            for _ in range(count):
+                kind, fingerprint, length = KEY_ENTRY.unpack_from(self.buffer, offset)
+                offset += KEY_ENTRY.size
+                self._key_entries.append((kind, fingerprint, self.buffer[offset:offset + length]))
+                offset += length
+        except struct.error:
+            raise CodecError('truncated key table')
+        self.body = offset
+
+    def key(self, position):
+        # Keys are converted back to PEM only when asked for, once per message.
+        public_key = self._keys[position]
+        if public_key is None:
+            public_key = self._keys[position] = _decode_key(*self._key_entries[position])
+        return public_key
+
+    def text(self, offset):
+        length, = U16.unpack_from(self.buffer, offset)
+        start = offset + U16.size
+        return bytes(self.buffer[start:start + length]).decode(), start + length
+
+    def hash(self, offset):
+        kind, = U8.unpack_from(self.buffer, offset)
+        if kind == HASH_RAW:
+            return self.buffer[offset + 1:offset + 33].hex(), offset + 33
+        if kind == HASH_TEXT:
+            return self.text(offset + 1)
+        raise CodecError(f'unknown hash kind {kind}')
+
+class TransactionView:
+    """Fields of an encoded transaction, read from the message buffer on access."""
+
+    __slots__ = ('message', 'offset', 'end', '_fixed')
+
+    def __init__(self, message, offset):
+        self.message = message
+        self.offset = offset
+        self._fixed = TRANSACTION_FIXED.unpack_from(message.buffer, offset)
+        signature_end = offset + TRANSACTION_FIXED.size + self._fixed[8]
+        _, sender_end = message.text(signature_end)
+        _, self.end = message.text(sender_end)
+        if self._fixed[0] & HAS_SCHEME:
+            _, self.end = message.text(self.end)
+
+    @property
+    def amount(self):
+        return _read_number(self._fixed[1], self._fixed[2])
+
+    @property
+    def nonce(self):
+        return _read_number(self._fixed[3], self._fixed[4])
+
+    @property
+    def fee(self):
+        return _read_number(self._fixed[5], self._fixed[6]) if self._fixed[0] & HAS_FEE else None
+
+    @property
+    def public_key(self):
+        return self.message.key(self._fixed[7])
+
+    @property
+    def signature_bytes(self):
+        start = self.offset + TRANSACTION_FIXED.size
+        return self.message.buffer[start:start + self._fixed[8]]
+
+    @property
+    def signature(self):
+        return self.signature_bytes.hex()
+
+    @property
+    def scheme(self):
+        if not self._fixed[0] & HAS_SCHEME:
+            return None
+        _, sender_end = self.message.text(self.offset + TRANSACTION_FIXED.size + self._fixed[8])
+        _, receiver_end = self.message.text(sender_end)
+        return self.message.text(receiver_end)[0]
+
+    @property
+    def sender(self):
+        return self.message.text(self.offset + TRANSACTION_FIXED.size + self._fixed[8])[0]
+
+    @property
+    def receiver(self):
+        _, sender_end = self.message.text(self.offset + TRANSACTION_FIXED.size + self._fixed[8])
+        return self.message.text(sender_end)[0]
+
+    def to_dict(self):
+        transaction = {
+            'sender': self.sender,
+            'receiver': self.receiver,
+            'amount': self.amount,
+            'nonce': self.nonce,
+            'signature': self.signature,
+            'public_key': self.public_key
+        }
+        if self._fixed[0] & HAS_FEE:
+            transaction['fee'] = self.fee
+        if self._fixed[0] & HAS_SCHEME:
+            transaction['scheme'] = self.scheme
+        return transaction
+
+class BlockView:
+    """Fields of an encoded block, read from the message buffer on access.
+
+    Only lengths are read up front, to find where each transaction and uncle
+    starts; no field is decoded until it is asked for.
+    """
+
+    __slots__ = ('message', 'offset', 'end', '_fixed', '_variable', '_transactions', '_uncles')
+
+    def __init__(self, message, offset):
+        self.message = message
+        self.offset = offset
+        self._fixed = BLOCK_FIXED.unpack_from(message.buffer, offset)
+        self._variable = offset + BLOCK_FIXED.size
+        _, position = message.hash(self._variable)
+        _, position = message.hash(position)
+        _, position = message.text(position)
+        if self._fixed[6] & HAS_MINER:
+            _, position = message.text(position)
+
+        self._transactions = []
+        for _ in range(self._fixed[7]):
+            transaction = TransactionView(message, position)
+            self._transactions.append(transaction)
+            position = transaction.end
+        self._uncles = []
+        for _ in range(self._fixed[8]):
+            uncle = BlockView(message, position)
+            self._uncles.append(uncle)
+            position = uncle.end
+        self.end = position
+
+    @classmethod
+    def from_bytes(cls, data):
+        message = _Message(data, BLOCK)
+        try:
+            view = cls(message, message.body)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise CodecError(f'malformed block: {e}')
+        if view.end != len(message.buffer):
+            raise CodecError('block length does not match the message')
+        return view
+
+    @property
+    def index(self):
+        return self._fixed[0]
+
+    @property
+    def nonce(self):
+        return self._fixed[1]
+
+    @property
+    def difficulty(self):
+        return _read_number(self._fixed[2], self._fixed[3])
+
+    @property
+    def block_time(self):
+        return _read_number(self._fixed[4], self._fixed[5])
+
+    @property
+    def previous_hash(self):
+        return self.message.hash(self._variable)[0]
+
+    @property
+    def merkleroot(self):
+        _, position = self.message.hash(self._variable)
+        return self.message.hash(position)[0]
+
+    @property
+    def timestamp(self):
+        _, position = self.message.hash(self._variable)
+        _, position = self.message.hash(position)
+        return self.message.text(position)[0]
+
+    @property
+    def miner(self):
+        if not self._fixed[6] & HAS_MINER:
+            return None
+        _, position = self.message.hash(self._variable)
+        _, position = self.message.hash(position)
+        _, position = self.message.text(position)
+        return self.message.text(position)[0]
+
+    @property
+    def transactions(self):
+        return self._transactions
+
+    @property
+    def uncles(self):
+        return self._uncles
+
+    def to_dict(self):
+        block = {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash,
+            'transactions': [transaction.to_dict() for transaction in self._transactions],
+            'merkleroot': self.merkleroot,
+            'difficulty': self.difficulty,
+            'nonce': self.nonce,
+            'block_time': self.block_time,
+            'uncles': [uncle.to_dict() for uncle in self._uncles]
+        }
+        if self._fixed[6] & HAS_MINER:
+            block['miner'] = self.miner
+        return block
+
+def _read_header(message, offset):
+    index, nonce, difficulty_tag, difficulty, block_time_tag, block_time, transaction_count, uncle_count = \
+        HEADER_FIXED.unpack_from(message.buffer, offset)
+    previous_hash, offset = message.hash(offset + HEADER_FIXED.size)
+    merkleroot, offset = message.hash(offset)
+    block_hash, offset = message.hash(offset)
+    timestamp, offset = message.text(offset)
+    header = {
+        'index': index,
+        'timestamp': timestamp,
+        'previous_hash': previous_hash,
+        'merkleroot': merkleroot,
+        'difficulty': _read_number(difficulty_tag, difficulty),
+        'nonce': nonce,
+        'block_time': _read_number(block_time_tag, block_time),
+        'hash': block_hash,
+        'transaction_count': transaction_count,
+        'uncle_count': uncle_count
+    }
+    return header, offset
+
+def _read_item(message, item_type, offset):
+    if item_type == BLOCK:
+        view = BlockView(message, offset)
+        return view.to_dict(), view.end
+    if item_type == TRANSACTION:
+        view = TransactionView(message, offset)
+        return view.to_dict(), view.end
+    return _read_header(message, offset)
+
+LIST_ITEMS = {BLOCKS: ('blocks', BLOCK), HEADERS: ('headers', HEADER), TRANSACTIONS: ('transactions', TRANSACTION)}
+
+def decode(data, expected_type=None):
+    """Decode any message to plain dicts and lists, in the same shape as its JSON form.
+
+    Lists come back as {'blocks'|'headers'|'transactions': [...], 'length': n}.
+    """
+    message = _Message(data, expected_type)
+    try:
+        if message.type in LIST_ITEMS:
+            key, item_type = LIST_ITEMS[message.type]
+            length, count = LIST_HEADER.unpack_from(message.buffer, message.body)
+            offset = message.body + LIST_HEADER.size
+            items = []
+            for _ in range(count):
+                item, offset = _read_item(message, item_type, offset)
+                items.append(item)
+            result = {key: items, 'length': length}
+        elif message.type in (BLOCK, HEADER, TRANSACTION):
+            result, offset = _read_item(message, message.type, message.body)
+        else:
+            raise CodecError(f'unknown message type {message.type}')
+    except (struct.error, UnicodeDecodeError, IndexError) as e:
+        raise CodecError(f'malformed message: {e}')
+    if offset != len(message.buffer):
+        raise CodecError('trailing bytes after message')
+    return result
+
+def decode_block(data):
+    return decode(data, BLOCK)
@@ -0,0 +1,129 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from crypto_utils import sign_transaction, verify_signature
+from metrics import Counter, Histogram
+
+SIGNATURE_VERIFICATIONS = Counter('blockchain_signature_verifications_total', 'Transaction signatures verified',
+                                  labels=('result',))
+VERIFICATION_BATCHES = Histogram('blockchain_signature_batch_seconds', 'Time to verify one batch of signatures',
+                                 labels=('mode',))
+SIGNING_BATCHES = Histogram('blockchain_signing_batch_seconds', 'Time to sign one batch of transactions',
+                            labels=('mode',))
+
+def process_context():
+    # Pools start lazily, once request, gossip and miner threads are running. A
+    # child forked while one of them holds a lock (logging, the metrics
+    # registry, a key cache) inherits the lock held and can deadlock, so
+    # workers start from a fresh interpreter instead.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def _verify_item(item):
+    public_key, transaction_data, signature, scheme = item
+    return verify_signature(public_key, transaction_data, signature, scheme)
+
+class SignatureVerifier:
+    """Verifies batches of (public_key, payload, signature, scheme) tuples on a process pool.
+
+    Batches smaller than `min_parallel_batch` are verified inline, where shipping
+    them to another process would cost more than the signature work itself.
+    """
+
+    def __init__(self, workers=None, min_parallel_batch=64, chunk_size=32):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel_batch = min_parallel_batch
+        self.chunk_size = chunk_size
+        self.executor = None
+
+    def _pool(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=process_context())
+        return self.executor
+
+    def verify_batch(self, items):
+        items = list(items)
+        if not items:
+            return []
+        started = time.perf_counter()
+        mode = 'inline'
+        if self.workers <= 1 or len(items) < self.min_parallel_batch:
+            results = [_verify_item(item) for item in items]
+        else:
+            try:
+                results = list(self._pool().map(_verify_item, items, chunksize=self.chunk_size))
+                mode = 'pool'
+            except BrokenProcessPool:
+                logging.warning("Signature verification pool broke, verifying batch inline")
+                self.executor = None
+                results = [_verify_item(item) for item in items]
+
+        VERIFICATION_BATCHES.observe(time.perf_counter() - started, mode=mode)
+        valid = sum(results)
+        SIGNATURE_VERIFICATIONS.inc(valid, result='valid')
+        if valid < len(results):
+            SIGNATURE_VERIFICATIONS.inc(len(results) - valid, result='invalid')
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+def _sign_item(item):
+    private_key, transaction_data, scheme = item
+    try:
+        return sign_transaction(private_key, transaction_data, scheme).hex()
+    except (ValueError, TypeError, IndexError) as e:
+        logging.debug(f'Signing failed: {str(e)}')
+        return None
+
+class TransactionSigner:
+    """Signs batches of (private_key, payload, scheme) tuples on a process pool.
+
+    Returns the hex signature of each item, or None where the key could not be
+    used. An RSA signature takes tens of milliseconds, so batches go to the
+    pool from a few items on. Consecutive items land in the same chunk, and
+    each worker keeps its own cache of parsed keys, so a batch signed with one
+    key parses it about once per chunk.
+    """
+
+    def __init__(self, workers=None, min_parallel_batch=4, chunk_size=8):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel_batch = min_parallel_batch
+        self.chunk_size = chunk_size
+        self.executor = None
+
+    def _pool(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=process_context())
+        return self.executor
+
+    def sign_batch(self, items):
+        items = list(items)
+        if not items:
+            return []
+        started = time.perf_counter()
+        mode = 'inline'
+        if self.workers <= 1 or len(items) < self.min_parallel_batch:
+            results = [_sign_item(item) for item in items]
+        else:
+            try:
+                chunk_size = min(self.chunk_size, max(1, len(items) // self.workers))
+                results = list(self._pool().map(_sign_item, items, chunksize=chunk_size))
+                mode = 'pool'
+            except BrokenProcessPool:
+                logging.warning("Signing pool broke, signing batch inline")
+                self.executor = None
+                results = [_sign_item(item) for item in items]
+
+        SIGNING_BATCHES.observe(time.perf_counter() - started, mode=mode)
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
@@ -1,30 +1,157 @@
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Signature import eddsa, pkcs1_15
 from Crypto.Hash import SHA256
 
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+except ImportError:
+    # pycryptodome's Ed25519 is used instead; it is correct but several times slower than RSA verification.
+    Ed25519PrivateKey = Ed25519PublicKey = None
+
+KEY_CACHE_SIZE = 1024
+PRIVATE_KEY_CACHE_SIZE = 256
+
+# Transactions name their signature scheme in an optional `scheme` field. One
+# without it is RSA-2048 PKCS#1 v1.5 with a PEM key, the original format.
+# Ed25519 keys are 32 raw bytes and signatures 64, both hex encoded.
+RSA_SCHEME = 'rsa'
+ED25519_SCHEME = 'ed25519'
+SCHEMES = (RSA_SCHEME, ED25519_SCHEME)
+
+_key_cache = OrderedDict()  # (scheme, key fingerprint) -> parsed public key
+_key_cache_lock = threading.Lock()
+_private_key_cache = OrderedDict()  # (scheme, sha256 of the private key text) -> parsed private key
+
+def transaction_scheme(transaction):
+    return transaction.get('scheme', RSA_SCHEME)
+
 # Helper functions for generating keys and signing transactions
-def generate_keys():
+def generate_keys(scheme=RSA_SCHEME):
+    if scheme == ED25519_SCHEME:
+        key = ECC.generate(curve='ed25519')
+        return key.seed.hex(), key.public_key().export_key(format='raw').hex()
+    if scheme != RSA_SCHEME:
+        raise ValueError(f'Unknown signature scheme: {scheme}')
     key = RSA.generate(2048)
     private_key = key.export_key().decode()
     public_key = key.publickey().export_key().decode()
     return private_key, public_key
 
-def sign_transaction(private_key, transaction_data):
-    key = RSA.import_key(private_key)
+def _import_private_key(private_key_str, scheme):
+    if scheme == ED25519_SCHEME:
+        seed = bytes.fromhex(private_key_str)
+        if Ed25519PrivateKey is not None:
+            return Ed25519PrivateKey.from_private_bytes(seed)
+        return eddsa.import_private_key(seed)
+    if scheme == RSA_SCHEME:
+        return RSA.import_key(private_key_str)
+    raise ValueError(f'Unknown signature scheme: {scheme}')
+
+def load_private_key(private_key_str, scheme=RSA_SCHEME):
+    # Parsing a PEM key costs more than an Ed25519 signature, so clients that
+    # sign repeatedly with one key only pay for it once. Entries are keyed by a
+    # hash, not by the key text.
+    cache_key = (scheme, hashlib.sha256(private_key_str.encode()).digest())
+    with _key_cache_lock:
+        key = _private_key_cache.get(cache_key)
+        if key is not None:
+            _private_key_cache.move_to_end(cache_key)
+            return key
+
+    key = _import_private_key(private_key_str, scheme)
+    with _key_cache_lock:
+        _private_key_cache[cache_key] = key
+        if len(_private_key_cache) > PRIVATE_KEY_CACHE_SIZE:
+            _private_key_cache.popitem(last=False)
+    return key
+
+def sign_transaction(private_key, transaction_data, scheme=RSA_SCHEME):
+    key = load_private_key(private_key, scheme)
+    if scheme == ED25519_SCHEME:
+        if Ed25519PrivateKey is not None:
+            return key.sign(transaction_data)
+        return eddsa.new(key, 'rfc8032').sign(transaction_data)
     hash_object = SHA256.new(transaction_data)
     signature = pkcs1_15.new(key).sign(hash_object)
     return signature
 
-def verify_signature(public_key_str, transaction_data, signature_hex):
+def transaction_payload(transaction):
+    """Return the bytes a transaction's signature covers.
+
+    A scheme tag and a fee are signed along with the rest, so they cannot be
+    added, changed or stripped without invalidating the signature.
+    """
+    payload = {
+        'sender': transaction['sender'],
+        'receiver': transaction['receiver'],
+        'amount': transaction['amount'],
+        'nonce': transaction['nonce']
+    }
+    for field in ('scheme', 'fee'):
+        if field in transaction:
+            payload[field] = transaction[field]
+    return json.dumps(payload, sort_keys=True).encode()
+
+def verification_item(transaction):
+    """The (public_key, payload, signature, scheme) tuple verify_signature takes."""
+    return transaction['public_key'], transaction_payload(transaction), transaction['signature'], \
+        transaction_scheme(transaction)
+
+def key_fingerprint(public_key_str):
+    return hashlib.sha256(public_key_str.encode()).hexdigest()
+
+def key_address(public_key_str):
+    # An account is named after the key that controls it, so only that key can spend from it.
+    return key_fingerprint(public_key_str)
+
+def _import_public_key(public_key_str, scheme):
+    if scheme == ED25519_SCHEME:
+        raw = bytes.fromhex(public_key_str)
+        if Ed25519PublicKey is not None:
+            return Ed25519PublicKey.from_public_bytes(raw)
+        return eddsa.import_public_key(raw)
+    if scheme == RSA_SCHEME:
+        return RSA.import_key(public_key_str)
+    raise ValueError(f'Unknown signature scheme: {scheme}')
+
+def load_public_key(public_key_str, scheme=RSA_SCHEME):
+    cache_key = (scheme, key_fingerprint(public_key_str))
+    with _key_cache_lock:
+        key = _key_cache.get(cache_key)
+        if key is not None:
+            _key_cache.move_to_end(cache_key)
+            return key
+
+    key = _import_public_key(public_key_str, scheme)
+    with _key_cache_lock:
+        _key_cache[cache_key] = key
+        if len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return key
+
+def verify_signature(public_key_str, transaction_data, signature_hex, scheme=RSA_SCHEME):
         try:
-            print('Verifying signature...')
-            public_key = RSA.import_key(public_key_str) # import public key
-            hash_object = SHA256.new(transaction_data)  # create sha256 hash object
+            public_key = load_public_key(public_key_str, scheme) # parsed keys are cached by fingerprint
             signature = bytes.fromhex(signature_hex) # convert signature to bytes
-            pkcs1_15.new(public_key).verify(hash_object, signature) # verify signature
-            print('Signature verified successfully')
+            if scheme == ED25519_SCHEME:
+                if Ed25519PublicKey is not None:
+                    try:
+                        public_key.verify(signature, transaction_data)
+                    except InvalidSignature:
+                        raise ValueError('Invalid Ed25519 signature')
+                else:
+                    eddsa.new(public_key, 'rfc8032').verify(transaction_data, signature)
+            else:
+                hash_object = SHA256.new(transaction_data)  # create sha256 hash object
+                pkcs1_15.new(public_key).verify(hash_object, signature) # verify signature
 
             return True
-        except (ValueError, TypeError) as e:
-            print(f'Signature verification failed: {str(e)}')
-            return False   
\ No newline at end of file
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.debug(f'Signature verification failed: {str(e)}')
+            return False
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import aiohttp
+
+from codec import CONTENT_TYPE, CodecError, encode_block, encode_transactions
+from metrics import Counter, Histogram
+
+ENCODERS = {'/receive_block': encode_block, '/receive_transactions': encode_transactions}
+
+DELIVERY_LATENCY = Histogram('blockchain_gossip_delivery_seconds', 'Round trip of one gossip message to a peer',
+                             labels=('peer', 'path'))
+DELIVERY_FAILURES = Counter('blockchain_gossip_failures_total', 'Gossip deliveries that will be retried',
+                            labels=('peer',))
+
+class PeerChannel:
+    def __init__(self, max_queue, json_only=False):
+        self.messages = deque(maxlen=max_queue)
+        self.wake = asyncio.Event()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.last_latency = None
+        self.avg_latency = None
+        self.json_only = json_only  # also set once the peer answers 415 to the binary codec
+
+    def record_latency(self, latency):
+        self.last_latency = latency
+        self.avg_latency = latency if self.avg_latency is None else 0.8 * self.avg_latency + 0.2 * latency
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.messages),
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'last_latency_ms': None if self.last_latency is None else round(self.last_latency * 1000, 2),
+            'avg_latency_ms': None if self.avg_latency is None else round(self.avg_latency * 1000, 2),
+            'backoff_seconds': round(max(0.0, self.backoff_until - time.monotonic()), 2),
+            'format': 'json' if self.json_only else 'binary'
+        }
+
+class Gossip:
+    """Outbound gossip running on an asyncio loop in a background thread.
+
+    publish_* only hands the message to the loop and returns. Each peer gets its own
+    ordered queue and worker. Deliveries share one keep-alive session, and their
+    concurrency is capped by a semaphore. Transactions are collected into batches for
+    /receive_transactions, and a bulk publish goes out whole. A peer that fails
+    backs off exponentially, and its queue keeps the newest `max_queue` messages. With `binary` set, messages are sent in
+    the binary codec, encoded once for all peers, and in JSON to peers that refuse it.
+    """
+
+    def __init__(self, node_address, get_peers, max_concurrency=16, timeout=5, batch_size=100,
+                 batch_interval=0.05, max_queue=1000, base_backoff=0.5, max_backoff=60, binary=True):
+        self.node_address = node_address
+        self.binary = binary
+        self.get_peers = get_peers
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_queue = max_queue
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.channels = {}
+        self.transaction_batch = []
+        self.session = None
+        self.semaphore = None
+        self._flush_handle = None
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='gossip', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop.run_forever()
+
+    def publish_block(self, block):
+        self.loop.call_soon_threadsafe(self._enqueue, '/receive_block', block)
+
+    def publish_transaction(self, transaction):
+        self.publish_transactions([transaction])
+
+    def publish_transactions(self, transactions):
+        self.loop.call_soon_threadsafe(self._add_to_batch, list(transactions))
+
+    def _add_to_batch(self, transactions):
+        if len(transactions) >= self.batch_size:
+            # A bulk submission is already a batch: it goes out as one message,
+            # after the transactions that were waiting so order is kept.
+            self._flush_transactions()
+            self._enqueue('/receive_transactions', transactions)
+            return
+        self.transaction_batch.extend(transactions)
+        if len(self.transaction_batch) >= self.batch_size:
+            self._flush_transactions()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.batch_interval, self._flush_transactions)
+
+    def _flush_transactions(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self.transaction_batch:
+            batch = self.transaction_batch[:self.batch_size]
+            del self.transaction_batch[:self.batch_size]
+            self._enqueue('/receive_transactions', batch)
+
+    def _enqueue(self, path, payload):
+        encoded = None
+        if self.binary:
+            try:
+                encoded = ENCODERS[path](payload)
+            except CodecError as e:
+                logging.debug(f"Sending {path} as JSON: {str(e)}")
+
+        for peer in list(self.get_peers()):
+            if peer == self.node_address:
+                continue
+            channel = self.channels.get(peer)
+            if channel is None:
+                channel = self.channels[peer] = PeerChannel(self.max_queue, json_only=not self.binary)
+                self.loop.create_task(self._peer_worker(peer, channel))
+            if len(channel.messages) == channel.messages.maxlen:
+                channel.dropped += 1
+            channel.messages.append((path, payload, encoded))
+            channel.wake.set()
+
+    async def _peer_worker(self, peer, channel):
+        while True:
+            await channel.wake.wait()
+            while channel.messages:
+                delay = channel.backoff_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                path, payload, encoded = channel.messages[0]
+                async with self.semaphore:
+                    delivered = await self._deliver(peer, path, payload, encoded, channel)
+
+                if delivered:
+                    if channel.messages and channel.messages[0][1] is payload:
+                        channel.messages.popleft()
+                    channel.failures = 0
+                else:
+                    channel.failed += 1
+                    channel.failures += 1
+                    backoff = min(self.max_backoff, self.base_backoff * 2 ** (channel.failures - 1))
+                    channel.backoff_until = time.monotonic() + backoff
+            channel.wake.clear()
+
+    async def _deliver(self, peer, path, payload, encoded, channel):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=30)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        binary = encoded is not None and not channel.json_only
+        if binary:
+            request = {'data': encoded, 'headers': {'Content-Type': CONTENT_TYPE}}
+        else:
+            request = {'json': payload}
+
+        start = time.monotonic()
+        try:
+            async with self.session.post(f'http://{peer}{path}', **request) as response:
+                body = await response.text()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Failed to gossip {path} to {peer}: {str(e) or type(e).__name__}")
+            DELIVERY_FAILURES.inc(peer=peer)
+            return False
+
+        latency = time.monotonic() - start
+        channel.record_latency(latency)
+        DELIVERY_LATENCY.observe(latency, peer=peer, path=path)
+        if status == 415 and binary:
+            logging.info(f"Peer {peer} does not accept the binary codec, falling back to JSON")
+            channel.json_only = True
+            return await self._deliver(peer, path, payload, None, channel)
+        if status >= 500:
+            logging.warning(f"Peer {peer} failed on {path}: {status}")
+            DELIVERY_FAILURES.inc(peer=peer)
+            return False
+        if status >= 400:
+            # The peer rejected the message itself, so retrying will not help.
+            logging.info(f"Peer {peer} rejected {path}: {body[:200]}")
+        channel.sent += 1
+        return True
+
+    def stats(self):
+        return {
+            'peers': {peer: channel.stats() for peer, channel in list(self.channels.items())},
+            'batched_transactions': len(self.transaction_batch)
+        }
+
+    def close(self):
+        async def shutdown():
+            if self.session is not None:
+                await self.session.close()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(timeout=self.timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=self.timeout)
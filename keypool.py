@@ -0,0 +1,97 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from crypto_pool import process_context
+from crypto_utils import RSA_SCHEME, generate_keys
+from metrics import Counter, Gauge
+
+KEYS_SERVED = Counter('blockchain_keys_served_total', 'Keypairs handed out by /generate_keys', labels=('source',))
+KEYS_AVAILABLE = Gauge('blockchain_keypool_available', 'Pre-generated keypairs waiting to be handed out')
+
+class KeyPool:
+    """Keypairs generated ahead of time, so /generate_keys does not wait for RSA.generate.
+
+    A background thread keeps up to `size` keypairs per pooled scheme, generated
+    on `workers` processes so the prime search does not compete with request
+    threads for the GIL. Every keypair is handed out once. When a queue runs
+    dry the caller generates its own keypair inline. Ed25519 keys take
+    microseconds to generate, so only RSA is pooled by default.
+    """
+
+    def __init__(self, size=16, schemes=(RSA_SCHEME,), workers=1, retry_delay=5):
+        self.size = size
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.queues = {scheme: queue.Queue(maxsize=size) for scheme in schemes}
+        self.executor = None
+        self.thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        KEYS_AVAILABLE.set_function(self.available)
+
+    def available(self):
+        return sum(keys.qsize() for keys in self.queues.values())
+
+    def start(self):
+        if self.size > 0 and self.thread is None:
+            self._stop.clear()
+            self.thread = threading.Thread(target=self._refill, name='keypool', daemon=True)
+            self.thread.start()
+        return self
+
+    def get(self, scheme=RSA_SCHEME):
+        keys = self.queues.get(scheme)
+        if keys is not None:
+            try:
+                keypair = keys.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self._wake.set()
+                KEYS_SERVED.inc(source='pool')
+                return keypair
+            self._wake.set()
+        KEYS_SERVED.inc(source='inline')
+        return generate_keys(scheme)
+
+    def _refill(self):
+        while not self._stop.is_set():
+            try:
+                self._fill_once()
+            except BrokenProcessPool:
+                logging.warning("Key generation pool broke, restarting it")
+                self.executor = None
+                self._stop.wait(self.retry_delay)
+                continue
+            except Exception as e:
+                logging.error(f"Key generation failed: {str(e)}")
+                self._stop.wait(self.retry_delay)
+                continue
+            self._wake.wait()
+            self._wake.clear()
+
+    def _fill_once(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=process_context())
+        for scheme, keys in self.queues.items():
+            missing = keys.maxsize - keys.qsize()
+            futures = [self.executor.submit(generate_keys, scheme) for _ in range(missing)]
+            for future in as_completed(futures):
+                if self._stop.is_set():
+                    return
+                try:
+                    keys.put_nowait(future.result())
+                except queue.Full:
+                    break
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,217 @@
+import hashlib
+import heapq
+import itertools
+import json
+import threading
+from bisect import insort
+from crypto_utils import transaction_payload
+from state import transaction_cost, valid_amount, valid_fee, valid_nonce
+
+def transaction_id(transaction):
+    """Hex SHA-256 of the canonical transaction, the same value as its Merkle leaf."""
+    return hashlib.sha256(json.dumps(transaction, sort_keys=True).encode()).hexdigest()
+
+class MempoolEntry:
+    __slots__ = ('txid', 'transaction', 'sender', 'nonce', 'fee', 'size', 'seq')
+
+    def __init__(self, txid, transaction, size, seq):
+        self.txid = txid
+        self.transaction = transaction
+        self.sender = transaction['sender']
+        self.nonce = transaction['nonce']
+        self.fee = transaction.get('fee', 0)
+        self.size = size
+        self.seq = seq
+
+class Mempool:
+    """Pending transactions, deduplicated by signed payload and queued per sender in nonce order.
+
+    Priority is the optional, signed `fee` field, then arrival order. A
+    transaction that reuses a pending (sender, nonce) replaces the old one only
+    if its fee is strictly higher. Once `max_count` or `max_bytes` is exceeded, the lowest-priority
+    transactions are evicted.
+    """
+
+    def __init__(self, max_count=50000, max_bytes=64 * 1024 * 1024):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.entries = {}  # txid -> MempoolEntry
+        self.by_sender = {}  # sender -> {nonce: txid}
+        self.sender_nonces = {}  # sender -> sorted pending nonces
+        self.sender_spend = {}  # sender -> total amount plus fees of their pending transactions
+        self.size_bytes = 0
+        self._eviction_heap = []  # (fee, -seq, txid), stale items are skipped lazily
+        self._heads = []  # (-fee, seq, token, sender) for each sender's lowest pending nonce
+        self._head_tokens = {}  # sender -> token of their current item in _heads; older items are stale
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def add(self, transaction):
+        """Return (accepted, reason)."""
+        encoded = json.dumps(transaction, sort_keys=True).encode()
+        txid = hashlib.sha256(encoded).hexdigest()
+
+        entry = MempoolEntry(txid, transaction, len(encoded), next(self._seq))
+        # Fees order the queues, nonces key them and amounts add up to the
+        # pending spend, so none of them may be anything arithmetic could fail on.
+        if not valid_amount(transaction['amount']):
+            return False, 'invalid amount'
+        if not valid_fee(entry.fee):
+            return False, 'invalid fee'
+        if not valid_nonce(entry.nonce):
+            return False, 'invalid nonce'
+        with self._lock:
+            existing_txid = self.by_sender.get(entry.sender, {}).get(entry.nonce)
+            if existing_txid is not None:
+                # A copy with other unsigned fields, or another signature of the
+                # same payload, is still the same transaction.
+                existing = self.entries[existing_txid]
+                if transaction_payload(existing.transaction) == transaction_payload(transaction):
+                    return False, 'duplicate'
+                if entry.fee <= existing.fee:
+                    return False, 'replacement fee too low'
+                self._remove(existing_txid)
+
+            self.entries[txid] = entry
+            self.by_sender.setdefault(entry.sender, {})[entry.nonce] = txid
+            queue = self.sender_nonces.setdefault(entry.sender, [])
+            insort(queue, entry.nonce)
+            if queue[0] == entry.nonce:
+                self._push_head(entry.sender)
+            self.sender_spend[entry.sender] = self.sender_spend.get(entry.sender, 0) + transaction_cost(transaction)
+            self.size_bytes += entry.size
+            heapq.heappush(self._eviction_heap, (entry.fee, -entry.seq, txid))
+
+            self._evict()
+            if txid not in self.entries:
+                return False, 'mempool full'
+            return True, 'replaced' if existing_txid is not None else 'added'
+
+    def _evict(self):
+        while len(self.entries) > self.max_count or self.size_bytes > self.max_bytes:
+            _, _, txid = heapq.heappop(self._eviction_heap)
+            if txid in self.entries:
+                self._remove(txid)
+
+    def _remove(self, txid):
+        entry = self.entries.pop(txid)
+        self.size_bytes -= entry.size
+
+        nonces = self.by_sender[entry.sender]
+        del nonces[entry.nonce]
+        queue = self.sender_nonces[entry.sender]
+        was_head = queue[0] == entry.nonce
+        queue.remove(entry.nonce)
+        self.sender_spend[entry.sender] -= transaction_cost(entry.transaction)
+        if not nonces:
+            del self.by_sender[entry.sender]
+            del self.sender_nonces[entry.sender]
+            del self.sender_spend[entry.sender]
+            del self._head_tokens[entry.sender]
+        elif was_head:
+            self._push_head(entry.sender)
+
+        if len(self._eviction_heap) > 2 * len(self.entries) + 64:
+            self._eviction_heap = [item for item in self._eviction_heap if item[2] in self.entries]
+            heapq.heapify(self._eviction_heap)
+        return entry
+
+    def _push_head(self, sender):
+        entry = self.entries[self.by_sender[sender][self.sender_nonces[sender][0]]]
+        token = next(self._seq)
+        self._head_tokens[sender] = token
+        heapq.heappush(self._heads, (-entry.fee, entry.seq, token, sender))
+        if len(self._heads) > 2 * len(self._head_tokens) + 64:
+            self._heads = [item for item in self._heads if self._head_tokens.get(item[3]) == item[2]]
+            heapq.heapify(self._heads)
+
+    def remove(self, txids):
+        with self._lock:
+            for txid in txids:
+                if txid in self.entries:
+                    self._remove(txid)
+
+    def remove_confirmed(self, transactions):
+        # Drops confirmed transactions along with any pending transaction whose
+        # nonce is no longer above its sender's confirmed nonce.
+        with self._lock:
+            confirmed_nonces = {}
+            for transaction in transactions:
+                txid = transaction_id(transaction)
+                if txid in self.entries:
+                    self._remove(txid)
+                sender = transaction['sender']
+                confirmed_nonces[sender] = max(transaction['nonce'], confirmed_nonces.get(sender, transaction['nonce']))
+
+            for sender, nonce in confirmed_nonces.items():
+                queue = self.sender_nonces.get(sender)
+                while queue and queue[0] <= nonce:
+                    self._remove(self.by_sender[sender][queue[0]])
+
+    def remove_unfunded(self, balance, senders=None):
+        # Walks each sender's queue in nonce order and drops the transactions
+        # that `balance(sender)` no longer covers after the ones before them.
+        with self._lock:
+            senders = list(self.sender_nonces) if senders is None else senders
+            for sender in senders:
+                available = balance(sender)
+                for nonce in list(self.sender_nonces.get(sender, ())):
+                    txid = self.by_sender[sender][nonce]
+                    cost = transaction_cost(self.entries[txid].transaction)
+                    if cost > available:
+                        self._remove(txid)
+                    else:
+                        available -= cost
+
+    def get(self, txid):
+        entry = self.entries.get(txid)
+        return None if entry is None else entry.transaction
+
+    def pending_spend(self, sender):
+        return self.sender_spend.get(sender, 0)
+
+    def pending_nonce(self, sender):
+        queue = self.sender_nonces.get(sender)
+        return queue[-1] if queue else None
+
+    def select(self, limit=None):
+        """Return up to `limit` transactions by priority, keeping each sender's nonce order.
+
+        Only the head of each sender's queue competes at a time. The heap of
+        heads is kept up to date as transactions come and go; a call pops the
+        heads it takes and pushes them back, so it costs O(limit * log(senders))
+        rather than a pass over every sender.
+        """
+        with self._lock:
+            limit = len(self.entries) if limit is None else limit
+            heads = self._heads
+            taken = []
+            followers = []  # (-fee, seq, sender, position) for the next transaction of a taken sender
+
+            selected = []
+            while len(selected) < limit:
+                while heads and self._head_tokens.get(heads[0][3]) != heads[0][2]:
+                    heapq.heappop(heads)  # stale
+                if heads and (not followers or heads[0][:2] < followers[0][:2]):
+                    item = heapq.heappop(heads)
+                    taken.append(item)
+                    sender, position = item[3], 0
+                elif followers:
+                    _, _, sender, position = heapq.heappop(followers)
+                else:
+                    break
+                queue = self.sender_nonces[sender]
+                selected.append(self.entries[self.by_sender[sender][queue[position]]].transaction)
+                if position + 1 < len(queue):
+                    entry = self.entries[self.by_sender[sender][queue[position + 1]]]
+                    heapq.heappush(followers, (-entry.fee, entry.seq, sender, position + 1))
+
+            for item in taken:
+                heapq.heappush(heads, item)
+            return selected
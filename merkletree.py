@@ -1,57 +1,117 @@
 import hashlib
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional
+
+HASH_SIZE = 32
 
 class MerkleTree:
+    """Merkle tree whose levels are stored as contiguous buffers of 32-byte digests.
+
+    Level 0 holds the leaf hashes and the last level holds the root. An odd node
+    at the end of a level is paired with itself.
+    """
+
     def __init__(self, transactions: List[dict]):
-        self.transactions = transactions
-        self.tree = self.build_tree()
-
-    def build_tree(self) -> List[List[str]]:
-        tree = [self.hash_transaction(tx) for tx in self.transactions]
-        
-        while len(tree) > 1:
-            tree = self.build_tree_level(tree)
-        
-        return tree
-
-    def build_tree_level(self, level: List[str]) -> List[str]:
-        new_level = []
-        for i in range(0, len(level), 2):
-            left = level[i]
-            right = level[i + 1] if i + 1 < len(level) else left
-            new_level.append(self.hash_pair(left, right))
+        self.transactions = list(transactions)
+        self.leaf_index: Dict[bytes, int] = {}
+        self.levels: List[bytearray] = []
+        self.build_tree()
+
+    def build_tree(self) -> List[bytearray]:
+        leaf_hash = self.leaf_hash
+        leaves = [leaf_hash(tx) for tx in self.transactions]
+        self.leaf_index = {}
+        for position, leaf in enumerate(leaves):
+            self.leaf_index.setdefault(leaf, position)
+
+        self.levels = []
+        level = bytearray(b''.join(leaves))
+        if level:
+            self.levels.append(level)
+        while len(level) > HASH_SIZE:
+            level = self.build_tree_level(level)
+            self.levels.append(level)
+        return self.levels
+
+    def build_tree_level(self, level: bytearray) -> bytearray:
+        sha256 = hashlib.sha256
+        view = memoryview(level)
+        new_level = bytearray()
+        for i in range(0, len(level), 2 * HASH_SIZE):
+            pair = view[i:i + 2 * HASH_SIZE]
+            if len(pair) == HASH_SIZE:
+                pair = bytes(pair) * 2
+            new_level += sha256(pair).digest()
         return new_level
 
-    def hash_transaction(self, transaction: dict) -> str:
-        return hashlib.sha256(json.dumps(transaction, sort_keys=True).encode()).hexdigest()
+    def append(self, transaction: dict) -> None:
+        """Add a leaf and rehash only the path from it to the root."""
+        leaf = self.leaf_hash(transaction)
+        index = len(self.transactions)
+        self.transactions.append(transaction)
+        self.leaf_index.setdefault(leaf, index)
+
+        if not self.levels:
+            self.levels.append(bytearray(leaf))
+            return
+        self.levels[0] += leaf
 
-    def hash_pair(self, left: str, right: str) -> str:
-        return hashlib.sha256(f"{left}{right}".encode()).hexdigest()
+        depth = 0
+        while len(self.levels[depth]) > HASH_SIZE:
+            if depth + 1 == len(self.levels):
+                self.levels.append(bytearray())
+            index //= 2
+            offset = index * HASH_SIZE
+            self.levels[depth + 1][offset:offset + HASH_SIZE] = self.node_hash(self.levels[depth], index)
+            depth += 1
+        del self.levels[depth + 1:]
+
+    def node_hash(self, level: bytearray, parent: int) -> bytes:
+        left = parent * 2 * HASH_SIZE
+        pair = level[left:left + 2 * HASH_SIZE]
+        if len(pair) == HASH_SIZE:
+            pair = pair * 2
+        return hashlib.sha256(pair).digest()
+
+    def leaf_hash(self, transaction: dict) -> bytes:
+        return hashlib.sha256(json.dumps(transaction, sort_keys=True).encode()).digest()
+
+    def hash_transaction(self, transaction: dict) -> str:
+        return self.leaf_hash(transaction).hex()
 
     def get_root(self) -> str:
-        return self.tree[0] if self.tree else ""
+        return self.levels[-1].hex() if self.levels else ""
 
     def get_proof(self, transaction: dict) -> List[Dict[str, str]]:
-        tx_hash = self.hash_transaction(transaction)
-        index = self.transactions.index(transaction)
+        proof = self.get_proof_by_hash(self.hash_transaction(transaction))
+        if proof is None:
+            raise ValueError('transaction is not in the tree')
+        return proof
+
+    def get_proof_by_hash(self, tx_hash: str) -> Optional[List[Dict[str, str]]]:
+        index = self.leaf_index.get(bytes.fromhex(tx_hash))
+        if index is None:
+            return None
+
         proof = []
-        for level in range(len(self.tree)):
-            companion_index = index + 1 if index % 2 == 0 else index - 1
-            if companion_index < len(self.tree[level]):
-                proof.append({
-                    'position': 'right' if index % 2 == 0 else 'left',
-                    'data': self.tree[level][companion_index]
-                })
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling * HASH_SIZE >= len(level):
+                sibling = index
+            proof.append({
+                'position': 'right' if index % 2 == 0 else 'left',
+                'data': level[sibling * HASH_SIZE:(sibling + 1) * HASH_SIZE].hex()
+            })
             index //= 2
         return proof
 
     @staticmethod
     def verify_proof(tx_hash: str, proof: List[Dict[str, str]], root: str) -> bool:
-        result = tx_hash
+        result = bytes.fromhex(tx_hash)
         for step in proof:
+            data = bytes.fromhex(step['data'])
             if step['position'] == 'right':
-                result = hashlib.sha256(f"{result}{step['data']}".encode()).hexdigest()
+                result = hashlib.sha256(result + data).digest()
             else:
-                result = hashlib.sha256(f"{step['data']}{result}".encode()).hexdigest()
-        return result == root
\ No newline at end of file
+                result = hashlib.sha256(data + result).digest()
+        return result.hex() == root
@@ -0,0 +1,231 @@
+import bisect
+import functools
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+class Registry:
+    """Every metric of the process, rendered in the Prometheus text format for /metrics."""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}  # tuple of label values -> value
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self.values[()] = self.initial_value()  # exported as zero before the first update
+        registry.register(self)
+
+    def initial_value(self):
+        return 0
+
+    def key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield '', dict(zip(self.label_names, key)), value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        # The value is read from `function` at every scrape, e.g. the size of a pool.
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield '', {}, self.function()
+            return
+        yield from super().samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, help, labels, registry)
+
+    def initial_value(self):
+        # Per-bucket counts, made cumulative when rendered, then the sum.
+        return [[0] * len(self.buckets), 0.0]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = self.initial_value()
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            labels = dict(zip(self.label_names, key))
+            for bound, count in zip(self.buckets, itertools.accumulate(counts)):
+                yield '_bucket', dict(labels, le=format_value(float(bound))), count
+            yield '_sum', labels, total
+            yield '_count', labels, sum(counts)
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Span:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.id = next(self.tracer.ids)
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.tracer.stack().pop()
+        record = {
+            'id': self.id,
+            'parent': self.parent,
+            'name': self.name,
+            'start': round(self.started, 6),
+            'duration_ms': round(duration * 1000, 3),
+            'thread': threading.current_thread().name,
+            'attributes': self.attributes
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self.tracer.spans.append(record)
+        logging.debug(f"span {self.name} took {record['duration_ms']} ms")
+        return False
+
+class Tracer:
+    """Optional spans kept in a ring buffer for /traces.
+
+    While disabled, span() returns a shared no-op object, so instrumented code
+    pays one attribute check per call.
+    """
+
+    def __init__(self, max_spans=1000):
+        self.enabled = False
+        self.spans = deque(maxlen=max_spans)
+        self.ids = itertools.count(1)
+        self._local = threading.local()
+
+    def enable(self, max_spans=None):
+        if max_spans is not None:
+            self.spans = deque(self.spans, maxlen=max_spans)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attributes)
+
+TRACER = Tracer()
+
+def traced(name):
+    """Wrap a function in a span named `name` while tracing is enabled."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            with Span(TRACER, name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
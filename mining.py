@@ -0,0 +1,201 @@
+import hashlib
+import os
+import logging
+import queue
+import threading
+import time
+from crypto_pool import process_context
+
+# Number of nonces a search loop tries between checks of its stop signal
+CHECK_INTERVAL = 4096
+
+def difficulty_target(difficulty):
+    """Return the proof-of-work target as 32 big-endian bytes.
+
+    Difficulty may be fractional, e.g. 20.5 bits means a target of 2 ** 235.5.
+    """
+    target = min(int(2 ** (256 - difficulty)), 2 ** 256 - 1)
+    return target.to_bytes(32, 'big')
+
+def block_work(difficulty):
+    """Expected number of hashes needed to meet the target for `difficulty`."""
+    target = int.from_bytes(difficulty_target(difficulty), 'big')
+    return 2 ** 256 // (target + 1)
+
+def check_proof(previous_nonce, nonce, difficulty):
+    digest = hashlib.sha256(hashlib.sha256(f"{previous_nonce}{nonce}".encode()).digest()).digest()
+    return digest < difficulty_target(difficulty)
+
+def search_nonce(previous_nonce, difficulty, start=0, step=1, stop_event=None):
+    # Digests and the target are both 32 bytes, so comparing them as bytes is
+    # the same as comparing them as big-endian integers, without the hex round-trip.
+    target = difficulty_target(difficulty)
+    prefix = hashlib.sha256(str(previous_nonce).encode())
+    sha256 = hashlib.sha256
+    nonce = start
+
+    while True:
+        for _ in range(CHECK_INTERVAL):
+            inner = prefix.copy()
+            inner.update(b'%d' % nonce)
+            if sha256(inner.digest()).digest() < target:
+                return nonce
+            nonce += step
+        if stop_event is not None and stop_event.is_set():
+            return None
+
+class AnyEvent:
+    """Reads as set once any of the given events is set."""
+
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+
+    def is_set(self):
+        return any(event.is_set() for event in self.events)
+
+class SingleProcessEngine:
+    name = 'single'
+    workers = 1
+
+    def search(self, previous_nonce, difficulty, stop_event=None):
+        return search_nonce(previous_nonce, difficulty, stop_event=stop_event)
+
+    def resize(self, workers):
+        pass
+
+    def close(self):
+        pass
+
+_worker_stop = None
+
+def _init_worker(stop_event):
+    global _worker_stop
+    _worker_stop = stop_event
+
+def _search_slice(previous_nonce, difficulty, start, step):
+    return search_nonce(previous_nonce, difficulty, start, step, _worker_stop)
+
+class ParallelEngine:
+    name = 'parallel'
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.context = process_context()
+        self.stop_event = self.context.Event()
+        self.lock = threading.Lock()  # held by a search, so resize cannot replace the pool under it
+        self.pool = self._start_pool()
+
+    def _start_pool(self):
+        return self.context.Pool(self.workers, initializer=_init_worker, initargs=(self.stop_event,))
+
+    def search(self, previous_nonce, difficulty, stop_event=None):
+        # Worker i tries nonces i, i + workers, i + 2 * workers, ... until one
+        # of them finds a solution or `stop_event` is set; either way the shared
+        # stop event is raised so every worker returns. A worker that fails
+        # fails the search; None means only that it was cancelled.
+        with self.lock:
+            self.stop_event.clear()
+            found = queue.Queue()
+            results = [
+                self.pool.apply_async(_search_slice, (previous_nonce, difficulty, i, self.workers), callback=found.put,
+                                      error_callback=found.put)
+                for i in range(self.workers)
+            ]
+
+            nonce = error = None
+            pending = len(results)
+            while pending:
+                try:
+                    nonce = found.get(timeout=0.05)
+                except queue.Empty:
+                    if stop_event is not None and stop_event.is_set():
+                        break
+                    continue
+                pending -= 1
+                if isinstance(nonce, BaseException):
+                    nonce, error = None, nonce
+                if nonce is not None or error is not None:
+                    break
+
+            self.stop_event.set()
+            for result in results:
+                result.wait()
+            if error is not None:
+                raise RuntimeError(f"Mining worker failed: {error}") from error
+            return nonce
+
+    def resize(self, workers):
+        # Cancels the search in progress, which mine_block restarts on the new pool.
+        workers = workers or os.cpu_count() or 1
+        while not self.lock.acquire(timeout=0.05):
+            self.stop_event.set()
+        try:
+            if workers != self.workers:
+                self.pool.terminate()
+                self.pool.join()
+                self.workers = workers
+                self.pool = self._start_pool()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+ENGINES = {
+    SingleProcessEngine.name: SingleProcessEngine,
+    ParallelEngine.name: ParallelEngine,
+}
+
+def create_engine(name='single', workers=None):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown mining engine: {name}")
+    if name == ParallelEngine.name:
+        return ParallelEngine(workers)
+    return ENGINES[name]()
+
+class BackgroundMiner:
+    """Runs a mine-block callable on a worker thread and reports its progress."""
+
+    def __init__(self, mine_block):
+        self.mine_block = mine_block
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.status = {'state': 'idle', 'blocks_mined': 0}
+
+    def start(self, engine=None, blocks=1):
+        """Mine `blocks` blocks, or keep mining until stopped if `blocks` is None."""
+        if self.thread is not None and self.thread.is_alive():
+            return self.status
+        self.stop_event.clear()
+        self.status = {
+            'state': 'mining',
+            'engine': getattr(engine, 'name', None),
+            'target_blocks': blocks,
+            'blocks_mined': 0,
+            'started': time.time()
+        }
+        self.thread = threading.Thread(target=self._run, args=(engine, blocks), name='miner', daemon=True)
+        self.thread.start()
+        return self.status
+
+    def stop(self):
+        # Also cancels the search in progress.
+        self.stop_event.set()
+        return self.status
+
+    def _run(self, engine, blocks):
+        status = self.status
+        try:
+            while not self.stop_event.is_set() and (blocks is None or status['blocks_mined'] < blocks):
+                block = self.mine_block(engine, self.stop_event)
+                if block is None:
+                    break
+                status['blocks_mined'] += 1
+                status['last_block'] = {'index': block['index'], 'block_time': block['block_time']}
+            status['state'] = 'stopped' if self.stop_event.is_set() else 'finished'
+        except Exception as e:
+            logging.error(f"Background mining failed: {str(e)}")
+            status['state'] = 'failed'
+            status['error'] = str(e)
+        status['finished'] = time.time()
@@ -0,0 +1,185 @@
+import argparse
+import datetime
+import json
+import math
+import random
+import statistics
+from collections import deque
+from itertools import islice
+
+EPOCH = datetime.datetime(1970, 1, 1)
+PRECISION = 4  # decimal places kept in a block's difficulty
+
+def parse_timestamp(timestamp):
+    """Seconds for a block timestamp, either a number or str(datetime)."""
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    # Block timestamps are naive UTC. One with an offset is refused rather than
+    # converted, so every node reads the same string as the same instant.
+    parsed = datetime.datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is not None:
+        raise ValueError('block timestamps carry no time zone')
+    return (parsed - EPOCH).total_seconds()
+
+def utc_now():
+    # Naive UTC, the clock and format of the timestamps of mined blocks.
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def current_time():
+    return (utc_now() - EPOCH).total_seconds()
+
+class Retarget:
+    """Next-block difficulty derived from a moving window of block timestamps.
+
+    Difficulty is a fractional number of bits; the proof-of-work target is
+    2 ** (256 - difficulty). The next difficulty scales the average work of
+    the last `window` blocks by how far their timespan is from `window *
+    target_time`. The timespan is clamped to `max_factor` of that, and one
+    block can move the difficulty by at most `max_step` bits. Only the chain
+    is needed, so every node computes the same value.
+
+    Because the timestamps decide the difficulty, a block's timestamp must be
+    later than the median of its last `median_span` ancestors and at most
+    `max_future_drift` seconds ahead of our clock.
+    """
+
+    def __init__(self, target_time=2, window=30, max_factor=4, max_step=1.0, min_difficulty=1,
+                 initial_difficulty=20, median_span=11, max_future_drift=120):
+        self.target_time = target_time
+        self.window = window
+        self.max_factor = max_factor
+        self.max_step = max_step
+        self.min_difficulty = min_difficulty
+        self.initial_difficulty = initial_difficulty
+        self.median_span = median_span
+        self.max_future_drift = max_future_drift
+
+    def window_start(self, height):
+        """First height whose header is needed for the difficulty of block `height`."""
+        return max(0, height - self.window - 1)
+
+    def valid_timestamp(self, headers, timestamp, now=None):
+        """Whether a block after `headers` (its ancestors, oldest first) may carry `timestamp`."""
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float, str)):
+            return False
+        try:
+            seconds = parse_timestamp(timestamp)
+        except ValueError:
+            return False
+        if not math.isfinite(seconds):
+            return False
+        if seconds > (current_time() if now is None else now) + self.max_future_drift:
+            return False
+        recent = [parse_timestamp(header['timestamp']) for header in list(headers)[-self.median_span:]]
+        return not recent or seconds > statistics.median(recent)
+
+    def next_difficulty(self, headers):
+        """`headers` are the blocks or headers from window_start(height) up to the parent, oldest first."""
+        if not headers:
+            return self.initial_difficulty
+        parent_difficulty = headers[-1]['difficulty']
+        intervals = len(headers) - 1
+        if intervals == 0:
+            return parent_difficulty
+
+        expected = intervals * self.target_time
+        timespan = parse_timestamp(headers[-1]['timestamp']) - parse_timestamp(headers[0]['timestamp'])
+        timespan = min(max(timespan, expected / self.max_factor), expected * self.max_factor)
+
+        # Average work per block over the blocks whose solve times were measured.
+        work = sum(2.0 ** header['difficulty'] for header in islice(headers, 1, None))
+        difficulty = math.log2(work / intervals * expected / timespan)
+
+        difficulty = min(max(difficulty, parent_difficulty - self.max_step), parent_difficulty + self.max_step)
+        return round(max(difficulty, self.min_difficulty), PRECISION)
+
+def legacy_difficulty(difficulty, block_time, target_time):
+    # The previous rule: one bit up or down based on the last block time alone.
+    if block_time < target_time * 0.8:
+        difficulty += 1
+    elif block_time > target_time * 1.2:
+        difficulty -= 1
+    return max(difficulty, 1)
+
+HASHRATE_CURVES = {
+    'constant': lambda progress, factor: 1.0,
+    'step': lambda progress, factor: factor if progress >= 0.5 else 1.0,
+    'ramp': lambda progress, factor: 1.0 + (factor - 1.0) * progress,
+    'spike': lambda progress, factor: factor if 0.45 <= progress < 0.55 else 1.0,
+    'sine': lambda progress, factor: 1.0 + (factor - 1.0) * (1 + math.sin(progress * 8 * math.pi)) / 2,
+}
+
+def simulate(retarget, curve, blocks, hashrate, factor=10.0, rule='window', seed=None):
+    """Mine `blocks` synthetic blocks; hash rate follows `curve` as a multiple of `hashrate` per second."""
+    rng = random.Random(seed)
+    scale = HASHRATE_CURVES[curve]
+    headers = deque(maxlen=retarget.window + 1)
+    now = 0.0
+    difficulty = retarget.initial_difficulty
+    block_times = []
+    difficulties = []
+
+    for height in range(blocks):
+        rate = hashrate * scale(height / blocks, factor)
+        block_time = rng.expovariate(1.0) * 2.0 ** difficulty / rate
+        now += block_time
+        headers.append({'timestamp': now, 'difficulty': difficulty})
+        block_times.append(block_time)
+        difficulties.append(difficulty)
+        if rule == 'legacy':
+            difficulty = legacy_difficulty(difficulty, block_time, retarget.target_time)
+        else:
+            difficulty = retarget.next_difficulty(headers)
+
+    return block_times, difficulties
+
+def summarize(block_times, difficulties, target_time):
+    ordered = sorted(block_times)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    mean = statistics.fmean(block_times)
+    return {
+        'blocks': len(block_times),
+        'mean_block_time': round(mean, 3),
+        'stdev_block_time': round(statistics.pstdev(block_times), 3),
+        'p50_block_time': round(percentile(0.5), 3),
+        'p90_block_time': round(percentile(0.9), 3),
+        'p99_block_time': round(percentile(0.99), 3),
+        'max_block_time': round(ordered[-1], 3),
+        'mean_abs_error': round(statistics.fmean(abs(t - target_time) for t in block_times), 3),
+        'min_difficulty': round(min(difficulties), 3),
+        'max_difficulty': round(max(difficulties), 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay synthetic hash-rate curves against the difficulty rules.')
+    parser.add_argument('--curve', choices=sorted(HASHRATE_CURVES), default='step')
+    parser.add_argument('--factor', type=float, default=10.0, help='peak hash rate as a multiple of the base rate')
+    parser.add_argument('--blocks', type=int, default=5000)
+    parser.add_argument('--hashrate', type=float, default=2.0 ** 20, help='base hashes per second')
+    parser.add_argument('--target-time', type=float, default=2)
+    parser.add_argument('--window', type=int, default=30)
+    parser.add_argument('--max-step', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    retarget = Retarget(target_time=args.target_time, window=args.window, max_step=args.max_step,
+                        initial_difficulty=round(math.log2(args.hashrate * args.target_time)))
+    report = {}
+    for rule in ('window', 'legacy'):
+        block_times, difficulties = simulate(retarget, args.curve, args.blocks, args.hashrate, args.factor,
+                                             rule, args.seed)
+        report[rule] = summarize(block_times, difficulties, args.target_time)
+
+    if args.json:
+        print(json.dumps({'curve': args.curve, 'factor': args.factor, 'results': report}, indent=2))
+        return
+    print(f"curve={args.curve} factor={args.factor} blocks={args.blocks} target={args.target_time}s")
+    for rule, summary in report.items():
+        print(f"{rule:>8}: " + ', '.join(f"{key}={value}" for key, value in summary.items() if key != 'blocks'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import hashlib
+import json
+
+SNAPSHOT_VERSION = 1
+
+# A state snapshot holds the balances and confirmed nonces after the first
+# `height` blocks, plus the header of every one of those blocks, so a node can
+# start from it, validate only the blocks that follow, and still compare chain
+# work and serve headers. The commitment is the double SHA-256 of the canonical
+# JSON of everything else in the file. Block headers cannot be checked without
+# their bodies, so operators compare the commitment with nodes they trust
+# before bootstrapping from a snapshot.
+
+class SnapshotError(ValueError):
+    pass
+
+def snapshot_commitment(snapshot):
+    content = {key: value for key, value in snapshot.items() if key != 'commitment'}
+    encoded = json.dumps(content, sort_keys=True).encode()
+    return hashlib.sha256(hashlib.sha256(encoded).digest()).hexdigest()
+
+def make_snapshot(height, tip_hash, balances, nonces, headers):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'height': height,
+        'tip_hash': tip_hash,
+        'balances': balances,
+        'nonces': nonces,
+        'headers': headers
+    }
+    snapshot['commitment'] = snapshot_commitment(snapshot)
+    return snapshot
+
+def read_snapshot(path, expected_commitment=None):
+    """Load and check a snapshot; `expected_commitment` is the value obtained from a trusted node."""
+    try:
+        with open(path, 'r') as f:
+            snapshot = json.load(f)
+    except OSError as e:
+        raise SnapshotError(f'cannot read snapshot {path}: {str(e)}')
+    except json.JSONDecodeError as e:
+        raise SnapshotError(f'snapshot {path} is not valid JSON: {str(e)}')
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError(f'snapshot {path} is not a version {SNAPSHOT_VERSION} snapshot')
+    fields = ('height', 'tip_hash', 'balances', 'nonces', 'headers', 'commitment')
+    if not all(field in snapshot for field in fields):
+        raise SnapshotError(f'snapshot {path} is missing fields')
+    if snapshot_commitment(snapshot) != snapshot['commitment']:
+        raise SnapshotError(f'snapshot {path} does not match its commitment')
+    if expected_commitment is not None and snapshot['commitment'] != expected_commitment.lower():
+        raise SnapshotError(f"snapshot {path} has commitment {snapshot['commitment']}, expected {expected_commitment}")
+    headers = snapshot['headers']
+    if len(headers) != snapshot['height'] or not headers or headers[-1].get('hash') != snapshot['tip_hash']:
+        raise SnapshotError(f'snapshot {path} headers do not end at its tip')
+    return snapshot
@@ -0,0 +1,168 @@
+import json
+import logging
+import math
+import os
+from collections import deque
+from itertools import islice
+
+def valid_amount(amount):
+    return not isinstance(amount, bool) and isinstance(amount, (int, float)) and math.isfinite(amount) and amount > 0
+
+def valid_fee(fee):
+    return not isinstance(fee, bool) and isinstance(fee, (int, float)) and math.isfinite(fee) and fee >= 0
+
+def valid_nonce(nonce):
+    return isinstance(nonce, int) and not isinstance(nonce, bool)
+
+def balance_changes(balances, block, mining_reward):
+    """New balances of the accounts `block` touches when applied on top of `balances`, which is not modified.
+
+    Each sender pays the amount plus its fee; the miner collects the fees after the block's transactions.
+    Raises ValueError if a transaction has an invalid amount or fee, or its sender cannot cover it.
+    """
+    changes = {}
+    fees = 0
+
+    def credit(address, amount):
+        changes[address] = changes.get(address, balances.get(address, 0)) + amount
+
+    if block.get('miner'):
+        credit(block['miner'], mining_reward)
+    for transaction in block['transactions']:
+        amount, fee = transaction['amount'], transaction.get('fee', 0)
+        if not valid_amount(amount):
+            raise ValueError('invalid amount')
+        if not valid_fee(fee):
+            raise ValueError('invalid fee')
+        if changes.get(transaction['sender'], balances.get(transaction['sender'], 0)) < amount + fee:
+            raise ValueError('insufficient balance')
+        credit(transaction['sender'], -amount - fee)
+        credit(transaction['receiver'], amount)
+        fees += fee
+    if fees and block.get('miner'):
+        credit(block['miner'], fees)
+    return changes
+
+def transaction_cost(transaction):
+    return transaction['amount'] + transaction.get('fee', 0)
+
+class AccountState:
+    """Balances and confirmed nonces, updated block by block.
+
+    Each applied block leaves an undo record with the previous values of the
+    accounts it touched, so the last `max_undo` blocks can be reverted on a reorg.
+    Every `snapshot_interval` blocks the state is written to `path`, so a restart
+    only has to replay the blocks after the snapshot.
+    """
+
+    def __init__(self, path, mining_reward=50, snapshot_interval=100, max_undo=1000):
+        self.path = path
+        self.mining_reward = mining_reward
+        self.snapshot_interval = snapshot_interval
+        self.undo = deque(maxlen=max_undo)
+        self.saved_height = 0  # height of the state last written to `path`
+        self.reset()
+
+    def reset(self):
+        self.balances = {}
+        self.nonces = {}
+        self.height = 0  # number of blocks applied
+        self.tip_hash = None
+        self.undo.clear()
+
+    def balance(self, address):
+        return self.balances.get(address, 0)
+
+    def nonce(self, address):
+        return self.nonces.get(address)
+
+    def nonces_at(self, height):
+        """Confirmed nonces as of the first `height` blocks, or None if that is beyond the undo log."""
+        return self._rewind(self.nonces, 1, height)
+
+    def balances_at(self, height):
+        return self._rewind(self.balances, 0, height)
+
+    def _rewind(self, current, field, height):
+        # Applies the undo records newer than `height` to a copy of `current`.
+        depth = self.height - height
+        if depth < 0 or depth > len(self.undo):
+            return None
+        values = dict(current)
+        for record in islice(reversed(self.undo), depth):
+            for address, value in record[field].items():
+                if value is None:
+                    values.pop(address, None)
+                else:
+                    values[address] = value
+        return values
+
+    def apply_block(self, block, block_hash):
+        # Checked before anything changes, so a block that would create money leaves the state as it was.
+        changes = balance_changes(self.balances, block, self.mining_reward)
+        previous_balances = {address: self.balances.get(address) for address in changes}
+        previous_nonces = {}
+        self.balances.update(changes)
+
+        for transaction in block['transactions']:
+            sender = transaction['sender']
+            if sender not in previous_nonces:
+                previous_nonces[sender] = self.nonces.get(sender)
+            self.nonces[sender] = transaction['nonce']
+
+        self.undo.append((previous_balances, previous_nonces, self.tip_hash))
+        self.height += 1
+        self.tip_hash = block_hash
+        if self.height % self.snapshot_interval == 0:
+            self.save()
+
+    def revert_block(self):
+        if not self.undo:
+            raise ValueError('no undo record for the current tip')
+
+        previous_balances, previous_nonces, previous_tip = self.undo.pop()
+        for values, previous in ((self.balances, previous_balances), (self.nonces, previous_nonces)):
+            for address, value in previous.items():
+                if value is None:
+                    values.pop(address, None)
+                else:
+                    values[address] = value
+        self.height -= 1
+        self.tip_hash = previous_tip
+
+    def save(self):
+        snapshot = {
+            'height': self.height,
+            'tip_hash': self.tip_hash,
+            'balances': self.balances,
+            'nonces': self.nonces
+        }
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        self.saved_height = self.height
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except json.JSONDecodeError:
+            logging.error(f"State snapshot {self.path} is corrupt, ignoring it")
+            return False
+
+        self.restore(snapshot['height'], snapshot['tip_hash'], snapshot['balances'], snapshot['nonces'])
+        self.saved_height = self.height
+        return True
+
+    def restore(self, height, tip_hash, balances, nonces):
+        # Without undo records, blocks below `height` can no longer be reverted.
+        self.reset()
+        self.height = height
+        self.tip_hash = tip_hash
+        self.balances = balances
+        self.nonces = nonces
@@ -0,0 +1,78 @@
+import json
+import zlib
+from flask import Response, request
+
+CHUNK_SIZE = 64 * 1024
+
+def iter_chain_json(store, start, length, key, envelope):
+    # JSON records are copied into the response as they are instead of being
+    # parsed and re-encoded; binary ones are converted back to canonical JSON.
+    head = json.dumps(envelope)[:-1]
+    yield (head + (', ' if envelope else '') + json.dumps(key) + ': [').encode()
+    for height in range(start, length):
+        yield (b', ' if height > start else b'') + store.read_json(height)
+    yield f'], "length": {length}}}'.encode()
+
+def iter_chain_ndjson(store, start, length, envelope):
+    yield json.dumps(dict(envelope, length=length)).encode() + b'\n'
+    for height in range(start, length):
+        yield store.read_json(height) + b'\n'
+
+def coalesce(parts, chunk_size=CHUNK_SIZE):
+    buffer = bytearray()
+    for part in parts:
+        buffer += part
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def chain_response(blockchain, key='chain', envelope=None):
+    """Stream the whole chain as JSON or NDJSON, one block at a time.
+
+    The ETag is derived from the tip hash, so a client polling an unchanged chain
+    with If-None-Match gets a 304 back. A pruned node streams the blocks it
+    still has and says where they start with `start`.
+    """
+    envelope = envelope or {}
+    store = blockchain.store
+    # Serve the chain as of one published snapshot; blocks mined while the
+    # response streams are left for the next request.
+    length, tip_hash = blockchain.snapshot
+    start = min(store.pruned_height, length)
+    if start:
+        envelope = dict(envelope, start=start)
+    tip_hash = tip_hash or ''
+
+    ndjson = request.args.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    variant = zlib.crc32(json.dumps([key, envelope, ndjson, use_gzip], sort_keys=True).encode())
+    etag = f'{tip_hash[:32]}-{length}-{variant:08x}'
+
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    if ndjson:
+        parts, mimetype = iter_chain_ndjson(store, start, length, envelope), 'application/x-ndjson'
+    else:
+        parts, mimetype = iter_chain_json(store, start, length, key, envelope), 'application/json'
+    body = coalesce(parts)
+    if use_gzip:
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    response = Response(body, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    return response
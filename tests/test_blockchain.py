@@ -0,0 +1,171 @@
+import pytest
+
+import blockchain as blockchain_module
+from blockchain import Blockchain
+from crypto_utils import ED25519_SCHEME, generate_keys, key_address, sign_transaction, transaction_payload
+from merkletree import MerkleTree
+from retarget import Retarget
+
+class Account:
+    def __init__(self):
+        self.private_key, self.public_key = generate_keys(ED25519_SCHEME)
+        self.address = key_address(self.public_key)
+        self.nonce = 0
+
+    def transaction(self, receiver, amount, sender=None, **fields):
+        self.nonce += 1
+        transaction = dict({'sender': sender or self.address, 'receiver': receiver, 'amount': amount,
+                            'nonce': self.nonce, 'scheme': ED25519_SCHEME}, **fields)
+        payload = transaction_payload(transaction)
+        transaction['signature'] = sign_transaction(self.private_key, payload, ED25519_SCHEME).hex()
+        transaction['public_key'] = self.public_key
+        return transaction
+
+@pytest.fixture
+def make_chain(tmp_path, monkeypatch):
+    # Easy proof of work, so a test can mine a few dozen blocks in well under a second.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(blockchain_module, 'Retarget',
+                        lambda target_time: Retarget(target_time=0.05, max_step=0.25, initial_difficulty=6))
+    chains = []
+
+    def make_chain(port=5900, reward_address=None):
+        chain = Blockchain(port, data_dir=str(tmp_path / str(port)), reward_address=reward_address)
+        chain.nodes = set()
+        chains.append(chain)
+        return chain
+
+    yield make_chain
+    for chain in chains:
+        chain.close()
+
+def forge_block(chain, transactions, miner=None):
+    """A block on the tip with exactly `transactions`, whatever the mempool holds."""
+    template, previous_nonce = chain.create_block_template(miner)
+    template.update(transactions=transactions, merkleroot=MerkleTree(transactions).get_root())
+    nonce = chain.mining_engine.search(previous_nonce, template['difficulty'])
+    return dict(template, nonce=nonce, block_time=0.1)
+
+def test_sender_must_match_signing_key(make_chain):
+    alice, mallory = Account(), Account()
+    chain = make_chain(reward_address=alice.address)
+    funds = chain.state.balance(alice.address)
+    assert funds > 0
+
+    stolen = mallory.transaction(mallory.address, 10, sender=alice.address)
+    assert chain.add_transactions([stolen], reasons=True) == [(False, 'sender does not match key')]
+    assert chain.receive_block(forge_block(chain, [stolen])) is None
+    assert chain.state.balance(alice.address) == funds
+
+    own = alice.transaction(mallory.address, 10)
+    assert chain.add_transactions([own]) == [len(chain.chain) + 1]
+    chain.mine_block()
+    assert chain.state.balance(mallory.address) == 10
+
+def test_block_spending_pending_funds_evicts_stale_transactions(make_chain):
+    alice, bob = Account(), Account()
+    chain = make_chain(reward_address=alice.address)
+    funds = chain.state.balance(alice.address)
+
+    spend_all, pending = alice.transaction(bob.address, funds), alice.transaction(bob.address, 10)
+    assert chain.add_transactions([pending]) == [len(chain.chain) + 1]
+    assert chain.receive_block(forge_block(chain, [spend_all], miner=bob.address)) is not None
+    assert chain.state.balance(alice.address) == 0
+    assert len(chain.mempool) == 0
+
+    chain.mine_block()
+    assert chain.state.balance(bob.address) == funds + chain.state.mining_reward
+
+def test_template_skips_transactions_the_state_no_longer_covers(make_chain):
+    alice, bob = Account(), Account()
+    chain = make_chain(reward_address=alice.address)
+    funds = chain.state.balance(alice.address)
+
+    first, second = alice.transaction(bob.address, funds), alice.transaction(bob.address, 10)
+    assert chain.add_transactions([first]) == [len(chain.chain) + 1]
+    # Admitted while `first` is still only pending, then made unaffordable by it.
+    chain.mempool.add(second)
+    template = chain.template_tree()
+    assert template.transactions == [first]
+    assert template.get_root() == MerkleTree([first]).get_root()
+
+def test_incremental_validation_credits_the_genesis_reward(make_chain):
+    alice, bob = Account(), Account()
+    chain = make_chain()
+    peer = make_chain(port=5901, reward_address=alice.address)
+    funds = peer.state.balance(alice.address)
+    # The peer's genesis block differs from ours, so the candidate forks at height 0.
+    peer.receive_block(forge_block(peer, [alice.transaction(bob.address, funds)], miner=bob.address))
+    peer.mine_block()
+
+    assert chain.validate_chain(peer.chain, full=True)[0]
+    assert chain.validate_chain(peer.chain)[0]
+
+def test_malformed_fee_is_refused(make_chain):
+    alice, bob = Account(), Account()
+    chain = make_chain(reward_address=alice.address)
+
+    bad_fee = alice.transaction(bob.address, 1, fee='x')
+    assert chain.add_transactions([bad_fee], reasons=True) == [(False, 'invalid fee')]
+    assert len(chain.mempool) == 0
+    chain.mine_block()
+
+def test_fees_are_charged_to_the_sender_and_paid_to_the_miner(make_chain):
+    alice, bob, carol = Account(), Account(), Account()
+    chain = make_chain(reward_address=alice.address)
+    funds = chain.state.balance(alice.address)
+
+    too_much = alice.transaction(bob.address, funds, fee=1)
+    assert chain.add_transactions([too_much], reasons=True) == [(False, 'insufficient balance')]
+    alice.nonce -= 1
+    paid = alice.transaction(bob.address, 10, fee=3)
+    assert chain.add_transactions([paid]) == [len(chain.chain) + 1]
+    assert chain.available_balance(alice.address) == funds - 13
+
+    chain.receive_block(forge_block(chain, [paid], miner=carol.address))
+    assert chain.state.balance(alice.address) == funds - 13
+    assert chain.state.balance(bob.address) == 10
+    assert chain.state.balance(carol.address) == chain.state.mining_reward + 3
+    assert chain.validate_chain(chain.chain, full=True)[0]
+
+def test_timestamps_with_an_offset_are_refused(make_chain):
+    chain = make_chain()
+    chain.mine_block()
+    block = forge_block(chain, [])
+    assert chain.retarget.valid_timestamp(chain.chain, block['timestamp'])
+
+    aware = block['timestamp'] + '+00:00'
+    assert not chain.retarget.valid_timestamp(chain.chain, aware)
+    assert chain.receive_block(dict(block, timestamp=aware)) is None
+    assert chain.receive_block(block) is not None
+
+def test_incremental_and_full_validation_agree(make_chain):
+    alice, bob, carol = Account(), Account(), Account()
+    chain = make_chain(reward_address=alice.address)
+    funds = chain.state.balance(alice.address)
+    fork_height = len(chain.chain)
+    replayed = alice.transaction(bob.address, 1)
+    fork_spend = forge_block(chain, [replayed, alice.transaction(bob.address, funds - 1)])
+
+    # Our chain spends the same funds differently after the fork point.
+    alice.nonce = 0
+    chain.receive_block(forge_block(chain, [alice.transaction(bob.address, funds // 2, fee=1)], miner=carol.address))
+    chain.receive_block(forge_block(chain, [], miner=carol.address))
+    tip = len(chain.chain)
+
+    def on_tip(*transactions):
+        return list(chain.chain) + [forge_block(chain, list(transactions), miner=carol.address)]
+
+    candidates = {
+        'fork spending our funds again': (list(chain.chain[:fork_height]) + [fork_spend], True),
+        'tip spending more than is left': (on_tip(alice.transaction(bob.address, funds - funds // 2)), False),
+        'tip replaying a nonce': (on_tip(replayed), False),
+        'tip paying its fee': (on_tip(alice.transaction(bob.address, funds - funds // 2 - 2, fee=1)), True),
+    }
+    candidates['our own chain'] = (chain.chain, True)
+    for name, (candidate, expected) in candidates.items():
+        full, incremental = chain.validate_chain(candidate, full=True), chain.validate_chain(candidate)
+        assert (full[0], incremental[0]) == (expected, expected), name
+        if expected:
+            assert incremental[1] == full[1], name
+    assert len(chain.chain) == tip
@@ -0,0 +1,96 @@
+import json
+import os
+from array import array
+
+import pytest
+
+from blockstore import INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION, RECORD_HEADER, BlockStore, block_digest
+
+def make_block(index):
+    return {
+        'index': index,
+        'timestamp': f'2024-01-01 00:00:{index:02d}.000000',
+        'previous_hash': '0' if index == 1 else 'ab' * 32,
+        'transactions': [],
+        'merkleroot': '',
+        'difficulty': 8,
+        'nonce': index * 7,
+        'block_time': 0.5,
+        'uncles': []
+    }
+
+def expected_hash(block):
+    return block_digest(json.dumps(block, sort_keys=True).encode()).hex()
+
+@pytest.fixture(params=['json', 'binary'])
+def record_format(request):
+    return request.param
+
+def fill(path, count, record_format='json'):
+    store = BlockStore(str(path), record_format=record_format)
+    blocks = [make_block(i + 1) for i in range(count)]
+    for block in blocks:
+        store.append(block)
+    store.close()
+    return blocks
+
+def test_torn_record_is_truncated(tmp_path, record_format):
+    blocks = fill(tmp_path, 3, record_format)
+    segment = os.path.join(tmp_path, 'blk00000.dat')
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(RECORD_HEADER.pack(100, 0) + b'{"index": 4')
+
+    store = BlockStore(str(tmp_path), record_format=record_format)
+    assert len(store) == 3
+    assert os.path.getsize(segment) == size
+    assert list(store) == blocks
+
+    block = make_block(4)
+    assert store.append(block) == expected_hash(block)
+    store.close()
+    reopened = BlockStore(str(tmp_path), record_format=record_format)
+    assert list(reopened) == blocks + [block]
+    reopened.close()
+
+def test_index_entry_past_segment_end_is_dropped(tmp_path):
+    blocks = fill(tmp_path, 3)
+    segment = os.path.join(tmp_path, 'blk00000.dat')
+    os.truncate(segment, os.path.getsize(segment) - 5)
+
+    store = BlockStore(str(tmp_path))
+    assert len(store) == 2
+    assert list(store) == blocks[:2]
+    store.close()
+
+def test_unindexed_records_are_reindexed(tmp_path, record_format):
+    blocks = fill(tmp_path, 5, record_format)
+    index_path = os.path.join(tmp_path, 'index.dat')
+    entry_size = (os.path.getsize(index_path) - INDEX_HEADER.size) // 5
+    os.truncate(index_path, INDEX_HEADER.size + 2 * entry_size)
+
+    store = BlockStore(str(tmp_path), record_format=record_format)
+    assert len(store) == 5
+    assert [store.block_hash(height) for height in range(5)] == [expected_hash(block) for block in blocks]
+    assert store.height_of(expected_hash(blocks[4])) == 4
+    store.close()
+    assert os.path.getsize(index_path) == INDEX_HEADER.size + 5 * entry_size
+
+def test_version_1_index_is_rebuilt(tmp_path):
+    blocks = fill(tmp_path, 4)
+    index_path = os.path.join(tmp_path, 'index.dat')
+    store = BlockStore(str(tmp_path))
+    entries = [store._entry(height) for height in range(4)]
+    store.close()
+    # Version 1 entries held only segment, offset and length.
+    with open(index_path, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, 1))
+        f.write(array('Q', [field for entry in entries for field in entry]).tobytes())
+
+    store = BlockStore(str(tmp_path))
+    assert len(store) == 4
+    assert list(store) == blocks
+    assert [store.block_hash(height) for height in range(4)] == [expected_hash(block) for block in blocks]
+    store.close()
+    with open(index_path, 'rb') as f:
+        assert INDEX_HEADER.unpack(f.read(INDEX_HEADER.size)) == (INDEX_MAGIC, INDEX_VERSION)
@@ -0,0 +1,75 @@
+import pytest
+
+from codec import (BLOCK, CODEC_VERSION, MAGIC, CodecError, UnsupportedFormat, decode, decode_block, encode_block,
+                   encode_header, encode_transactions)
+from crypto_utils import ED25519_SCHEME, RSA_SCHEME, generate_keys, sign_transaction, transaction_payload
+
+@pytest.fixture(scope='module')
+def keys():
+    return {scheme: generate_keys(scheme) for scheme in (RSA_SCHEME, ED25519_SCHEME)}
+
+def make_transaction(keys, scheme, nonce, tagged=False, **fields):
+    private_key, public_key = keys[scheme]
+    transaction = dict({'sender': public_key, 'receiver': 'bob', 'amount': 1.5, 'nonce': nonce}, **fields)
+    if tagged:
+        transaction['scheme'] = scheme
+    transaction['signature'] = sign_transaction(private_key, transaction_payload(transaction), scheme).hex()
+    transaction['public_key'] = public_key
+    return transaction
+
+def make_block(transactions):
+    return {
+        'index': 2,
+        'timestamp': '2024-01-01 00:00:01.000000',
+        'previous_hash': 'ab' * 32,
+        'transactions': transactions,
+        'merkleroot': 'cd' * 32,
+        'difficulty': 20.5,
+        'nonce': 12345,
+        'block_time': 1.25,
+        'uncles': [],
+        'miner': '127.0.0.1:5000'
+    }
+
+def test_block_round_trip(keys):
+    transactions = [make_transaction(keys, RSA_SCHEME, 1), make_transaction(keys, RSA_SCHEME, 2, fee=3),
+                    make_transaction(keys, ED25519_SCHEME, 1, tagged=True)]
+    block = make_block(transactions)
+    data = encode_block(block)
+    assert data[0] == MAGIC and data[1] == CODEC_VERSION
+    assert decode_block(data) == block
+    assert decode(encode_transactions(transactions))['transactions'] == transactions
+
+def test_rsa_only_block_is_version_1(keys):
+    block = make_block([make_transaction(keys, RSA_SCHEME, 1)])
+    data = encode_block(block)
+    assert data[1] == 1
+    assert decode_block(data) == block
+
+def test_header_round_trip():
+    header = {'index': 0, 'timestamp': '2024-01-01 00:00:00', 'previous_hash': '0', 'merkleroot': '',
+              'difficulty': 20, 'nonce': 0, 'block_time': 0, 'hash': 'ef' * 32, 'transaction_count': 0,
+              'uncle_count': 0}
+    assert decode(encode_header(header)) == header
+
+def test_bad_magic_is_rejected():
+    data = bytearray(encode_block(make_block([])))
+    data[0] = ord('{')
+    with pytest.raises(UnsupportedFormat):
+        decode(bytes(data))
+
+@pytest.mark.parametrize('version', [0, CODEC_VERSION + 1])
+def test_unknown_version_is_rejected(version):
+    data = bytearray(encode_block(make_block([])))
+    data[1] = version
+    with pytest.raises(UnsupportedFormat, match='unsupported codec version'):
+        decode(bytes(data))
+
+def test_wrong_type_and_truncation_are_rejected():
+    data = encode_block(make_block([]))
+    with pytest.raises(CodecError):
+        decode(data, BLOCK + 1)
+    with pytest.raises(CodecError):
+        decode(data[:-3])
+    with pytest.raises(CodecError):
+        decode(data + b'\0')
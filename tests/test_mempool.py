@@ -0,0 +1,79 @@
+from mempool import Mempool
+
+def make_transaction(sender, nonce, amount=1, fee=None, receiver='bob'):
+    transaction = {'sender': sender, 'receiver': receiver, 'amount': amount, 'nonce': nonce,
+                   'signature': f'{sender}-{nonce}-{fee}', 'public_key': sender}
+    if fee is not None:
+        transaction['fee'] = fee
+    return transaction
+
+def test_malformed_fields_are_refused_before_anything_changes():
+    mempool = Mempool()
+    assert mempool.add(make_transaction('alice', 1, fee=2)) == (True, 'added')
+
+    assert mempool.add(make_transaction('alice', 2, fee='x')) == (False, 'invalid fee')
+    assert mempool.add(make_transaction('alice', 1, fee=float('nan'))) == (False, 'invalid fee')
+    assert mempool.add(make_transaction('alice', '3')) == (False, 'invalid nonce')
+    assert mempool.add(make_transaction('alice', 4, amount='1')) == (False, 'invalid amount')
+
+    assert len(mempool) == 1
+    assert mempool.pending_spend('alice') == 3
+    assert [tx['nonce'] for tx in mempool.select()] == [1]
+
+def test_select_orders_by_fee_then_arrival_keeping_nonce_order():
+    mempool = Mempool()
+    for transaction in [make_transaction('alice', 1, fee=1), make_transaction('alice', 2, fee=9),
+                        make_transaction('bob', 1, fee=5), make_transaction('carol', 1, fee=5),
+                        make_transaction('dave', 1)]:
+        assert mempool.add(transaction)[0]
+
+    order = [(tx['sender'], tx['nonce']) for tx in mempool.select()]
+    assert order == [('bob', 1), ('carol', 1), ('alice', 1), ('alice', 2), ('dave', 1)]
+    assert [(tx['sender'], tx['nonce']) for tx in mempool.select(2)] == order[:2]
+    assert mempool.pending_nonce('alice') == 2
+
+def test_replacement_needs_a_higher_fee():
+    mempool = Mempool()
+    original = make_transaction('alice', 1, amount=5, fee=2)
+    assert mempool.add(original) == (True, 'added')
+    assert mempool.add(dict(original, signature='resigned')) == (False, 'duplicate')
+    assert mempool.add(make_transaction('alice', 1, amount=7, fee=2)) == (False, 'replacement fee too low')
+
+    replacement = make_transaction('alice', 1, amount=7, fee=3)
+    assert mempool.add(replacement) == (True, 'replaced')
+    assert mempool.select() == [replacement]
+    assert mempool.pending_spend('alice') == 10
+
+def test_lowest_fee_is_evicted_when_full():
+    mempool = Mempool(max_count=2)
+    assert mempool.add(make_transaction('alice', 1, fee=1))[0]
+    assert mempool.add(make_transaction('bob', 1, fee=3))[0]
+    assert mempool.add(make_transaction('carol', 1, fee=2)) == (True, 'added')
+    assert mempool.add(make_transaction('dave', 1, fee=0)) == (False, 'mempool full')
+
+    assert [tx['sender'] for tx in mempool.select()] == ['bob', 'carol']
+    assert mempool.pending_spend('alice') == 0
+
+def test_remove_confirmed_drops_stale_nonces():
+    mempool = Mempool()
+    transactions = [make_transaction('alice', nonce) for nonce in (1, 2, 3)] + [make_transaction('bob', 4)]
+    for transaction in transactions:
+        mempool.add(transaction)
+
+    # Alice's nonce 2 was confirmed under another signature, so nonce 1 can never be.
+    mempool.remove_confirmed([dict(transactions[1], signature='other')])
+    assert [(tx['sender'], tx['nonce']) for tx in mempool.select()] == [('alice', 3), ('bob', 4)]
+    mempool.remove_confirmed([transactions[2], transactions[3]])
+    assert len(mempool) == 0 and mempool.size_bytes == 0
+    assert mempool.select() == []
+
+def test_remove_unfunded_keeps_what_the_balance_still_covers():
+    mempool = Mempool()
+    for nonce in (1, 2, 3):
+        mempool.add(make_transaction('alice', nonce, amount=4, fee=1))
+    mempool.add(make_transaction('bob', 1, amount=50))
+
+    mempool.remove_unfunded({'alice': 11, 'bob': 0}.get, ['alice'])
+    assert [(tx['sender'], tx['nonce']) for tx in mempool.select()] == [('alice', 1), ('alice', 2), ('bob', 1)]
+    mempool.remove_unfunded({'alice': 11, 'bob': 0}.get)
+    assert mempool.pending_spend('alice') == 10 and mempool.pending_spend('bob') == 0
@@ -0,0 +1,25 @@
+import threading
+
+import pytest
+
+from mining import ParallelEngine, check_proof
+
+@pytest.fixture
+def engine():
+    engine = ParallelEngine(2)
+    yield engine
+    engine.close()
+
+def test_parallel_search_finds_a_valid_nonce(engine):
+    nonce = engine.search(7, 8)
+    assert check_proof(7, nonce, 8)
+
+def test_parallel_search_returns_none_when_cancelled(engine):
+    stop_event = threading.Event()
+    stop_event.set()
+    assert engine.search(7, 200, stop_event) is None
+
+def test_worker_failure_fails_the_search(engine):
+    with pytest.raises(RuntimeError, match='Mining worker failed'):
+        engine.search(7, 'bad')
+    assert check_proof(7, engine.search(7, 8), 8)
@@ -0,0 +1,58 @@
+import pytest
+
+from state import AccountState, balance_changes
+
+def make_block(miner, *transactions):
+    return {'miner': miner, 'transactions': [
+        {'sender': sender, 'receiver': receiver, 'amount': amount, 'nonce': nonce, **fields}
+        for sender, receiver, amount, nonce, fields in transactions]}
+
+@pytest.fixture
+def state(tmp_path):
+    state = AccountState(str(tmp_path / 'state.json'), mining_reward=50, snapshot_interval=1000, max_undo=2)
+    state.apply_block(make_block('alice'), 'h1')
+    state.apply_block(make_block('bob', ('alice', 'carol', 20, 1, {'fee': 5})), 'h2')
+    state.apply_block(make_block('bob', ('carol', 'alice', 10, 1, {}), ('alice', 'carol', 5, 2, {})), 'h3')
+    return state
+
+def test_balance_changes_charge_fees_and_leave_balances_alone():
+    balances = {'alice': 30}
+    changes = balance_changes(balances, make_block('bob', ('alice', 'carol', 20, 1, {'fee': 5})), 50)
+    assert changes == {'alice': 5, 'carol': 20, 'bob': 55}
+    assert balances == {'alice': 30}
+
+    for transaction, reason in [(('alice', 'carol', 26, 1, {'fee': 5}), 'insufficient balance'),
+                                (('alice', 'carol', 0, 1, {}), 'invalid amount'),
+                                (('alice', 'carol', 1, 1, {'fee': -1}), 'invalid fee')]:
+        with pytest.raises(ValueError, match=reason):
+            balance_changes(balances, make_block('bob', transaction), 50)
+
+def test_history_within_the_undo_log(state):
+    assert state.balances == {'alice': 30, 'bob': 105, 'carol': 15}
+    assert state.nonces == {'alice': 2, 'carol': 1}
+
+    assert state.balances_at(2) == {'alice': 25, 'bob': 55, 'carol': 20}
+    assert state.nonces_at(2) == {'alice': 1}
+    assert state.balances_at(1) == {'alice': 50}
+    assert state.nonces_at(1) == {}
+    assert state.balances_at(0) is None  # older than the two undo records kept
+    assert state.balances_at(4) is None
+    assert state.balances_at(3) == state.balances
+
+def test_revert_restores_previous_accounts(state):
+    expected = state.balances_at(2), state.nonces_at(2)
+    state.revert_block()
+    assert (state.balances, state.nonces) == expected
+    assert (state.height, state.tip_hash) == (2, 'h2')
+
+    state.revert_block()
+    assert (state.balances, state.nonces, state.tip_hash) == ({'alice': 50}, {}, 'h1')
+    with pytest.raises(ValueError):
+        state.revert_block()
+
+def test_rejected_block_changes_nothing(state):
+    before = dict(state.balances), dict(state.nonces), state.height
+    with pytest.raises(ValueError):
+        state.apply_block(make_block('dave', ('carol', 'dave', 100, 2, {})), 'h4')
+    assert (state.balances, state.nonces, state.height) == before
+    assert state.tip_hash == 'h3'
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+from mempool import transaction_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    txid TEXT PRIMARY KEY,
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transactions_height ON transactions (height);
+CREATE TABLE IF NOT EXISTS address_transactions (
+    address TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    txid TEXT NOT NULL,
+    PRIMARY KEY (address, height, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS address_transactions_height ON address_transactions (height);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class TransactionIndex:
+    """On-disk txid -> (height, position) and address -> txids indexes.
+
+    Both live in SQLite B-trees, so lookups are O(log n) and memory use is capped
+    by the page cache rather than by the number of transactions.
+    """
+
+    def __init__(self, path, cache_kib=8192):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(f'PRAGMA cache_size=-{int(cache_kib)}')
+            self.db.executescript(SCHEMA)
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, height, tip_hash):
+        self.db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                            [('height', str(height)), ('tip_hash', tip_hash)])
+
+    @property
+    def height(self):
+        with self.lock:
+            return int(self._get_meta('height') or 0)
+
+    @property
+    def tip_hash(self):
+        with self.lock:
+            return self._get_meta('tip_hash')
+
+    def add_block(self, height, block, block_hash):
+        transaction_rows = []
+        address_rows = []
+        for position, transaction in enumerate(block['transactions']):
+            txid = transaction_id(transaction)
+            transaction_rows.append((txid, height, position))
+            address_rows.append((transaction['sender'], height, position, txid))
+            address_rows.append((transaction['receiver'], height, position, txid))
+
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO transactions VALUES (?, ?, ?)', transaction_rows)
+            self.db.executemany('INSERT OR IGNORE INTO address_transactions VALUES (?, ?, ?, ?)', address_rows)
+            self._set_meta(height + 1, block_hash)
+
+    def rollback_to(self, height, tip_hash):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM transactions WHERE height >= ?', (height,))
+            self.db.execute('DELETE FROM address_transactions WHERE height >= ?', (height,))
+            self._set_meta(height, tip_hash)
+
+    def reset(self):
+        self.rollback_to(0, None)
+
+    def lookup(self, txid):
+        with self.lock:
+            row = self.db.execute('SELECT height, position FROM transactions WHERE txid = ?', (txid,)).fetchone()
+        return tuple(row) if row else None
+
+    def address_transactions(self, address, limit=50, before=None):
+        """Newest first. `before` is the (height, position) cursor returned with the previous page."""
+        query = 'SELECT txid, height, position FROM address_transactions WHERE address = ?'
+        params = [address]
+        if before is not None:
+            query += ' AND (height, position) < (?, ?)'
+            params.extend(before)
+        query += ' ORDER BY height DESC, position DESC LIMIT ?'
+        params.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [{'txid': txid, 'height': height, 'position': position} for txid, height, position in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()